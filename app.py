@@ -1,8 +1,28 @@
-import sqlite3
-import requests # pyright: ignore[reportMissingModuleSource]
+import base64
+import functools
+import json
 import re
 import os
-from flask import Flask, render_template, request, redirect, url_for, abort, jsonify # pyright: ignore[reportMissingImports]
+import sqlite3
+import time
+import bulk_import
+import changes
+import covers
+import database
+import duplicates
+import enrich
+import export
+import facets
+import housekeeping
+import metrics
+import migrations
+import openlibrary
+import page_cache
+import snapshot
+import series
+import shelving
+import stats
+from flask import Flask, render_template, request, redirect, url_for, abort, jsonify, g, send_file, Response, make_response, stream_with_context # pyright: ignore[reportMissingImports]
 
 app = Flask(__name__)
 
@@ -17,124 +37,528 @@ IS_READ_ONLY = (APP_MODE == 'PUBLIC')
 def inject_mode():
     return dict(is_read_only=IS_READ_ONLY)
 
+# One pool per process. PUBLIC mode opens the file read-only, so the
+# public container can never write to the shared books.db. By default it
+# serves from an in-memory copy instead, refreshed when the file changes
+# (see snapshot.py); the page and facet caches then follow its version.
+USE_SNAPSHOT = IS_READ_ONLY and os.environ.get('PUBLIC_SNAPSHOT', '1') == '1'
+# With a snapshot, cached covers are looked up in a map built alongside it
+cover_map = None
+if USE_SNAPSHOT:
+    cover_map = covers.CoverMap()
+    db_pool = snapshot.SnapshotPool(on_load=cover_map.load)
+else:
+    db_pool = database.ConnectionPool(read_only=IS_READ_ONLY)
+data_version = db_pool.version if USE_SNAPSHOT else None
+
 def get_db_connection():
-    # 1. Determine where this file (app.py) is located
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    # 2. Look for the 'data' folder inside that directory
-    db_path = os.path.join(base_dir, 'data', 'books.db')
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def extract_year(date_str):
-    if not date_str: return None
-    match = re.search(r'\d{4}', str(date_str))
-    if match: return int(match.group(0))
-    return None
+    # One connection per request, borrowed from the pool on first use and
+    # handed back by close_db_connection() when the request ends.
+    # Statements are timed per route (see metrics.py).
+    if 'db' not in g:
+        g.db = metrics.InstrumentedConnection(db_pool.acquire(), request.endpoint or 'unmatched')
+    return g.db
+
+@app.teardown_appcontext
+def close_db_connection(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        db_pool.release(conn.conn)
+
+# --- METRICS ---
+
+# When this process last served a real request (scrapes don't count);
+# the nightly maintenance waits for a quiet moment
+last_request_at = time.monotonic()
+
+@app.before_request
+def start_request_timer():
+    global last_request_at
+    g.request_start = time.perf_counter()
+    if request.endpoint != 'metrics_page':
+        last_request_at = time.monotonic()
+
+@app.after_request
+def record_request(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.endpoint or 'unmatched'
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, route)
+        metrics.REQUESTS.inc(route, request.method, str(response.status_code))
+    return response
+
+if not IS_READ_ONLY:
+    @app.after_request
+    def index_written_works(response):
+        # A write may have added or renamed works: the duplicates worker
+        # indexes them off the request (see duplicates.py)
+        if request.method == 'POST' and response.status_code < 400:
+            duplicates.start_background()
+        return response
+
+@app.teardown_request
+def record_failed_request(exception):
+    # Only still set if after_request never ran (the response failed)
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.endpoint or 'unmatched'
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, route)
+        metrics.REQUESTS.inc(route, request.method, '500')
+
+@app.route('/metrics')
+def metrics_page():
+    """Prometheus text format, for this process only"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Bring the schema (tables, triggers, indexes) up to date before serving.
+# The admin container owns the file: PUBLIC mode never opens it writable
+# (which would also switch it to WAL), it waits until the schema matches.
+if IS_READ_ONLY:
+    migrations.wait_until_current(lambda: database.connect(read_only=True))
+else:
+    _conn = database.connect()
+    migrations.migrate(_conn)
+    _conn.close()
+
+# --- PUBLIC PAGE CACHE ---
+
+# In PUBLIC mode nothing here writes, so rendered pages are reused until
+# the admin container commits a change (see page_cache.py).
+pages = None
+if IS_READ_ONLY:
+    pages = page_cache.PageCache(max_bytes=int(os.environ.get('PAGE_CACHE_MB', 64)) * 1024 * 1024,
+                                 data_version=data_version)
+
+def cached_page(view):
+    """Serves the view from the page cache in PUBLIC mode, keyed on the
+    route, its URL arguments and the query string, with a strong ETag so
+    repeat visits get 304 Not Modified."""
+    if pages is None:
+        return view
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = (request.endpoint, tuple(sorted(kwargs.items())), tuple(sorted(request.args.items(multi=True))))
+        version = pages.version()
+        entry = pages.get(key)
+        if entry is None:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            body = response.get_data()
+            if g.get('no_page_cache'):
+                entry = page_cache.Entry(body, response.mimetype)
+            else:
+                entry = pages.put(key, body, response.mimetype, version)
+
+        response = Response(entry.body, mimetype=entry.mimetype)
+        response.set_etag(entry.etag)
+        # Browsers must revalidate, which costs them a 304 at most
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+
+    return wrapper
+
+# --- FULL-TEXT SEARCH ---
+
+# bm25 column weights: title, author, series_title, publisher, isbn, notes
+SEARCH_WEIGHTS = "10.0, 5.0, 3.0, 1.0, 2.0, 1.0"
+SEARCH_LIMIT = 50
+
+def build_match_query(text):
+    # Every word must match as a prefix ("tolk hob" finds The Hobbit).
+    # Words are quoted so FTS5 operators in user input are inert.
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    return " ".join(f'"{w}"*' for w in words)
+
+# --- LIBRARY LISTING ---
+
+# Number of grouped rows (one per title/author) sent per page of the listing
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# Facet counts per selection (see facets.py), reused until books.db changes
+facet_counts = facets.CountCache(data_version=data_version)
+listing_pages = facets.ListingCache(data_version=data_version)
+
+# Columns of the works table sent to the template / JSON
+WORK_COLUMNS = "id, title, author, series_title, series_number, published_year, formats, read_status"
+
+# Sort dropdown value -> (sort key expressions, direction)
+# Every key list ends with a unique column so the keyset cursor never skips
+# or repeats a row. NULLs are folded into sentinels so the row-value
+# comparison agrees with ORDER BY (NULLs first ascending, last descending).
+SORT_KEYS = {
+    # DEFAULT: The "Canonical Library Sort"
+    # 1. Author
+    # 2. Series Title (group series together)
+    # 3. Series Number (order within series)
+    # 4. Title (fallback for standalones or ties)
+    'author': (["author", "COALESCE(series_title, '')", "COALESCE(series_number, -1)", "title", "id"], 'ASC'),
+    'title': (["title", "id"], 'ASC'),
+    'newest': (["last_id"], 'DESC'),
+    'oldest': (["id"], 'ASC'),
+    'year_asc': (["COALESCE(published_year, -1)", "id"], 'ASC'),
+    'year_desc': (["COALESCE(last_year, -1)", "last_id"], 'DESC'),
+}
+
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(token, key_count):
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except ValueError:
+        return None
+    if not isinstance(values, list) or len(values) != key_count:
+        return None
+    # Only what encode_cursor() writes: the values go straight into SQL
+    if not all(value is None or isinstance(value, (str, int, float)) for value in values):
+        return None
+    return values
+
+def work_from_row(row):
+    return {
+        'id': row['id'],
+        'title': row['title'],
+        'author': row['author'],
+        'series_title': row['series_title'],
+        'series_number': row['series_number'],
+        'published_year': row['published_year'],
+        'copy_count': row['copy_count'],
+        'read_status': row['read_status'],
+        'display_formats': row['formats'] or "Unknown",
+    }
+
+def matching_copies(selected):
+    """(copy count expression, WHERE condition, params of either) for
+    listing works with copies matching the selected facets. Simple
+    status/signed filters use the works table's own counts; anything else
+    looks up the work's copies (idx_books_work)."""
+    if not selected:
+        return 'copy_count', None, []
+    column = facets.summary_column(selected)
+    if column:
+        return column, f"{column} > 0", []
+    where, params = facets.where(selected)
+    copies = f"FROM books WHERE books.title = works.title AND books.author = works.author AND {where}"
+    return f"(SELECT COUNT(*) {copies})", f"EXISTS (SELECT 1 {copies})", params
+
+def fetch_books_page(conn, sort_param, selected, cursor=None, limit=PAGE_SIZE):
+    """Returns (books, next_cursor) for one page of the grouped library listing.
+    Raises ValueError if the cursor does not belong to this sort mode."""
+    if selected and not facets.summary_column(selected):
+        # These look up the copies of every work they pass (a scan of
+        # works for a narrow selection), so pages are kept until the data
+        # changes
+        key = (tuple(selected.items()), sort_param, cursor, limit)
+        return listing_pages.get(key, lambda: query_books_page(conn, sort_param, selected, cursor, limit))
+    return query_books_page(conn, sort_param, selected, cursor, limit)
+
+def query_books_page(conn, sort_param, selected, cursor, limit):
+    keys, direction = SORT_KEYS.get(sort_param, SORT_KEYS['author'])
+
+    # 1. One row per title/author comes straight from the works table
+    # (kept up to date by triggers). Facets count only matching copies.
+    count_sql, condition, facet_params = matching_copies(selected)
+    conditions = []
+    # The count in the SELECT list takes its parameters before the WHERE clause
+    params = list(facet_params)
+    if condition:
+        conditions.append(condition)
+        params.extend(facet_params)
+
+    # 2. Seek past the last row of the previous page
+    if cursor:
+        values = decode_cursor(cursor, len(keys))
+        if values is None:
+            raise ValueError("Invalid cursor")
+        op = '>' if direction == 'ASC' else '<'
+        conditions.append(f"({', '.join(keys)}) {op} ({', '.join('?' * len(keys))})")
+        params.extend(values)
+
+    where_clause = ""
+    if conditions:
+        where_clause = "WHERE " + " AND ".join(conditions)
+    key_columns = ", ".join(f"{expr} AS sort_key_{i}" for i, expr in enumerate(keys))
+    order_clause = "ORDER BY " + ", ".join(f"{expr} {direction}" for expr in keys)
+
+    # Fetch one extra row to learn whether another page exists
+    final_query = f"""
+        SELECT {WORK_COLUMNS}, {count_sql} AS copy_count, {key_columns}
+        FROM works
+        {where_clause} {order_clause} LIMIT ?
+    """
+    params.append(limit + 1)
+    rows = conn.execute(final_query, params).fetchall()
+
+    # 3. Shape the rows for the template / JSON
+    books = [work_from_row(row) for row in rows[:limit]]
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor([last[f'sort_key_{i}'] for i in range(len(keys))])
+
+    return books, next_cursor
+
+def search_books(conn, text, selected, limit=SEARCH_LIMIT):
+    match = build_match_query(text)
+    if match is None:
+        return []
+
+    where, where_params = facets.where(selected)
+    count_sql, _, count_params = matching_copies(selected)
+
+    # 1. Rank matching copies and keep the best-ranked title/author groups
+    # 2. Pull each group's summary from the works table
+    query = f"""
+        WITH matches AS MATERIALIZED (
+            SELECT rowid, bm25(books_fts, {SEARCH_WEIGHTS}) AS score
+            FROM books_fts
+            WHERE books_fts MATCH ?
+        ),
+        hits AS (
+            SELECT title, author, MIN(score) AS score
+            FROM matches
+            JOIN books ON books.id = matches.rowid
+            WHERE {where}
+            GROUP BY title, author
+            ORDER BY score
+            LIMIT ?
+        )
+        SELECT {', '.join('works.' + c for c in WORK_COLUMNS.split(', '))},
+            {count_sql} AS copy_count
+        FROM hits
+        JOIN works ON works.title = hits.title AND works.author = hits.author
+        ORDER BY hits.score
+    """
+    rows = conn.execute(query, [match, *where_params, limit, *count_params]).fetchall()
+    return [work_from_row(row) for row in rows]
 
 # --- ROUTES ---
 
 @app.route('/')
+@cached_page
 def index():
-    conn = get_db_connection()
-    
     # URL Parameters
     sort_param = request.args.get('sort', 'author')
-    filter_param = request.args.get('filter', 'all')
-
-    # 1. Base Query
-    base_query = """
-        SELECT 
-            MIN(id) as id,
-            title, 
-            author, 
-            series_title, 
-            series_number, 
-            MIN(published_year) as published_year,
-            COUNT(*) as copy_count,
-            GROUP_CONCAT(binding, ',') as all_bindings,
-            read_status -- We need this for filtering logic
-        FROM books 
-    """
+    selected = facets.parse(request.args)
 
-    # 2. Add Filter Clause
-    where_clause = ""
-    params = []
-    
-    if filter_param == 'read':
-        where_clause = "WHERE read_status = 'Read'"
-    elif filter_param == 'tbr':
-        where_clause = "WHERE read_status = 'To Read'"
-    elif filter_param == 'dnf':
-        where_clause = "WHERE read_status = 'DNF'"
-    elif filter_param == 'signed':
-        where_clause = "WHERE is_signed = 1"
-
-    # 3. Add Sort Clause
-    if sort_param == 'newest':
-        order_clause = 'ORDER BY MAX(id) DESC'
-    elif sort_param == 'oldest':
-        order_clause = 'ORDER BY MIN(id) ASC'
-    elif sort_param == 'title':
-        order_clause = 'ORDER BY title ASC'
-    elif sort_param == 'year_asc':
-        order_clause = 'ORDER BY MIN(published_year) ASC'
-    elif sort_param == 'year_desc':
-        order_clause = 'ORDER BY MAX(published_year) DESC'
-    else:
-        # DEFAULT: The "Canonical Library Sort"
-        # 1. Author
-        # 2. Series Title (group series together)
-        # 3. Series Number (order within series)
-        # 4. Title (fallback for standalones or ties)
-        order_clause = '''
-            ORDER BY 
-            author ASC, 
-            series_title ASC, 
-            series_number ASC, 
-            title ASC
-        '''
-
-    # Combine Query
-    final_query = f"{base_query} {where_clause} GROUP BY title, author {order_clause}"
-    
-    books_raw = conn.execute(final_query, params).fetchall()
-    conn.close()
-
-    # Process Bindings
-    books = []
-    for b in books_raw:
-        book = dict(b)
-        if book['all_bindings']:
-            formats = [f.strip() for f in book['all_bindings'].split(',') if f.strip()]
-            unique_formats = sorted(list(set(formats)))
-            book['display_formats'] = ", ".join(unique_formats)
-        else:
-            book['display_formats'] = "Unknown"
-        books.append(book)
-
-    total_physical_books = sum(book['copy_count'] for book in books)
-    # Pass both sort and filter params back to template
-    return render_template('index.html', books=books, current_sort=sort_param, current_filter=filter_param, total_count=total_physical_books)
+    # Only the first page is rendered here; index.html pulls the rest
+    # from /api/books as the user scrolls.
+    conn = get_db_connection()
+    books, next_cursor = fetch_books_page(conn, sort_param, selected)
+    counts = facet_counts.get(conn, selected)
+
+    # Pass sort, facets and their counts back to template
+    return render_template('index.html', books=books, current_sort=sort_param, facets=counts['facets'],
+                           facet_headings={name: facet[2] for name, facet in facets.FACETS.items()},
+                           total_count=counts['total'], next_cursor=next_cursor)
+
+@app.route('/api/books')
+@cached_page
+def api_books():
+    """Keyset-paginated JSON version of the home page listing"""
+    sort_param = request.args.get('sort', 'author')
+    selected = facets.parse(request.args)
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    conn = get_db_connection()
+    try:
+        books, next_cursor = fetch_books_page(conn, sort_param, selected, cursor, limit)
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+
+    return jsonify({'books': books, 'next_cursor': next_cursor})
 
 @app.route('/book/<int:book_id>')
+@cached_page
 def book_detail(book_id):
     conn = get_db_connection()
     book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
     
     if book is None:
-        conn.close()
         abort(404)
         
-    siblings = conn.execute('''
-        SELECT id, binding, published_year, notes 
+    # Other copies of the work, also under spellings with the same work
+    # key ("Hobbit, The"); see duplicates.py
+    same_work, params = duplicates.same_work(book['title'], book['author'])
+    siblings = conn.execute(f'''
+        SELECT id, title, author, binding, published_year, notes
         FROM books 
-        WHERE title = ? AND author = ? AND id != ?
+        WHERE {same_work} AND id != ?
         ORDER BY id ASC
-    ''', (book['title'], book['author'], book_id)).fetchall()
+    ''', (*params, book_id)).fetchall()
+
+    # Serve the locally cached cover if we have it. Only the admin side
+    # queues missing ones; PUBLIC mode never downloads.
+    if cover_map is not None:
+        cover_key = cover_map.get(book['cover_url'])
+    else:
+        cover_key = covers.local_cover(book['cover_url'], fetch=not IS_READ_ONLY)
+        if book['cover_url'] and cover_key is None:
+            # Don't keep the hot-linked version once the cover is downloaded
+            g.no_page_cache = True
+
+    return render_template('book_detail.html', book=book, siblings=siblings, cover_key=cover_key)
+
+# Covers are named after a hash of their source URL and never change
+COVER_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+@app.route('/covers/<key>/<variant>.webp')
+def cover_image(key, variant):
+    if variant not in covers.VARIANTS or not re.fullmatch(r'[0-9a-f]{20}', key):
+        abort(404)
+    path = covers.variant_path(key, variant)
+    if not os.path.exists(path):
+        abort(404)
+
+    # conditional=True answers If-None-Match with 304 Not Modified
+    response = send_file(path, mimetype='image/webp', etag=f'{key}-{variant}', conditional=True)
+    response.headers['Cache-Control'] = COVER_CACHE_CONTROL
+    return response
+
+@app.route('/api/search')
+@cached_page
+def api_search():
+    """Ranked, prefix-matching search over the FTS5 index"""
+    text = request.args.get('q', '').strip()
+    selected = facets.parse(request.args)
+    limit = request.args.get('limit', SEARCH_LIMIT, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    conn = get_db_connection()
+    books = search_books(conn, text, selected, limit)
+
+    return jsonify({'books': books, 'query': text})
+
+@app.route('/api/changes')
+def api_changes():
+    """Books written since ?since=<version> (all of them for 0), so offline
+    clients only download what changed. Streamed, gzipped if accepted."""
+    since = request.args.get('since', 0, type=int)
+    compress = 'gzip' in request.accept_encodings
+
+    conn = get_db_connection()
+    body = changes.stream_changes(conn, since)
+    if compress:
+        body = export.gzip_chunks(body)
+
+    response = Response(stream_with_context(body), mimetype='application/json')
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+# --- COLLECTION STATISTICS ---
+
+# Shelf, weight and page-count figures for /stats (see stats.py), kept
+# until books.db changes
+collection_stats = stats.StatsCache(data_version=data_version)
+
+@app.route('/stats')
+@cached_page
+def stats_page():
+    return render_template('stats.html', stats=collection_stats.get(get_db_connection()))
+
+@app.route('/api/stats')
+@cached_page
+def api_stats():
+    return jsonify(collection_stats.get(get_db_connection()))
+
+# --- SERIES ---
+
+# Owned volumes, gaps and formats per series (see series.py), recomputed
+# only for the series a write touches
+series_index = series.SeriesIndex(data_version=data_version)
+
+@app.route('/series')
+@cached_page
+def series_page():
+    return render_template('series.html', all_series=series_index.all(get_db_connection()),
+                           incomplete=request.args.get('incomplete') == '1')
+
+@app.route('/series/<path:name>')
+@cached_page
+def api_series(name):
+    found = series_index.get(get_db_connection(), name)
+    if found is None:
+        abort(404)
+    return jsonify(found)
+
+# --- SHELF PLANNER ---
+
+# Layout of the physical copies on the defined shelves (see shelving.py),
+# updated from the change log when books.db changes
+shelf_planner = shelving.ShelfPlanner(data_version=data_version)
+
+def shelf_mode_param():
+    mode = request.args.get('mode')
+    return mode if mode in shelving.MODES else shelving.MODES[0]
+
+@app.route('/shelves')
+@cached_page
+def shelves_page():
+    conn = get_db_connection()
+    definitions = conn.execute('SELECT * FROM shelves ORDER BY id').fetchall()
+    return render_template('shelves.html', plan=shelf_planner.get(conn, shelf_mode_param()),
+                           definitions=definitions, modes=shelving.MODES,
+                           grams_per_mm=shelving.GRAMS_PER_MM)
+
+@app.route('/api/shelves')
+@cached_page
+def api_shelves():
+    return jsonify(shelf_planner.get(get_db_connection(), shelf_mode_param()))
 
-    conn.close()
-    return render_template('book_detail.html', book=book, siblings=siblings)
+def positive_number(name, required=True):
+    value = request.form.get(name, '').strip()
+    if not value and not required:
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        abort(400)
+    if number <= 0:
+        abort(400)
+    return number
+
+if not IS_READ_ONLY:
+    @app.route('/shelves/add', methods=('POST',))
+    def add_shelves():
+        name = request.form.get('name', '').strip()
+        count = positive_number('shelf_count', required=False) or 1
+        if not name or count != int(count):
+            abort(400)
+        conn = get_db_connection()
+        conn.execute('''
+            INSERT INTO shelves (name, width_mm, height_mm, max_load_kg, shelf_count) VALUES (?, ?, ?, ?, ?)
+        ''', (name, positive_number('width_mm'), positive_number('height_mm'),
+              positive_number('max_load_kg', required=False), int(count)))
+        conn.commit()
+        return redirect(url_for('shelves_page', mode=shelf_mode_param()))
+
+if not IS_READ_ONLY:
+    @app.route('/shelves/<int:shelf_id>/delete', methods=('POST',))
+    def delete_shelves(shelf_id):
+        conn = get_db_connection()
+        conn.execute('DELETE FROM shelves WHERE id = ?', (shelf_id,))
+        conn.commit()
+        return redirect(url_for('shelves_page', mode=shelf_mode_param()))
+
+@app.route('/sw.js')
+def service_worker():
+    # Served from the root (not /static/) so it may control every page
+    response = app.send_static_file('sw.js')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 if not IS_READ_ONLY:
     @app.route('/add', methods=('GET', 'POST'))
@@ -184,19 +608,20 @@ if not IS_READ_ONLY:
                         :height, :width, :weight, :notes, :cover_url)
             ''', book_data)
             new_id = cur.lastrowid
+            covers.fetcher.enqueue(book_data['cover_url'])
 
             # --- NEW: SYNC LOGIC ---
             # If checkbox is checked, apply read_status to all OTHER copies
             if request.form.get('sync_status'):
-                cur.execute('''
+                same_work, params = duplicates.same_work(title, author)
+                cur.execute(f'''
                     UPDATE books 
                     SET read_status = ? 
-                    WHERE title = ? AND author = ? AND id != ?
-                ''', (read_status, title, author, new_id))
+                    WHERE {same_work} AND id != ?
+                ''', (read_status, *params, new_id))
             # -----------------------
 
             conn.commit()
-            conn.close()
 
             return redirect(url_for('book_detail', book_id=new_id))
 
@@ -209,7 +634,6 @@ if not IS_READ_ONLY:
         book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
 
         if book is None:
-            conn.close()
             abort(404)
 
         if request.method == 'POST':
@@ -259,20 +683,23 @@ if not IS_READ_ONLY:
             ''', book_data)
 
             if request.form.get('sync_status'):
-                conn.execute('''
+                same_work, params = duplicates.same_work(title, author)
+                conn.execute(f'''
                     UPDATE books 
                     SET read_status = ? 
-                    WHERE title = ? AND author = ? AND id != ?
-                ''', (read_status, title, author, book_id))
+                    WHERE {same_work} AND id != ?
+                ''', (read_status, *params, book_id))
 
             conn.commit()
-            conn.close()
+            covers.fetcher.enqueue(book_data['cover_url'])
             if request.args.get('origin') == 'audit':
+                # Straight on to the next book on that audit list
+                if request.args.get('list') in AUDIT_LISTS:
+                    return redirect(url_for('audit_next', list=request.args['list'], after=book_id))
                 return redirect(url_for('audit_page'))
                 
             return redirect(url_for('book_detail', book_id=book_id))
 
-        conn.close()
         return render_template('add_book.html', book=book)
 
 if not IS_READ_ONLY:
@@ -281,101 +708,213 @@ if not IS_READ_ONLY:
         conn = get_db_connection()
         conn.execute('DELETE FROM books WHERE id = ?', (book_id,))
         conn.commit()
-        conn.close()
         return redirect(url_for('index'))
 
 @app.route('/api/lookup', methods=['POST'])
 def lookup_isbn():
-    data = request.get_json()
-    isbn = data.get('isbn')
-    clean_isbn = ''.join(filter(str.isdigit, isbn))
+    data = request.get_json(silent=True) or {}
+    clean_isbn = openlibrary.clean_isbn(data.get('isbn'))
 
     if not clean_isbn:
         return jsonify({'found': False})
 
+    # 1. Open Library Fetch (cached, see openlibrary.py)
     try:
-        # 1. Open Library Fetch
-        url = f"https://openlibrary.org/api/books?bibkeys=ISBN:{clean_isbn}&jscmd=data&format=json"
-        response = requests.get(url)
-        if response.status_code == 200:
-            json_data = response.json()
-            key = f"ISBN:{clean_isbn}"
-            if key in json_data:
-                book = json_data[key]
-                
-                # Format Author
-                authors_str = "Unknown"
-                if 'authors' in book:
-                    raw_names = [a['name'] for a in book['authors']]
-                    formatted_names = []
-                    for name in raw_names:
-                        parts = name.strip().split(' ')
-                        if len(parts) > 1:
-                            last = parts[-1]
-                            first = " ".join(parts[:-1])
-                            formatted_names.append(f"{last}, {first}")
-                        else:
-                            formatted_names.append(name)
-                    authors_str = " & ".join(formatted_names)
-                
-                # Cover
-                cover = ""
-                if 'cover' in book:
-                    cover = book['cover'].get('large', book['cover'].get('medium', ''))
-
-                # --- NEW: CHECK LOCAL DB FOR READ STATUS ---
-                conn = get_db_connection()
-                # Check if we have ANY copy of this book (same title/author) that is not NULL
-                existing = conn.execute('''
-                    SELECT read_status FROM books 
-                    WHERE title = ? AND author = ? AND read_status IS NOT NULL 
-                    LIMIT 1
-                ''', (book.get('title', ''), authors_str)).fetchone()
-                conn.close()
-
-                suggested_status = ""
-                if existing:
-                    suggested_status = existing['read_status']
-                # -------------------------------------------
-
-                return jsonify({
-                    'found': True,
-                    'title': book.get('title', ''),
-                    'author': authors_str,
-                    'published_year': extract_year(book.get('publish_date')),
-                    'page_count': book.get('number_of_pages'),
-                    'publisher': book.get('publishers', [{'name': ''}])[0].get('name'),
-                    'cover_url': cover,
-                    'suggested_status': suggested_status # Sending this back to frontend
-                })
-    except:
-        pass
-    
-    return jsonify({'found': False})
+        book = openlibrary.lookup(clean_isbn)
+    except openlibrary.LookupFailed:
+        return jsonify({'found': False, 'error': 'Open Library is not responding. Try again later.'}), 502
+
+    if book is None:
+        return jsonify({'found': False})
+
+    # --- NEW: CHECK LOCAL DB FOR READ STATUS ---
+    conn = get_db_connection()
+    # Check if we have ANY copy of this book (same title/author) that is not NULL
+    same_work, params = duplicates.same_work(book['title'], book['author'])
+    existing = conn.execute(f'''
+        SELECT read_status FROM books 
+        WHERE {same_work} AND read_status IS NOT NULL 
+        LIMIT 1
+    ''', params).fetchone()
+
+    suggested_status = ""
+    if existing:
+        suggested_status = existing['read_status']
+    # -------------------------------------------
+
+    result = dict(book)
+    result['found'] = True
+    result['suggested_status'] = suggested_status # Sending this back to frontend
+    return jsonify(result)
+
+# --- AUDIT ---
+
+# Audit list -> (bits of audit_queue.missing, tab label). The masks must
+# match the partial indexes of migration 8.
+AUDIT_LISTS = {
+    'dims': (6, "Physical Audit (Dimensions)"),
+    'isbn': (1, "Bibliographic Audit (ISBNs)"),
+    'cover': (8, "Covers"),
+    'pages': (16, "Page Counts"),
+    'year': (32, "Publication Year"),
+}
+AUDIT_PAGE_SIZE = 100
+
+# Queue order (author, series, title) with book_id as the tie-breaker
+AUDIT_KEYS = "q.author, q.series_title, q.series_number, q.title, q.book_id"
+
+def audit_list_param():
+    list_name = request.args.get('list', 'dims')
+    if list_name not in AUDIT_LISTS:
+        abort(404)
+    return list_name
 
 if not IS_READ_ONLY:
     @app.route('/audit')
     def audit_page():
+        list_name = audit_list_param()
+        mask = AUDIT_LISTS[list_name][0]
         conn = get_db_connection()
-        
-        # MODIFIED QUERY: Exclude books where no_isbn = 1
-        missing_isbn = conn.execute('''
-            SELECT * FROM books 
-            WHERE (isbn IS NULL OR isbn = '') 
-            AND (no_isbn IS NULL OR no_isbn = 0) 
-            ORDER BY author ASC, title ASC
-        ''').fetchall()
-        
-        missing_dims = conn.execute('''
-            SELECT * FROM books 
-            WHERE (height IS NULL OR height = 0) 
-            OR (width IS NULL OR width = 0) 
-            OR (weight IS NULL OR weight = 0)
-            ORDER BY author ASC, series_title ASC, series_number ASC, title ASC
-        ''').fetchall()
-        
-        conn.close()
-        return render_template('audit.html', missing_isbn=missing_isbn, missing_dims=missing_dims)
+
+        # Tab counts are kept by triggers (audit_totals)
+        totals = dict(conn.execute('SELECT mask, books FROM audit_totals').fetchall())
+        lists = [(name, label, totals.get(list_mask, 0)) for name, (list_mask, label) in AUDIT_LISTS.items()]
+
+        # One page of the list, seeking past the previous page's last row
+        conditions = [f"(q.missing & {mask}) != 0"]
+        params = []
+        cursor = request.args.get('cursor')
+        if cursor:
+            values = decode_cursor(cursor, 5)
+            if values is None:
+                abort(400)
+            conditions.append(f"({AUDIT_KEYS}) > (?, ?, ?, ?, ?)")
+            params.extend(values)
+        params.append(AUDIT_PAGE_SIZE + 1)
+        rows = conn.execute(f'''
+            SELECT books.*, {AUDIT_KEYS}
+            FROM audit_queue AS q
+            JOIN books ON books.id = q.book_id
+            WHERE {' AND '.join(conditions)}
+            ORDER BY {AUDIT_KEYS}
+            LIMIT ?
+        ''', params).fetchall()
+
+        next_cursor = None
+        if len(rows) > AUDIT_PAGE_SIZE:
+            last = rows[AUDIT_PAGE_SIZE - 1]
+            next_cursor = encode_cursor([last[i] for i in range(len(last) - 5, len(last))])
+
+        # Indexed by the background worker; a big backlog shows as in progress
+        duplicates.start_background()
+        pairs, pair_total = [], None
+        if not duplicates.rebuilding(conn):
+            pairs, pair_total = duplicates.possible_duplicates(conn)
+        return render_template('audit.html', books=rows[:AUDIT_PAGE_SIZE], lists=lists,
+                               current_list=list_name, next_cursor=next_cursor,
+                               enrichment=enrichment_status(conn),
+                               enrichment_problems=enrich.recent_problems(conn),
+                               duplicate_pairs=pairs, duplicate_total=pair_total)
+
+def enrichment_status(conn):
+    run = enrich.current_run()
+    status = {'running': False, 'outcomes': enrich.summary(conn)}
+    if run is not None:
+        status.update(running=run.finished_at is None, done=run.done, total=run.total,
+                      failed=run.counts.get(enrich.FAILED, 0), error=run.error)
+    return status
+
+if not IS_READ_ONLY:
+    @app.route('/audit/enrich', methods=('GET', 'POST'))
+    def audit_enrich():
+        """POST starts filling missing metadata from Open Library on a
+        background thread; GET reports its progress (the audit page polls)."""
+        if request.method == 'POST':
+            enrich.start_background()
+            return redirect(url_for('audit_page', list=audit_list_param()))
+        return jsonify(enrichment_status(get_db_connection()))
+
+def work_param(prefix):
+    title, author = request.form.get(f'{prefix}_title'), request.form.get(f'{prefix}_author')
+    if not title or not author:
+        abort(400)
+    return title, author
+
+if not IS_READ_ONLY:
+    @app.route('/audit/duplicates/merge', methods=('POST',))
+    def merge_duplicates():
+        """Gives every copy of the `drop` work the title/author of `keep`."""
+        conn = get_db_connection()
+        duplicates.merge(conn, work_param('keep'), work_param('drop'))
+        conn.commit()
+        return redirect(url_for('audit_page', list=audit_list_param(), _anchor='duplicates'))
+
+if not IS_READ_ONLY:
+    @app.route('/audit/duplicates/dismiss', methods=('POST',))
+    def dismiss_duplicates():
+        conn = get_db_connection()
+        duplicates.dismiss(conn, work_param('first'), work_param('second'))
+        conn.commit()
+        return redirect(url_for('audit_page', list=audit_list_param(), _anchor='duplicates'))
+
+if not IS_READ_ONLY:
+    @app.route('/api/duplicates')
+    def api_duplicates():
+        """Works the title/author being typed on the add/edit form may
+        duplicate (?book_id= leaves out that book's own work)."""
+        title = request.args.get('title', '').strip()
+        author = request.args.get('author', '').strip()
+        conn = get_db_connection()
+        exclude = None
+        book_id = request.args.get('book_id', type=int)
+        if book_id is not None:
+            row = conn.execute('SELECT title, author FROM books WHERE id = ?', (book_id,)).fetchone()
+            exclude = (row['title'], row['author']) if row else None
+        # Read-only: works written in the last moments may not be indexed yet
+        return jsonify({'matches': duplicates.matches(conn, title, author, exclude)})
+
+if not IS_READ_ONLY:
+    @app.route('/audit/next')
+    def audit_next():
+        """Edit form of the next book on an audit list after ?after=<book id>,
+        wrapping round to the top; back to the list once it is empty."""
+        list_name = audit_list_param()
+        mask = AUDIT_LISTS[list_name][0]
+        after = request.args.get('after', type=int)
+        conn = get_db_connection()
+
+        found = None
+        current = None
+        if after is not None:
+            # The book just edited may have left the queue; its sort key
+            # still says where it was
+            current = conn.execute('''
+                SELECT author, COALESCE(series_title, ''), COALESCE(series_number, -1), title, id
+                FROM books WHERE id = ?
+            ''', (after,)).fetchone()
+        if current is not None:
+            found = conn.execute(f'''
+                SELECT q.book_id FROM audit_queue AS q
+                WHERE (q.missing & {mask}) != 0 AND ({AUDIT_KEYS}) > (?, ?, ?, ?, ?)
+                ORDER BY {AUDIT_KEYS} LIMIT 1
+            ''', tuple(current)).fetchone()
+        if found is None:
+            found = conn.execute(f'''
+                SELECT q.book_id FROM audit_queue AS q
+                WHERE (q.missing & {mask}) != 0 AND q.book_id IS NOT ?
+                ORDER BY {AUDIT_KEYS} LIMIT 1
+            ''', (after,)).fetchone()
+
+        if found is None:
+            return redirect(url_for('audit_page', list=list_name))
+        return redirect(url_for('edit_book', book_id=found['book_id'], origin='audit', list=list_name))
+
+# Largest number of queued audit edits accepted in one request
+MAX_BATCH_SIZE = 500
+
+def clean_measurement(val):
+    # Empty -> NULL; raises ValueError on junk
+    return float(val) if val and val != "" else None
 
 if not IS_READ_ONLY:
     @app.route('/api/mark_no_isbn', methods=['POST'])
@@ -387,7 +926,6 @@ if not IS_READ_ONLY:
             conn = get_db_connection()
             conn.execute('UPDATE books SET no_isbn = 1 WHERE id = ?', (book_id,))
             conn.commit()
-            conn.close()
             return jsonify({'success': True})
         
         return jsonify({'success': False}), 400
@@ -399,22 +937,203 @@ if not IS_READ_ONLY:
         data = request.get_json()
         book_id = data.get('id')
         
-        # Helper to clean numbers
-        def clean(val):
-            return float(val) if val and val != "" else None
-
         if book_id:
             conn = get_db_connection()
             conn.execute('''
                 UPDATE books 
                 SET height = ?, width = ?, weight = ? 
                 WHERE id = ?
-            ''', (clean(data.get('height')), clean(data.get('width')), clean(data.get('weight')), book_id))
+            ''', (clean_measurement(data.get('height')), clean_measurement(data.get('width')), clean_measurement(data.get('weight')), book_id))
             conn.commit()
-            conn.close()
             return jsonify({'success': True})
         
         return jsonify({'success': False}), 400
 
+if not IS_READ_ONLY:
+    @app.route('/api/quick_update_batch', methods=['POST'])
+    def quick_update_batch():
+        """Queued audit edits: a list of {id, height, width, weight} and/or
+        {id, no_isbn: true} items, applied in one transaction.
+        Returns a result per item, in order."""
+        items = request.get_json(silent=True)
+        if not isinstance(items, list) or len(items) > MAX_BATCH_SIZE:
+            return jsonify({'success': False, 'error': f'Expected a list of up to {MAX_BATCH_SIZE} updates'}), 400
+
+        # 1. Validate everything before touching the database
+        results = []
+        updates = []
+        for item in items:
+            book_id = item.get('id') if isinstance(item, dict) else None
+            result = {'id': book_id, 'success': False}
+            results.append(result)
+            try:
+                book_id = int(book_id)
+                dims = None
+                if any(k in item for k in ('height', 'width', 'weight')):
+                    dims = tuple(clean_measurement(item.get(k)) for k in ('height', 'width', 'weight'))
+            except (TypeError, ValueError):
+                result['error'] = 'Invalid id or measurement'
+                continue
+            if dims is None and not item.get('no_isbn'):
+                result['error'] = 'Nothing to update'
+                continue
+            updates.append((result, book_id, dims, bool(item.get('no_isbn'))))
+
+        # 2. Apply the valid ones atomically: one transaction, one commit
+        conn = get_db_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for result, book_id, dims, no_isbn in updates:
+                found = True
+                if dims is not None:
+                    cur = conn.execute('UPDATE books SET height = ?, width = ?, weight = ? WHERE id = ?', (*dims, book_id))
+                    found = cur.rowcount > 0
+                if no_isbn and found:
+                    cur = conn.execute('UPDATE books SET no_isbn = 1 WHERE id = ?', (book_id,))
+                    found = cur.rowcount > 0
+                if found:
+                    result['success'] = True
+                else:
+                    result['error'] = 'Book not found'
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            app.logger.warning("Batch update failed: %s", e)
+            for result, *_ in updates:
+                result['success'] = False
+                result['error'] = 'Database is busy. Try again.'
+            return jsonify({'success': False, 'results': results}), 503
+
+        return jsonify({'success': all(r['success'] for r in results), 'results': results})
+
+if not IS_READ_ONLY:
+    @app.route('/import', methods=('GET', 'POST'))
+    def import_books():
+        """Bulk import from an uploaded CSV or a pasted list of ISBNs"""
+        conn = get_db_connection()
+
+        if request.method == 'POST':
+            upload = request.files.get('file')
+            if upload and upload.filename:
+                text = upload.read().decode('utf-8-sig', errors='replace')
+                source = upload.filename
+            else:
+                text = request.form.get('isbns', '')
+                source = 'Pasted list'
+
+            if not text.strip():
+                return redirect(url_for('import_books'))
+
+            defaults = {
+                'binding': request.form.get('binding'),
+                'read_status': request.form.get('read_status'),
+            }
+            job_id = bulk_import.create_job(conn, source, text, defaults)
+            # Lookups run on a background thread; the job page polls for progress
+            bulk_import.start_background(job_id)
+            return redirect(url_for('import_status', job_id=job_id))
+
+        jobs = conn.execute('SELECT * FROM import_jobs ORDER BY id DESC LIMIT 20').fetchall()
+        return render_template('import.html', jobs=jobs)
+
+if not IS_READ_ONLY:
+    @app.route('/import/<int:job_id>')
+    def import_status(job_id):
+        conn = get_db_connection()
+        job = conn.execute('SELECT * FROM import_jobs WHERE id = ?', (job_id,)).fetchone()
+        if job is None:
+            abort(404)
+
+        report = []
+        for row in bulk_import.job_report(conn, job_id):
+            entry = dict(row)
+            fields = json.loads(row['fields'] or '{}')
+            metadata = json.loads(row['metadata'] or '{}')
+            entry['title'] = fields.get('title') or metadata.get('title') or ''
+            entry['author'] = fields.get('author') or metadata.get('author') or ''
+            report.append(entry)
+
+        return render_template('import.html', job=job, report=report,
+                               summary=bulk_import.job_summary(conn, job_id),
+                               running=bulk_import.is_running(job_id))
+
+if not IS_READ_ONLY:
+    @app.route('/import/<int:job_id>/resume', methods=('POST',))
+    def resume_import(job_id):
+        bulk_import.start_background(job_id)
+        return redirect(url_for('import_status', job_id=job_id))
+
+if not IS_READ_ONLY:
+    @app.route('/export.<fmt>')
+    def export_books(fmt):
+        """Streams the library (optionally narrowed by facets) as a download"""
+        if fmt not in export.FORMATS:
+            abort(404)
+        filter_param = request.args.get('filter', 'all')
+        selected = facets.parse(request.args)
+        compress = 'gzip' in request.accept_encodings
+
+        # The request (and its pooled connection) stays open until the
+        # last chunk is sent
+        conn = get_db_connection()
+        body = stream_with_context(export.stream(conn, fmt, selected, compress))
+
+        response = Response(body, mimetype=export.FORMATS[fmt])
+        suffix = ""
+        if filter_param in facets.LEGACY_FILTERS:
+            suffix = f"-{filter_param}"
+        elif selected:
+            suffix = "-filtered"
+        filename = f"caliper-{time.strftime('%Y-%m-%d')}{suffix}.{fmt}"
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        response.headers['Vary'] = 'Accept-Encoding'
+        if compress:
+            response.headers['Content-Encoding'] = 'gzip'
+        return response
+
+# --- STARTUP ---
+
+def warm_templates():
+    """Compiles every template now rather than on its first request.
+    serve.py calls this before forking, so workers share the result."""
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+def start_worker():
+    """Per-process startup: pooled connections, warm caches and background
+    work. serve.py runs it in each worker after forking (SQLite connections
+    and threads must not cross a fork); `python app.py` runs it directly."""
+    db_pool.fill(int(os.environ.get('WARM_CONNECTIONS', 4)))
+    if USE_SNAPSHOT:
+        db_pool.start_watcher()
+    if pages is not None:
+        pages.version()
+    conn = db_pool.acquire()
+    try:
+        facet_counts.get(conn, {})
+        collection_stats.get(conn)
+        shelf_planner.get(conn)
+        series_index.all(conn)
+    finally:
+        db_pool.release(conn)
+
+    # Download any covers that are not cached locally yet (in the background)
+    if not IS_READ_ONLY and os.environ.get('COVER_BACKFILL', '1') == '1':
+        covers.start_backfill()
+
+    # Index works added or renamed while the app was down (all of them
+    # after the upgrade that added duplicate detection)
+    if not IS_READ_ONLY:
+        duplicates.start_background()
+
+    # Nightly snapshot, vacuum and ANALYZE (see housekeeping.py)
+    if not IS_READ_ONLY and os.environ.get('MAINTENANCE_AT'):
+        housekeeping.start_scheduler(os.environ['MAINTENANCE_AT'], lambda: time.monotonic() - last_request_at)
+
 if __name__ == '__main__':
+    # Development server; containers run serve.py. The debug reloader
+    # runs this file again in a child process that does the serving, so
+    # only that one starts the background work.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_worker()
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,344 @@
+import argparse
+import json
+import os
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import database
+import setup_example_db
+
+# Drives the Flask app in-process (test client) against a generated
+# library and reports per-route latency, SQL work and response size.
+# Results are written as JSON so two commits can be compared:
+#
+#   python benchmark.py --size 100k
+#   python benchmark.py --size 100k --compare benchmarks/<old>.json
+
+RESULTS_DIR = os.path.join(database.BASE_DIR, 'benchmarks')
+
+# Per route: stop after this many timed requests or this many seconds,
+# whichever comes first (but always take at least MIN_SAMPLES)
+DEFAULT_REQUESTS = 200
+DEFAULT_SECONDS = 20.0
+MIN_SAMPLES = 5
+WARMUP_REQUESTS = 3
+
+# The progress handler fires every this many SQLite VM instructions
+VM_STEP_GRANULARITY = 1000
+
+# A p50/p95 timing is flagged by --compare when it grew by more than this
+REGRESSION_RATIO = 1.2
+
+SEARCH_WORDS = setup_example_db.TITLE_WORDS + setup_example_db.LAST_NAMES
+
+# --- OPEN LIBRARY STUB ---
+
+class StubOpenLibrary(BaseHTTPRequestHandler):
+    """Answers /api/books like openlibrary.org does, from made-up data.
+    ISBNs ending in 0 are 'not found'."""
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        bibkey = query.get('bibkeys', [''])[0]
+        isbn = bibkey.split(':', 1)[-1]
+        payload = {}
+        if isbn and not isbn.endswith('0'):
+            payload[bibkey] = {
+                'title': f"Stub Book {isbn[-4:]}",
+                'authors': [{'name': "Stub Author"}],
+                'publish_date': "2001",
+                'number_of_pages': 321,
+                'publishers': [{'name': "Stub Press"}],
+                'cover': {'large': f"http://127.0.0.1/covers/{isbn}.jpg"},
+            }
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubOpenLibrary)
+    threading.Thread(target=server.serve_forever, name='openlibrary-stub', daemon=True).start()
+    return server
+
+# --- SQL INSTRUMENTATION ---
+
+class SqlStats:
+    """Counts statements and VM steps on every pooled connection."""
+
+    def __init__(self):
+        self.queries = 0
+        self.vm_steps = 0
+        self.statements = set()
+        self._instrumented = set()
+
+    def reset(self):
+        self.queries = 0
+        self.vm_steps = 0
+
+    def instrument(self, conn):
+        if id(conn) in self._instrumented:
+            return conn
+        self._instrumented.add(id(conn))
+        conn.set_trace_callback(self._on_statement)
+        conn.set_progress_handler(self._on_progress, VM_STEP_GRANULARITY)
+        return conn
+
+    def _on_statement(self, sql):
+        if re.match(r'\s*(SELECT|WITH|INSERT|UPDATE|DELETE)\b', sql, re.IGNORECASE):
+            self.queries += 1
+            if len(self.statements) < 200:
+                self.statements.add(sql)
+
+    def _on_progress(self):
+        self.vm_steps += VM_STEP_GRANULARITY
+        return 0
+
+def full_scans(conn, statements):
+    """Table scans that use no index, from EXPLAIN QUERY PLAN."""
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    scans = set()
+    for sql in statements:
+        try:
+            plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+        except Exception:
+            continue
+        for row in plan:
+            match = re.match(r'SCAN (\w+)', row[3])
+            if match and match.group(1) in tables and 'INDEX' not in row[3]:
+                scans.add(match.group(1))
+    return sorted(scans)
+
+# --- ROUTES ---
+
+def build_routes(conn, client):
+    """(name, make_request) pairs; make_request returns a test-client response."""
+    max_id = conn.execute("SELECT MAX(id) FROM books").fetchone()[0] or 1
+    rng = random.Random(1)
+    cursors = {'next': None}
+
+    def get(url):
+        return lambda: client.get(url)
+
+    def next_page():
+        # Walk the listing page by page, starting over at the end
+        response = client.get('/api/books', query_string={'cursor': cursors['next']} if cursors['next'] else None)
+        cursors['next'] = (response.get_json() or {}).get('next_cursor')
+        return response
+
+    def search():
+        return client.get('/api/search', query_string={'q': rng.choice(SEARCH_WORDS)[:rng.randint(3, 6)]})
+
+    def detail():
+        return client.get(f'/book/{rng.randint(1, max_id)}')
+
+    def lookup():
+        # A small ISBN pool, so most lookups after the first few are cache hits
+        return client.post('/api/lookup', json={'isbn': f"978000000{rng.randint(0, 19):04d}"})
+
+    return [
+        ('index', get('/')),
+        ('index_sort_title', get('/?sort=title')),
+        ('index_sort_year_desc', get('/?sort=year_desc')),
+        ('index_filter_read', get('/?filter=read')),
+        ('index_filter_signed', get('/?filter=signed')),
+        ('index_facets', get('/?binding=Hardcover&status=To+Read&decade=1960')),
+        ('api_books_pages', next_page),
+        ('api_search', search),
+        ('book_detail', detail),
+        ('audit', get('/audit')),
+        ('api_lookup', lookup),
+    ]
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def run_route(make_request, stats, requests, seconds):
+    for _ in range(WARMUP_REQUESTS):
+        make_request()
+
+    timings = []
+    sizes = []
+    queries = []
+    vm_steps = []
+    statuses = set()
+    started = time.perf_counter()
+    while len(timings) < requests:
+        if len(timings) >= MIN_SAMPLES and time.perf_counter() - started > seconds:
+            break
+        stats.reset()
+        t0 = time.perf_counter()
+        response = make_request()
+        body = response.get_data()
+        timings.append((time.perf_counter() - t0) * 1000)
+        sizes.append(len(body))
+        queries.append(stats.queries)
+        vm_steps.append(stats.vm_steps)
+        statuses.add(response.status_code)
+
+    timings.sort()
+    return {
+        'samples': len(timings),
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p95_ms': round(percentile(timings, 95), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'mean_bytes': round(sum(sizes) / len(sizes)),
+        'queries': round(sum(queries) / len(queries), 2),
+        'vm_steps': round(sum(vm_steps) / len(vm_steps)),
+        'statuses': sorted(statuses),
+    }
+
+def copy_database(path, directory):
+    """Copies `path` into `directory` with the online backup API (a
+    consistent copy even while the app writes to it) and returns the copy.
+    The benchmark runs the admin app, which migrates its database and
+    writes to it, so it never gets the original."""
+    copy_path = os.path.join(directory, os.path.basename(path))
+    source = database.connect(read_only=True, path=path)
+    target = sqlite3.connect(copy_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+    return copy_path
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=database.BASE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def run(db_path, requests=DEFAULT_REQUESTS, seconds=DEFAULT_SECONDS, only=None):
+    # Must be set before app is imported (it opens the database on import)
+    database.DB_PATH = db_path
+    os.environ['COVER_BACKFILL'] = '0'
+    os.environ['APP_MODE'] = 'ADMIN'
+    import app
+    import covers
+    import openlibrary
+
+    # Lookups go to the local stub, with a throwaway cache
+    stub = start_stub()
+    openlibrary.API_URL = f"http://127.0.0.1:{stub.server_address[1]}/api/books"
+    cache_dir = tempfile.TemporaryDirectory()
+    openlibrary.cache = openlibrary.LookupCache(os.path.join(cache_dir.name, 'cache.db'))
+    # Covers are not part of the benchmark and must never hit the network
+    covers.fetcher.enqueue = lambda url: None
+
+    stats = SqlStats()
+    acquire = app.db_pool.acquire
+    app.db_pool.acquire = lambda: stats.instrument(acquire())
+
+    conn = database.connect(read_only=True, path=db_path)
+    client = app.app.test_client()
+    copies = conn.execute("SELECT COUNT(*) FROM books").fetchone()[0]
+
+    results = {}
+    try:
+        for name, make_request in build_routes(conn, client):
+            if only and not any(o in name for o in only):
+                continue
+            stats.statements = set()
+            print(f"  {name:<22}", end='', flush=True)
+            result = run_route(make_request, stats, requests, seconds)
+            result['full_scans'] = full_scans(conn, stats.statements)
+            results[name] = result
+            print(f"p50 {result['p50_ms']:>9.2f} ms   p95 {result['p95_ms']:>9.2f} ms   "
+                  f"p99 {result['p99_ms']:>9.2f} ms   {result['mean_bytes']:>9,} B   "
+                  f"{result['queries']:>5} q   {result['vm_steps']:>11,} steps"
+                  + (f"   SCAN {', '.join(result['full_scans'])}" if result['full_scans'] else ''))
+    finally:
+        conn.close()
+        stub.shutdown()
+        cache_dir.cleanup()
+
+    return {
+        'commit': git_commit(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'database': os.path.basename(db_path),
+        'copies': copies,
+        'python': sys.version.split()[0],
+        'routes': results,
+    }
+
+def compare(old, new):
+    """Prints per-route timing ratios. Returns the number of regressions."""
+    print(f"\nCompared with {old['commit']} ({old['copies']:,} copies):")
+    regressions = 0
+    for name, result in new['routes'].items():
+        before = old['routes'].get(name)
+        if not before:
+            continue
+        cells = []
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            ratio = result[key] / before[key] if before[key] else 1.0
+            marker = ''
+            # p99 of a few hundred samples is too noisy to fail on
+            if ratio > REGRESSION_RATIO and key != 'p99_ms':
+                marker = ' ⚠️'
+                regressions += 1
+            cells.append(f"{key[:3]} x{ratio:.2f}{marker}")
+        print(f"  {name:<22}" + "   ".join(cells))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the web routes against a (generated) library.")
+    parser.add_argument('--size', choices=sorted(setup_example_db.SIZES, key=setup_example_db.SIZES.get),
+                        help="Use data/bench-<size>.db, generating it first if needed")
+    parser.add_argument('--db', help="...or benchmark a copy of this database file (the file itself is never opened for writing)")
+    parser.add_argument('--requests', type=int, default=DEFAULT_REQUESTS, help="Timed requests per route")
+    parser.add_argument('--seconds', type=float, default=DEFAULT_SECONDS, help="Time budget per route")
+    parser.add_argument('--only', nargs='*', help="Only routes whose name contains one of these")
+    parser.add_argument('--output', help="Where to write the JSON results (default: benchmarks/<commit>-<copies>.json)")
+    parser.add_argument('--compare', help="Earlier results file to compare against")
+    args = parser.parse_args(argv)
+
+    scratch = None
+    if args.db:
+        scratch = tempfile.TemporaryDirectory()
+        print(f"Copying {args.db}")
+        db_path = copy_database(args.db, scratch.name)
+    else:
+        size = args.size or '10k'
+        db_path = os.path.join(database.BASE_DIR, 'data', f'bench-{size}.db')
+        if not os.path.exists(db_path):
+            setup_example_db.create_example_database(db_path, setup_example_db.SIZES[size])
+
+    print(f"Benchmarking {db_path}")
+    try:
+        results = run(db_path, args.requests, args.seconds, args.only)
+    finally:
+        if scratch:
+            scratch.cleanup()
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{results['commit']}-{results['copies']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            return 1 if compare(json.load(f), results) else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
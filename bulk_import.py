@@ -0,0 +1,363 @@
+import argparse
+import csv
+import io
+import json
+import os
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import database
+import migrations
+import openlibrary
+from maintenance import FIELDS
+
+# Parallel Open Library requests. Kept small to stay polite to the API.
+DEFAULT_WORKERS = 6
+
+# Fetch results are committed in batches of this size, which is also the
+# most work an interruption can lose.
+PROGRESS_BATCH = 20
+
+# Columns a CSV may provide: everything maintenance.py can edit, plus the
+# status flags from the add form.
+COLUMN_TYPES = {col_name: data_type for col_name, _, data_type in FIELDS}
+COLUMN_TYPES['read_status'] = str
+COLUMN_TYPES['is_signed'] = int
+
+# Row statuses
+# pending   -> not fetched yet
+# fetched   -> ready to insert (metadata found, or the CSV had title/author)
+# failed    -> Open Library error; retried on resume
+# not_found -> no record and no title/author to fall back on
+# invalid   -> not an ISBN
+# imported  -> inserted as book_id
+RETRY_STATUSES = ('pending', 'failed')
+
+INSERT_COLUMNS = [
+    'title', 'author', 'isbn', 'publisher', 'binding', 'read_status', 'is_signed',
+    'page_count', 'published_year', 'series_title', 'series_number',
+    'height', 'width', 'weight', 'notes', 'cover_url',
+]
+
+def normalize_isbn(raw):
+    # Digits only, except the 'X' check digit of an ISBN-10
+    isbn = re.sub(r'[^0-9Xx]', '', raw or '').upper()
+    if len(isbn) == 13 and isbn.isdigit():
+        return isbn
+    if len(isbn) == 10 and isbn[:9].isdigit() and (isbn[9].isdigit() or isbn[9] == 'X'):
+        return isbn
+    return None
+
+def convert(col_name, value):
+    value = (value or '').strip()
+    if value == '':
+        return None
+    data_type = COLUMN_TYPES[col_name]
+    if data_type == int:
+        return int(float(value))
+    if data_type == float:
+        return float(value)
+    return value
+
+def parse_input(text):
+    """Yields (raw_isbn, fields, error) for each book in a CSV with a header
+    row, or in a plain list of scanned ISBNs (one or more per line)."""
+    first_line = text.lstrip().split('\n', 1)[0]
+    header = [h.strip().lower() for h in first_line.split(',')]
+
+    if any(h in COLUMN_TYPES for h in header):
+        # CSV with a header row. Unknown columns are ignored.
+        reader = csv.DictReader(io.StringIO(text.lstrip()))
+        headers = {h: h.strip().lower() for h in (reader.fieldnames or [])}
+        for record in reader:
+            fields = {}
+            error = None
+            for column, value in record.items():
+                col_name = headers.get(column)
+                if col_name not in COLUMN_TYPES:
+                    continue
+                try:
+                    converted = convert(col_name, value)
+                except ValueError:
+                    error = f"{col_name}: '{value}' is not a {COLUMN_TYPES[col_name].__name__}"
+                    continue
+                if converted is not None:
+                    fields[col_name] = converted
+            raw_isbn = fields.pop('isbn', None)
+            if raw_isbn is None and not fields:
+                continue
+            yield raw_isbn, fields, error
+        return
+
+    # Plain list, e.g. straight from a barcode scanner
+    for line in text.splitlines():
+        line = line.split('#', 1)[0]
+        for token in re.split(r'[\s,;]+', line.strip()):
+            if token:
+                yield token, {}, None
+
+# --- JOBS ---
+
+def create_job(conn, source, text, defaults=None):
+    """Records every input row as pending and returns the new job id.
+    `defaults` (e.g. binding) fill columns the input leaves empty."""
+    defaults = {k: v for k, v in (defaults or {}).items() if v not in (None, '')}
+    cur = conn.cursor()
+    cur.execute('INSERT INTO import_jobs (source) VALUES (?)', (source,))
+    job_id = cur.lastrowid
+
+    rows = []
+    for raw_isbn, fields, error in parse_input(text):
+        isbn = normalize_isbn(raw_isbn) if raw_isbn else None
+        status, message = 'pending', None
+        if error:
+            status, message = 'invalid', error
+        elif raw_isbn and not isbn:
+            status, message = 'invalid', f"'{raw_isbn}' is not an ISBN"
+        elif not isbn:
+            # No ISBN at all: only importable if the CSV names the book
+            if fields.get('title') and fields.get('author'):
+                status = 'fetched'
+            else:
+                status, message = 'invalid', 'Needs an ISBN or a title and author'
+        merged = dict(defaults)
+        merged.update(fields)
+        # Rows are numbered by their position in the input
+        rows.append((job_id, len(rows) + 1, isbn or raw_isbn, json.dumps(merged), status, message))
+
+    cur.executemany('''
+        INSERT INTO import_rows (job_id, row_no, isbn, fields, status, message)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', rows)
+    conn.commit()
+    return job_id
+
+def fetch_pending(conn, job_id, workers=DEFAULT_WORKERS, progress=None):
+    """Looks up every row that still needs metadata, `workers` at a time.
+    Only this thread writes to the database; results are committed every
+    PROGRESS_BATCH rows so an interrupted job picks up where it left off."""
+    placeholders = ', '.join('?' * len(RETRY_STATUSES))
+    todo = conn.execute(f'''
+        SELECT row_no, isbn, fields FROM import_rows
+        WHERE job_id = ? AND status IN ({placeholders})
+        ORDER BY row_no
+    ''', (job_id, *RETRY_STATUSES)).fetchall()
+
+    done = 0
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {pool.submit(openlibrary.lookup, row['isbn']): row for row in todo}
+        for future in as_completed(futures):
+            row = futures[future]
+            fields = json.loads(row['fields'])
+            try:
+                book = future.result()
+            except openlibrary.LookupFailed as e:
+                status, metadata, message = 'failed', None, str(e)
+            else:
+                if book is not None:
+                    status, metadata, message = 'fetched', json.dumps(book), None
+                elif fields.get('title') and fields.get('author'):
+                    status, metadata, message = 'fetched', None, 'Not on Open Library; used CSV data'
+                else:
+                    status, metadata, message = 'not_found', None, 'Not found on Open Library'
+
+            conn.execute('''
+                UPDATE import_rows SET status = ?, metadata = ?, message = ?
+                WHERE job_id = ? AND row_no = ?
+            ''', (status, metadata, message, job_id, row['row_no']))
+
+            done += 1
+            if done % PROGRESS_BATCH == 0:
+                conn.commit()
+            if progress:
+                progress(done, len(todo), row['isbn'], status)
+    finally:
+        # On Ctrl-C: drop lookups that haven't started, keep the ones done
+        pool.shutdown(wait=False, cancel_futures=True)
+        conn.commit()
+    return done
+
+def build_book(isbn, fields, metadata):
+    # Open Library fills the gaps; anything in the CSV (or defaults) wins
+    book = dict.fromkeys(INSERT_COLUMNS)
+    book['is_signed'] = 0
+    if metadata:
+        for col_name, value in metadata.items():
+            if col_name in book and value not in (None, ''):
+                book[col_name] = value
+    book.update({k: v for k, v in fields.items() if k in book})
+    if isbn:
+        book['isbn'] = isbn
+    return book
+
+def insert_fetched(conn, job_id):
+    """Inserts all fetched rows with one executemany in one transaction and
+    marks them imported. Returns the number of books added."""
+    rows = conn.execute('''
+        SELECT row_no, isbn, fields, metadata FROM import_rows
+        WHERE job_id = ? AND status = 'fetched'
+        ORDER BY row_no
+    ''', (job_id,)).fetchall()
+
+    books = []
+    for row in rows:
+        metadata = json.loads(row['metadata']) if row['metadata'] else None
+        books.append(build_book(row['isbn'], json.loads(row['fields']), metadata))
+    if not books:
+        return 0
+
+    columns = ', '.join(INSERT_COLUMNS)
+    values = ', '.join(f':{c}' for c in INSERT_COLUMNS)
+    try:
+        # IMMEDIATE holds the write lock, so the AUTOINCREMENT ids handed
+        # out by the executemany are consecutive and can be read back below.
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany(f'INSERT INTO books ({columns}) VALUES ({values})', books)
+        last_id = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'books'").fetchone()[0]
+        first_id = last_id - len(books) + 1
+        conn.executemany('''
+            UPDATE import_rows SET status = 'imported', book_id = ?
+            WHERE job_id = ? AND row_no = ?
+        ''', [(first_id + i, job_id, row['row_no']) for i, row in enumerate(rows)])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(books)
+
+def run_job(conn, job_id, workers=DEFAULT_WORKERS, progress=None):
+    """Fetch, insert and stamp the job finished. Safe to call again on an
+    interrupted job."""
+    fetch_pending(conn, job_id, workers, progress)
+    added = insert_fetched(conn, job_id)
+    conn.execute('''
+        UPDATE import_jobs SET finished_at = CURRENT_TIMESTAMP WHERE id = ?
+    ''', (job_id,))
+    conn.commit()
+    return added
+
+def job_summary(conn, job_id):
+    counts = conn.execute('''
+        SELECT status, COUNT(*) AS n FROM import_rows WHERE job_id = ? GROUP BY status
+    ''', (job_id,)).fetchall()
+    return {row['status']: row['n'] for row in counts}
+
+def job_report(conn, job_id):
+    return conn.execute('''
+        SELECT row_no, isbn, status, message, book_id, fields, metadata
+        FROM import_rows WHERE job_id = ? ORDER BY row_no
+    ''', (job_id,)).fetchall()
+
+# --- BACKGROUND RUNS (web upload) ---
+
+_running = set()
+_running_lock = threading.Lock()
+
+def is_running(job_id):
+    with _running_lock:
+        return job_id in _running
+
+def start_background(job_id, workers=DEFAULT_WORKERS):
+    """Runs a job on a daemon thread with its own connection. Returns False
+    if this process is already running it."""
+    with _running_lock:
+        if job_id in _running:
+            return False
+        _running.add(job_id)
+
+    def work():
+        conn = database.connect()
+        try:
+            run_job(conn, job_id, workers)
+        finally:
+            conn.close()
+            with _running_lock:
+                _running.discard(job_id)
+
+    threading.Thread(target=work, name=f'import-{job_id}', daemon=True).start()
+    return True
+
+# --- CLI ---
+
+def print_report(conn, job_id):
+    print("-" * 60)
+    for row in job_report(conn, job_id):
+        if row['status'] == 'imported':
+            detail = f"book #{row['book_id']}"
+        else:
+            detail = row['message'] or ''
+        print(f"[{row['row_no']:>4}] {row['isbn'] or '-':<14} {row['status']:<10} {detail}")
+    print("-" * 60)
+    summary = job_summary(conn, job_id)
+    print("  ".join(f"{status}: {n}" for status, n in sorted(summary.items())))
+
+def write_report_csv(conn, job_id, path):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['row', 'isbn', 'status', 'message', 'book_id'])
+        for row in job_report(conn, job_id):
+            writer.writerow([row['row_no'], row['isbn'], row['status'], row['message'], row['book_id']])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import books from a CSV or a list of scanned ISBNs.")
+    parser.add_argument('file', nargs='?', help="CSV with a header row, or one ISBN per line ('-' for stdin)")
+    parser.add_argument('--resume', type=int, metavar='JOB_ID', help="Finish an interrupted import")
+    parser.add_argument('--list', action='store_true', help="Show previous import jobs")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="Parallel Open Library lookups")
+    parser.add_argument('--binding', help="Binding for rows that don't specify one")
+    parser.add_argument('--read-status', help="Read status for rows that don't specify one")
+    parser.add_argument('--report', metavar='PATH', help="Also write the per-row report as CSV")
+    args = parser.parse_args(argv)
+
+    conn = database.connect()
+    migrations.migrate(conn)
+
+    if args.list:
+        for job in conn.execute('SELECT * FROM import_jobs ORDER BY id DESC').fetchall():
+            summary = job_summary(conn, job['id'])
+            state = 'finished' if job['finished_at'] else 'unfinished'
+            print(f"#{job['id']}  {job['created_at']}  {job['source']}  ({state})  {summary}")
+        return 0
+
+    if args.resume:
+        job_id = args.resume
+        if conn.execute('SELECT 1 FROM import_jobs WHERE id = ?', (job_id,)).fetchone() is None:
+            print(f"❌ Import job {job_id} not found.")
+            return 1
+        print(f"Resuming import job #{job_id}...")
+    elif args.file:
+        if args.file == '-':
+            text, source = sys.stdin.read(), 'stdin'
+        else:
+            with open(args.file, encoding='utf-8-sig') as f:
+                text = f.read()
+            source = os.path.basename(args.file)
+        defaults = {'binding': args.binding, 'read_status': args.read_status}
+        job_id = create_job(conn, source, text, defaults)
+        print(f"Created import job #{job_id} (resume with --resume {job_id} if interrupted).")
+    else:
+        parser.print_help()
+        return 1
+
+    def progress(done, total, isbn, status):
+        print(f"  {done}/{total}  {isbn}  {status}")
+
+    try:
+        added = run_job(conn, job_id, args.workers, progress)
+    except KeyboardInterrupt:
+        print(f"\n⚠️  Interrupted. Run again with --resume {job_id} to continue.")
+        return 130
+
+    print_report(conn, job_id)
+    if args.report:
+        write_report_csv(conn, job_id, args.report)
+        print(f"Report written to {args.report}")
+    print(f"✅ Added {added} books.")
+    conn.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
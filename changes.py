@@ -0,0 +1,105 @@
+import json
+
+# Delta sync for offline clients (index.html keeps a copy of the library
+# in IndexedDB). A client sends the version it last saw and gets back the
+# current state of every book written since, plus the ids that were
+# deleted. Version 0, an unknown version or one below the floor (see
+# compact()) means "send everything".
+#
+# The version is book_changes' AUTOINCREMENT high-water mark, so it only
+# ever grows, even when compact() deletes rows.
+
+# What a client needs to list, filter and search books offline
+SYNC_COLUMNS = [
+    'id', 'title', 'author', 'series_title', 'series_number', 'published_year',
+    'binding', 'read_status', 'is_signed', 'isbn', 'publisher', 'notes',
+]
+
+# Rows per fetchmany() / yielded chunk
+CHUNK_ROWS = 500
+
+# compact() keeps the log entries of this many deleted books; clients
+# that last synced before an older delete get everything again
+KEEP_DELETED = 10000
+
+def current_version(conn):
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'book_changes'").fetchone()
+    return row[0] if row else 0
+
+def floor(conn):
+    """Oldest version the log still answers for: deltas since an older
+    one may miss deletes."""
+    return conn.execute("SELECT version FROM book_changes_floor").fetchone()[0]
+
+def changed_books(conn, since, limit):
+    """Ids of the books written after version `since` (at most `limit`),
+    or None if the log can't tell and everything must be read again."""
+    if since < floor(conn) or since > current_version(conn):
+        return None
+    return [row[0] for row in conn.execute(
+        'SELECT DISTINCT book_id FROM book_changes WHERE version > ? LIMIT ?', (since, limit))]
+
+def compact(conn):
+    """Keeps only the latest entry per book (all a delta needs), and of
+    deleted books only the latest KEEP_DELETED, raising the floor past the
+    others. Returns the number of entries removed."""
+    with conn:
+        removed = conn.execute('''
+            DELETE FROM book_changes
+            WHERE version NOT IN (SELECT MAX(version) FROM book_changes GROUP BY book_id)
+        ''').rowcount
+        dropped = conn.execute('''
+            SELECT MAX(version) FROM (
+                SELECT version FROM book_changes
+                WHERE NOT EXISTS (SELECT 1 FROM books WHERE books.id = book_changes.book_id)
+                ORDER BY version DESC LIMIT -1 OFFSET ?
+            )
+        ''', (KEEP_DELETED,)).fetchone()[0]
+        if dropped is not None:
+            removed += conn.execute('''
+                DELETE FROM book_changes
+                WHERE version <= ? AND NOT EXISTS (SELECT 1 FROM books WHERE books.id = book_changes.book_id)
+            ''', (dropped,)).rowcount
+            conn.execute('UPDATE book_changes_floor SET version = MAX(version, ?)', (dropped,))
+    return removed
+
+def stream_changes(conn, since):
+    """Yields the JSON response for /api/changes in chunks:
+    {"version": v, "full": bool, "columns": [...], "deleted": [ids], "books": [[...], ...]}
+    Everything is read inside one transaction, so the version matches the rows."""
+    conn.execute('BEGIN')
+    try:
+        version = current_version(conn)
+        columns = ', '.join(SYNC_COLUMNS)
+        full = since <= 0 or since < floor(conn) or since > version
+        cursor = None
+        deleted = []
+        if full:
+            cursor = conn.execute(f"SELECT {columns} FROM books ORDER BY id")
+        elif since < version:
+            deleted = [row[0] for row in conn.execute('''
+                SELECT DISTINCT book_changes.book_id FROM book_changes
+                LEFT JOIN books ON books.id = book_changes.book_id
+                WHERE book_changes.version > ? AND books.id IS NULL
+            ''', (since,))]
+            cursor = conn.execute(f'''
+                SELECT {columns} FROM books
+                WHERE id IN (SELECT book_id FROM book_changes WHERE version > ?)
+                ORDER BY id
+            ''', (since,))
+
+        head = json.dumps({'version': version, 'full': full, 'columns': SYNC_COLUMNS, 'deleted': deleted})
+        yield (head[:-1] + ', "books": [').encode('utf-8')
+        separator = '\n'
+        while cursor is not None:
+            rows = cursor.fetchmany(CHUNK_ROWS)
+            if not rows:
+                break
+            parts = []
+            for row in rows:
+                parts.append(separator + json.dumps(list(row), ensure_ascii=False))
+                separator = ',\n'
+            yield ''.join(parts).encode('utf-8')
+        yield b'\n]}\n'
+    finally:
+        conn.rollback()
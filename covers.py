@@ -0,0 +1,218 @@
+import argparse
+import hashlib
+import io
+import logging
+import os
+import queue
+import sys
+import threading
+
+import requests # pyright: ignore[reportMissingModuleSource]
+from PIL import Image # pyright: ignore[reportMissingImports]
+
+import database
+import metrics
+import openlibrary
+
+log = logging.getLogger(__name__)
+
+# Local copies of every cover_url, so pages never wait on (or break with)
+# covers.openlibrary.org. Files are named after a hash of the source URL,
+# which makes each one immutable: a new cover means a new URL, a new file.
+COVER_DIR = os.path.join(database.BASE_DIR, 'data', 'covers')
+
+# Variant name -> max width in px. 'detail' is 2x the 200px cover on the
+# detail page; 'thumb' covers 1x screens and small previews.
+VARIANTS = {
+    'thumb': 160,
+    'detail': 400,
+}
+QUALITY = 80
+
+# Bump when VARIANTS/QUALITY change so browsers don't keep stale images
+# that were served as immutable.
+FORMAT_VERSION = 1
+
+# Open Library answers a missing cover with a 1x1 placeholder
+MIN_SOURCE_WIDTH = 10
+
+# Original images larger than this are refused
+MAX_DOWNLOAD_BYTES = 10 * 1024 * 1024
+
+class CoverFailed(Exception):
+    """The cover could not be downloaded or decoded."""
+
+def cover_key(url):
+    digest = hashlib.sha1(f"{FORMAT_VERSION}:{url}".encode('utf-8')).hexdigest()
+    return digest[:20]
+
+def variant_path(key, variant):
+    # Sharded by the first two characters to keep directories small
+    return os.path.join(COVER_DIR, key[:2], f"{key}-{variant}.webp")
+
+def is_cached(url):
+    key = cover_key(url)
+    return all(os.path.exists(variant_path(key, v)) for v in VARIANTS)
+
+def download(url):
+    """Fetches one cover and writes all its variants. Raises CoverFailed."""
+    try:
+        with metrics.upstream_timer('covers'), \
+                openlibrary.SESSION.get(url, timeout=openlibrary.TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            # Appended in place: `bytes +=` would copy the whole image per chunk
+            data = bytearray()
+            for chunk in response.iter_content(64 * 1024):
+                data += chunk
+                if len(data) > MAX_DOWNLOAD_BYTES:
+                    raise CoverFailed("Image too large")
+    except requests.RequestException as e:
+        raise CoverFailed(str(e)) from e
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except (OSError, Image.DecompressionBombError) as e:
+        raise CoverFailed(f"Not an image: {e}") from e
+    if image.width < MIN_SOURCE_WIDTH:
+        raise CoverFailed("No cover available (placeholder image)")
+
+    image = image.convert('RGB')
+    key = cover_key(url)
+    os.makedirs(os.path.dirname(variant_path(key, 'detail')), exist_ok=True)
+
+    for variant, max_width in VARIANTS.items():
+        resized = image.copy()
+        # Never upscale; keep the aspect ratio
+        resized.thumbnail((max_width, max_width * 3), Image.LANCZOS)
+        path = variant_path(key, variant)
+        # Write then rename, so a half-written file is never served
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        resized.save(tmp_path, 'WEBP', quality=QUALITY, method=6)
+        os.replace(tmp_path, path)
+
+class CoverFetcher:
+    """One background thread that downloads queued cover URLs, so web
+    requests only ever enqueue. Each URL is attempted once per process."""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._seen = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def enqueue(self, url):
+        if not url:
+            return
+        with self._lock:
+            if url in self._seen:
+                return
+            self._seen.add(url)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='cover-fetcher', daemon=True)
+                self._thread.start()
+        self._queue.put(url)
+
+    def _run(self):
+        while True:
+            url = self._queue.get()
+            if is_cached(url):
+                continue
+            try:
+                download(url)
+            except CoverFailed as e:
+                log.warning("Could not cache cover %s: %s", url, e)
+            except Exception:
+                log.exception("Unexpected error caching cover %s", url)
+
+fetcher = CoverFetcher()
+
+def local_cover(url, fetch=True):
+    """Returns the cover key if the image is cached locally. Otherwise
+    queues the download (if `fetch`) and returns None (callers hot-link
+    this once)."""
+    if not url:
+        return None
+    if is_cached(url):
+        return cover_key(url)
+    if fetch:
+        fetcher.enqueue(url)
+    return None
+
+def cached_keys():
+    """Keys of every cover with all its variants in COVER_DIR, from one
+    directory listing per shard."""
+    found = {}
+    try:
+        shards = [entry.path for entry in os.scandir(COVER_DIR) if entry.is_dir()]
+    except FileNotFoundError:
+        return set()
+    for shard in shards:
+        for entry in os.scandir(shard):
+            key, _, variant = entry.name.partition('-')
+            if variant.endswith('.webp') and variant[:-5] in VARIANTS:
+                found[key] = found.get(key, 0) + 1
+    return {key for key, count in found.items() if count == len(VARIANTS)}
+
+class CoverMap:
+    """Source URL -> key of the covers cached locally, for PUBLIC mode:
+    built when a books.db snapshot is loaded (snapshot.SnapshotPool
+    on_load), so requests neither stat files nor queue downloads. Covers
+    the admin side caches later show up with the next snapshot."""
+
+    def __init__(self):
+        self._keys = {}
+
+    def load(self, conn):
+        cached = cached_keys()
+        keys = {}
+        for row in conn.execute("SELECT DISTINCT cover_url FROM books WHERE cover_url > ''"):
+            key = cover_key(row[0])
+            if key in cached:
+                keys[row[0]] = key
+        self._keys = keys
+
+    def get(self, url):
+        return self._keys.get(url) if url else None
+
+def missing_cover_urls(conn):
+    rows = conn.execute('''
+        SELECT DISTINCT cover_url FROM books
+        WHERE cover_url IS NOT NULL AND cover_url != ''
+    ''').fetchall()
+    return [row[0] for row in rows if not is_cached(row[0])]
+
+def start_backfill():
+    """Queues every cover in the library that is not cached yet."""
+    def work():
+        conn = database.connect(read_only=True)
+        try:
+            for url in missing_cover_urls(conn):
+                fetcher.enqueue(url)
+        finally:
+            conn.close()
+
+    threading.Thread(target=work, name='cover-backfill', daemon=True).start()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Download and resize every book cover into data/covers.")
+    parser.parse_args(argv)
+
+    conn = database.connect(read_only=True)
+    urls = missing_cover_urls(conn)
+    conn.close()
+
+    print(f"{len(urls)} covers to fetch.")
+    failed = 0
+    for i, url in enumerate(urls, start=1):
+        try:
+            download(url)
+            print(f"  {i}/{len(urls)}  ✅ {url}")
+        except CoverFailed as e:
+            failed += 1
+            print(f"  {i}/{len(urls)}  ❌ {url} ({e})")
+    print(f"Done. {len(urls) - failed} cached, {failed} failed.")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
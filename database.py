@@ -0,0 +1,91 @@
+import os
+import sqlite3
+import threading
+from urllib.parse import quote
+
+# 1. Determine where this file (database.py) is located
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# 2. Look for the 'data' folder inside that directory
+# (CALIPER_DB points the app at another file, e.g. a benchmark library)
+DB_PATH = os.environ.get('CALIPER_DB') or os.path.join(BASE_DIR, 'data', 'books.db')
+
+# Seconds to wait for a lock held by the other container before giving up
+BUSY_TIMEOUT = 5.0
+
+# Applied to every connection. WAL itself is a property of the database
+# file, so it is switched on from the writable side in connect().
+PRAGMAS = [
+    # Safe in WAL mode: only the last commits can be lost on power failure,
+    # never the database. Saves an fsync per transaction.
+    'PRAGMA synchronous = NORMAL',
+    # Negative = KiB, so roughly 16 MB of page cache per connection
+    'PRAGMA cache_size = -16000',
+    # Read pages straight from the OS page cache
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA temp_store = MEMORY',
+]
+
+def connect(read_only=False, check_same_thread=True, path=None):
+    """Opens a tuned connection to books.db.
+    read_only connections go through a mode=ro URI, so even a bug in a
+    route cannot write to the file."""
+    path = path or DB_PATH
+    if read_only:
+        uri = f"file:{quote(os.path.abspath(path))}?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, timeout=BUSY_TIMEOUT, check_same_thread=check_same_thread)
+    else:
+        conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=check_same_thread)
+        # Readers never wait for a writer (and vice versa) in WAL mode
+        conn.execute('PRAGMA journal_mode = WAL')
+
+    conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+class ConnectionPool:
+    """Keeps up to `size` idle connections for reuse across requests.
+    acquire() never blocks: if nothing is idle a new connection is opened."""
+
+    def __init__(self, read_only=False, size=8, path=None):
+        self.read_only = read_only
+        self.size = size
+        self.path = path
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        # Connections are handed between worker threads, one at a time
+        return connect(self.read_only, check_same_thread=False, path=self.path)
+
+    def release(self, conn):
+        # Never hand the next request a half-finished transaction
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def fill(self, count=None):
+        """Opens idle connections up front (at most `size`) so the first
+        requests don't pay for connecting and parsing the schema."""
+        count = min(self.size if count is None else count, self.size)
+        opened = []
+        for _ in range(count):
+            conn = connect(self.read_only, check_same_thread=False, path=self.path)
+            # The first statement loads the schema (tables, triggers, indexes)
+            conn.execute('SELECT 1 FROM books LIMIT 0').fetchall()
+            opened.append(conn)
+        for conn in opened:
+            self.release(conn)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
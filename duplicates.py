@@ -0,0 +1,380 @@
+import json
+import logging
+import re
+import threading
+import unicodedata
+from collections import Counter
+
+import database
+
+log = logging.getLogger(__name__)
+
+# Possible duplicate works: one book entered under two spellings ("Hobbit,
+# The" / "The Hobbit", "Tolkien, J.R.R." / "Tolkien, J. R. R."), which the
+# works table (one row per exact title/author) lists twice.
+#
+# The listing keeps grouping on the exact title/author on purpose. A key
+# match is a guess, and the spelling shown is the one typed in. Two
+# spellings become one work when merge() renames the copies; only the
+# detail page's sibling copies look across spellings by key.
+#
+# Every title/author pair gets a normalized work key and the trigrams of
+# its title (migration 10). Triggers queue the pairs that change; sync()
+# indexes them and records each one's possible duplicates: works with the
+# same key, and works found through the rare trigrams they share, so no
+# search ever compares every work with every other. Only the background
+# worker (start_background()) syncs; readers use the index as it is.
+
+ARTICLES = ('the', 'a', 'an')
+
+# Trigrams found in more works than this say little about a match and
+# are left out of candidate searches
+MAX_POSTINGS = 100
+
+# A candidate must share this many rare trigrams
+MIN_SHARED = 2
+
+# How alike two works must be: trigram similarity of the titles, and of
+# the authors
+TITLE_SIMILARITY = 0.75
+AUTHOR_SIMILARITY = 0.5
+
+# Queued title/author pairs indexed per transaction. A backlog bigger
+# than REBUILD_AT (the first run, a bulk import) is paired in one pass at
+# the end instead of one lookup per work; the duplicate_rebuild row keeps
+# that pass due across restarts.
+SYNC_BATCH = 2000
+REBUILD_AT = 5000
+
+# Possible duplicates listed on the audit page
+SHOWN = 50
+
+# --- KEYS ---
+
+def _words(text):
+    text = (text or '').casefold().replace('&', ' and ')
+    if not text.isascii():
+        # Drop accents: 'Brontë' -> 'bronte'
+        text = ''.join(ch for ch in unicodedata.normalize('NFKD', text) if not unicodedata.combining(ch))
+    return re.findall(r'[^\W_]+', text)
+
+def title_key(title):
+    """'Hobbit, The' and 'The Hobbit' -> 'hobbit'."""
+    words = _words(title)
+    if len(words) > 1 and words[-1] in ARTICLES and re.search(r',\s*[^\W\d_]+\W*$', title or ''):
+        words.pop()
+    if len(words) > 1 and words[0] in ARTICLES:
+        words.pop(0)
+    return ' '.join(words)
+
+def author_key(author):
+    """'Tolkien, J. R. R.' and 'J.R.R. Tolkien' -> 'jrr tolkien': initials
+    run together and name order doesn't matter."""
+    names = []
+    initials = ''
+    for word in _words(author):
+        if len(word) == 1:
+            initials += word
+            continue
+        if initials:
+            names.append(initials)
+            initials = ''
+        names.append(word)
+    if initials:
+        names.append(initials)
+    return ' '.join(sorted(names))
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _dice(a, b):
+    return 2 * len(a & b) / (len(a) + len(b)) if a or b else 1.0
+
+def similarity(first, second):
+    """How alike two (title_key, author_key) are, 0-1 (0 unless both the
+    titles and the authors pass their thresholds). Titles with different
+    numbers ("Book 2" / "Book 3") are never alike."""
+    if first == second:
+        return 1.0
+    if re.findall(r'\d+', first[0]) != re.findall(r'\d+', second[0]):
+        return 0.0
+    titles = _dice(trigrams(first[0]), trigrams(second[0]))
+    authors = _dice(trigrams(first[1]), trigrams(second[1]))
+    if titles < TITLE_SIMILARITY or authors < AUTHOR_SIMILARITY:
+        return 0.0
+    return round((2 * titles + authors) / 3, 3)
+
+def same_work(title, author):
+    """(SQL condition over books, params) matching every copy of the work,
+    under any spelling with the same work key."""
+    return ('''((title = ? AND author = ?) OR (title, author) IN (
+        SELECT title, author FROM work_keys WHERE title_key = ? AND author_key = ?))''',
+            [title, author, title_key(title), author_key(author)])
+
+# --- INDEX ---
+
+_sync_lock = threading.Lock()
+
+# The background worker, and what wakes it up
+_worker = None
+_worker_lock = threading.Lock()
+_wake = threading.Event()
+
+def pending(conn):
+    """Title/author pairs changed since the last sync()."""
+    return conn.execute('SELECT COUNT(*) FROM work_key_queue').fetchone()[0]
+
+def rebuilding(conn):
+    """Whether sync() has (or has started) a backlog to pair in one pass."""
+    if conn.execute('SELECT 1 FROM duplicate_rebuild').fetchone() is not None:
+        return True
+    return pending(conn) > REBUILD_AT
+
+def sync(conn, wait=True):
+    """Indexes the title/author pairs queued by the triggers and records
+    their possible duplicates. Returns how many were done, or None if
+    another thread is syncing and wait is False."""
+    if not _sync_lock.acquire(blocking=wait):
+        return None
+    try:
+        rebuild = rebuilding(conn)
+        if not rebuild and not pending(conn):
+            # Nothing to do: don't take the write lock
+            return 0
+        done = 0
+        while True:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                queued = conn.execute('SELECT title, author FROM work_key_queue LIMIT ?', (SYNC_BATCH,)).fetchall()
+                if queued:
+                    added = _index(conn, [tuple(row) for row in queued])
+                    if rebuild:
+                        # With the first batch, so it is never indexed unpaired
+                        conn.execute('INSERT OR IGNORE INTO duplicate_rebuild (id) VALUES (1)')
+                    else:
+                        _pair(conn, added)
+                    conn.executemany('DELETE FROM work_key_queue WHERE title = ? AND author = ?', queued)
+                elif rebuild:
+                    _pair_all(conn)
+                    conn.execute('DELETE FROM duplicate_rebuild')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            if not queued:
+                return done
+            done += len(queued)
+    finally:
+        _sync_lock.release()
+
+def start_background():
+    """Wakes the worker thread that runs sync() with its own connection,
+    starting it if it isn't running (the first run after an upgrade
+    indexes the whole library). Call it after writes to books."""
+    global _worker
+    with _worker_lock:
+        _wake.set()
+        if _worker is not None and _worker.is_alive():
+            return
+        _worker = threading.Thread(target=_work, name='duplicates', daemon=True)
+        _worker.start()
+
+def _work():
+    conn = database.connect()
+    try:
+        while True:
+            _wake.wait()
+            # Cleared first: a write during the sync wakes it again
+            _wake.clear()
+            try:
+                sync(conn)
+            except Exception:
+                log.exception("Indexing works for duplicate detection failed")
+    finally:
+        conn.close()
+
+def _index(conn, names):
+    # (Re)indexes each (title, author); returns [(key id, keys)] added
+    counts = Counter()
+    added = []
+    new_grams = []
+    old_grams = []
+    for title, author in names:
+        old = conn.execute('SELECT id, title_key, author_key FROM work_keys WHERE title = ? AND author = ?',
+                           (title, author)).fetchone()
+        listed = conn.execute('SELECT 1 FROM works WHERE title = ? AND author = ?', (title, author)).fetchone()
+        keys = (title_key(title), author_key(author)) if listed else None
+        if old is not None and keys == (old[1], old[2]):
+            continue
+        if old is not None:
+            grams = trigrams(old[1])
+            old_grams.extend((gram, old[0]) for gram in grams)
+            counts.subtract(grams)
+            conn.execute('DELETE FROM work_keys WHERE id = ?', (old[0],))
+            conn.execute('DELETE FROM duplicate_pairs WHERE first_id = ? OR second_id = ?', (old[0], old[0]))
+        if keys is not None:
+            key_id = conn.execute('INSERT INTO work_keys (title, author, title_key, author_key) VALUES (?, ?, ?, ?)',
+                                  (title, author, *keys)).lastrowid
+            grams = trigrams(keys[0])
+            new_grams.extend((gram, key_id) for gram in grams)
+            counts.update(grams)
+            added.append((key_id, keys))
+
+    # In index order: far fewer pages touched than in arrival order
+    conn.executemany('DELETE FROM work_grams WHERE gram = ? AND key_id = ?', sorted(old_grams))
+    conn.executemany('INSERT INTO work_grams (gram, key_id) VALUES (?, ?)', sorted(new_grams))
+    conn.executemany('''
+        INSERT INTO work_gram_counts (gram, works) VALUES (?, ?)
+        ON CONFLICT (gram) DO UPDATE SET works = works + excluded.works
+    ''', sorted((gram, n) for gram, n in counts.items() if n))
+    conn.execute('DELETE FROM work_gram_counts WHERE works <= 0')
+    return added
+
+def _probe(conn, keys):
+    # {key id: similarity} of the indexed works alike to (title_key,
+    # author_key). Only rare trigrams are looked up, so this reads a few
+    # short posting lists however big the library is.
+    found = {row[0]: 1.0 for row in conn.execute(
+        'SELECT id FROM work_keys WHERE title_key = ? AND author_key = ?', keys)}
+    grams = sorted(trigrams(keys[0]))
+    candidates = conn.execute(f'''
+        SELECT g.key_id, k.title_key, k.author_key FROM work_gram_counts AS c
+        CROSS JOIN work_grams AS g ON g.gram = c.gram
+        JOIN work_keys AS k ON k.id = g.key_id
+        WHERE c.gram IN ({', '.join('?' * len(grams))}) AND c.works <= ?
+        GROUP BY g.key_id HAVING COUNT(*) >= ?
+    ''', (*grams, MAX_POSTINGS, min(MIN_SHARED, len(grams))))
+    for key_id, other_title, other_author in candidates:
+        if key_id not in found:
+            score = similarity(keys, (other_title, other_author))
+            if score:
+                found[key_id] = score
+    return found
+
+def _pair(conn, added):
+    rows = []
+    for key_id, keys in added:
+        for other, score in _probe(conn, keys).items():
+            if other != key_id:
+                rows.append((min(key_id, other), max(key_id, other), score))
+    conn.executemany('INSERT OR REPLACE INTO duplicate_pairs (first_id, second_id, score) VALUES (?, ?, ?)', rows)
+
+def _pair_all(conn):
+    # Every pair at once: same keys by GROUP BY, similar ones through a
+    # self-join of the rare trigrams' posting lists
+    conn.execute('DELETE FROM duplicate_pairs')
+    scores = {}
+    for (ids,) in conn.execute('''
+        SELECT GROUP_CONCAT(id) FROM work_keys GROUP BY title_key, author_key HAVING COUNT(*) > 1
+    '''):
+        ids = sorted(int(key_id) for key_id in ids.split(','))
+        for i, first in enumerate(ids):
+            for second in ids[i + 1:]:
+                scores[(first, second)] = 1.0
+
+    candidates = conn.execute('''
+        WITH rare AS MATERIALIZED (
+            SELECT g.gram, g.key_id FROM work_gram_counts AS c
+            CROSS JOIN work_grams AS g ON g.gram = c.gram
+            WHERE c.works BETWEEN 2 AND ?
+        ),
+        shared AS (
+            SELECT a.key_id AS first_id, b.key_id AS second_id FROM rare AS a
+            JOIN rare AS b ON b.gram = a.gram AND b.key_id > a.key_id
+            GROUP BY a.key_id, b.key_id HAVING COUNT(*) >= ?
+        )
+        SELECT s.first_id, s.second_id, a.title_key, a.author_key, b.title_key, b.author_key
+        FROM shared AS s
+        JOIN work_keys AS a ON a.id = s.first_id
+        JOIN work_keys AS b ON b.id = s.second_id
+    ''', (MAX_POSTINGS, MIN_SHARED))
+    for first, second, *keys in candidates:
+        if (first, second) not in scores:
+            score = similarity(tuple(keys[:2]), tuple(keys[2:]))
+            if score:
+                scores[(first, second)] = score
+    conn.executemany('INSERT INTO duplicate_pairs (first_id, second_id, score) VALUES (?, ?, ?)',
+                     [(first, second, score) for (first, second), score in scores.items()])
+
+# --- READING ---
+
+_NOT_DISMISSED = '''NOT EXISTS (
+    SELECT 1 FROM duplicate_dismissals AS d
+    WHERE (d.first_title = a.title AND d.first_author = a.author AND d.second_title = b.title AND d.second_author = b.author)
+       OR (d.first_title = b.title AND d.first_author = b.author AND d.second_title = a.title AND d.second_author = a.author)
+)'''
+
+def possible_duplicates(conn, limit=SHOWN):
+    """(pairs, total): the `limit` pairs of works most likely to be the same
+    book, as {'score', 'same_key', 'works': (work, work)} with the work
+    with more copies first. A work is a dict of title, author, id (its
+    first copy) and copies. Dismissed pairs are left out."""
+    pairs = []
+    rows = conn.execute(f'''
+        SELECT p.score, a.title_key = b.title_key AND a.author_key = b.author_key,
+               a.title, a.author, wa.id, wa.copy_count, b.title, b.author, wb.id, wb.copy_count
+        FROM duplicate_pairs AS p
+        -- CROSS JOIN: drive from the (few) pairs, not from works
+        CROSS JOIN work_keys AS a ON a.id = p.first_id
+        CROSS JOIN work_keys AS b ON b.id = p.second_id
+        JOIN works AS wa ON wa.title = a.title AND wa.author = a.author
+        JOIN works AS wb ON wb.title = b.title AND wb.author = b.author
+        WHERE {_NOT_DISMISSED}
+        ORDER BY p.score DESC, a.title, a.author
+        LIMIT ?
+    ''', (limit,))
+    for score, same_key, *sides in rows:
+        works = [dict(zip(('title', 'author', 'id', 'copies'), sides[i:i + 4])) for i in (0, 4)]
+        works.sort(key=lambda work: (-work['copies'], work['id']))
+        pairs.append({'score': score, 'same_key': bool(same_key), 'works': tuple(works)})
+
+    total = conn.execute(f'''
+        SELECT COUNT(*) FROM duplicate_pairs AS p
+        JOIN work_keys AS a ON a.id = p.first_id
+        JOIN work_keys AS b ON b.id = p.second_id
+        WHERE {_NOT_DISMISSED}
+    ''').fetchone()[0]
+    return pairs, total
+
+def matches(conn, title, author, exclude=None, limit=5):
+    """Works a book typed in as title/author may duplicate, most alike
+    first, for the add form's warning. `exclude` is a (title, author) to
+    leave out (the work of the book being edited)."""
+    keys = (title_key(title), author_key(author))
+    if not keys[0]:
+        return []
+    found = _probe(conn, keys)
+    if not found:
+        return []
+    rows = conn.execute('''
+        SELECT k.id, k.title, k.author, w.id, w.copy_count
+        FROM work_keys AS k JOIN works AS w ON w.title = k.title AND w.author = k.author
+        WHERE k.id IN (SELECT value FROM json_each(?))
+    ''', (json.dumps(list(found)),)).fetchall()
+    result = []
+    for key_id, work_title, work_author, first_id, copies in rows:
+        if (work_title, work_author) == exclude:
+            continue
+        result.append({'title': work_title, 'author': work_author, 'id': first_id, 'copies': copies,
+                       'score': found[key_id], 'exact': (work_title, work_author) == (title, author)})
+    result.sort(key=lambda match: (-match['exact'], -match['score'], -match['copies']))
+    return result[:limit]
+
+# --- ACTIONS ---
+
+def merge(conn, keep, drop):
+    """Renames every copy of the `drop` (title, author) to `keep`, so they
+    become one work. Returns the number of copies moved; the caller commits
+    (and syncs)."""
+    return conn.execute('UPDATE books SET title = ?, author = ? WHERE title = ? AND author = ?',
+                        (*keep, *drop)).rowcount
+
+def dismiss(conn, first, second):
+    """Records that two (title, author) works are different books, so the
+    pair isn't suggested again. The caller commits."""
+    first, second = sorted((tuple(first), tuple(second)))
+    conn.execute('''
+        INSERT OR IGNORE INTO duplicate_dismissals (first_title, first_author, second_title, second_author)
+        VALUES (?, ?, ?, ?)
+    ''', (*first, *second))
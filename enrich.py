@@ -0,0 +1,295 @@
+import argparse
+import logging
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import covers
+import database
+import migrations
+import openlibrary
+
+log = logging.getLogger(__name__)
+
+# Fills the gaps in books that have an ISBN but are missing a cover, page
+# count, publisher or year, from Open Library. Runs from the audit page
+# (a daemon thread in the admin app) or as `python enrich.py`. Only empty
+# columns are ever written, and each book's outcome is kept in the
+# enrichment table so a run never asks twice about the same book.
+
+# Parallel lookups, and the most Open Library requests per second across
+# all of them (cache hits are free)
+DEFAULT_WORKERS = 4
+DEFAULT_RATE = 1.0
+
+# Attempts per lookup, and the first back-off in seconds (doubles each time)
+ATTEMPTS = 3
+BACKOFF = 2.0
+
+# A book whose lookups all failed is tried again after this many seconds
+# (doubling per failed run, capped at a week)
+RETRY_AFTER = 3600
+MAX_RETRY_AFTER = 7 * 24 * 3600
+
+# Books read per query, and results written per transaction
+FETCH_BATCH = 200
+WRITE_BATCH = 50
+
+# Columns this fills, with the value that counts as "empty"
+COLUMNS = {
+    'cover_url': '',
+    'page_count': 0,
+    'publisher': '',
+    'published_year': 0,
+}
+
+# Outcomes (enrichment.status)
+# filled      -> at least one column was filled
+# nothing_new -> Open Library had nothing we were missing
+# not_found   -> Open Library has no record of the ISBN
+# failed      -> Open Library could not be reached; retried later
+FAILED = 'failed'
+
+def _incomplete():
+    return " OR ".join(f"books.{col} IS NULL OR books.{col} = {empty!r}" for col, empty in COLUMNS.items())
+
+def candidates(conn, after_id=0, limit=FETCH_BATCH, recheck=False):
+    """Incomplete books with an ISBN that have not been looked up yet (or
+    whose failed lookup is due again), in id order."""
+    done_clause = "e.book_id IS NULL OR (e.status = 'failed' AND e.retry_after <= ?)"
+    params = [after_id, time.time()]
+    if recheck:
+        done_clause = "1 = 1"
+        params.pop()
+    return conn.execute(f'''
+        SELECT books.id, books.isbn, e.attempts FROM books
+        LEFT JOIN enrichment AS e ON e.book_id = books.id
+        WHERE books.id > ? AND books.isbn IS NOT NULL AND books.isbn != ''
+            AND ({_incomplete()}) AND ({done_clause})
+        ORDER BY books.id LIMIT ?
+    ''', (*params, limit)).fetchall()
+
+def count_candidates(conn, recheck=False):
+    done_clause = "1 = 1" if recheck else "e.book_id IS NULL OR (e.status = 'failed' AND e.retry_after <= ?)"
+    params = () if recheck else (time.time(),)
+    return conn.execute(f'''
+        SELECT COUNT(*) FROM books
+        LEFT JOIN enrichment AS e ON e.book_id = books.id
+        WHERE books.isbn IS NOT NULL AND books.isbn != ''
+            AND ({_incomplete()}) AND ({done_clause})
+    ''', params).fetchone()[0]
+
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart, across threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+def fetch(isbn, limiter):
+    """Open Library lookup with retries. Returns the parsed book or None;
+    raises LookupFailed once every attempt has failed."""
+    isbn = openlibrary.clean_isbn(isbn)
+    hit, book = openlibrary.cache.get(isbn)
+    if hit:
+        return book
+    for attempt in range(ATTEMPTS):
+        limiter.wait()
+        try:
+            return openlibrary.lookup(isbn)
+        except openlibrary.LookupFailed:
+            if attempt == ATTEMPTS - 1:
+                raise
+            # Exponential back-off with jitter, so workers don't retry in step
+            time.sleep(BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+
+def save_results(conn, results):
+    """Writes a batch of (book_id, attempts, book, error) in one transaction.
+    Each book is re-read under the write lock, so an edit made meanwhile
+    is never overwritten. Returns the cover URLs that were filled in."""
+    new_covers = []
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for book_id, attempts, book, error in results:
+            attempts = (attempts or 0) + 1
+            filled = []
+            current = conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM books WHERE id = ?", (book_id,)
+            ).fetchone()
+            if current is None:
+                # Deleted during the run: its enrichment row is already gone
+                # (enrichment_ad) and must not come back
+                continue
+            if error is not None:
+                status, message = FAILED, str(error)
+            elif book is None:
+                status, message = 'not_found', 'Not found on Open Library'
+            else:
+                updates = {col: book.get(col) for col, empty in COLUMNS.items()
+                           if current[col] in (None, empty) and book.get(col) not in (None, empty)}
+                if updates:
+                    assignments = ', '.join(f"{col} = :{col}" for col in updates)
+                    conn.execute(f"UPDATE books SET {assignments} WHERE id = :id", {**updates, 'id': book_id})
+                    if updates.get('cover_url'):
+                        new_covers.append(updates['cover_url'])
+                filled = list(updates)
+                status = 'filled' if filled else 'nothing_new'
+                message = None
+
+            retry_after = None
+            if status == FAILED:
+                retry_after = time.time() + min(RETRY_AFTER * 2 ** (attempts - 1), MAX_RETRY_AFTER)
+            conn.execute('''
+                INSERT OR REPLACE INTO enrichment (book_id, status, filled, message, attempts, updated_at, retry_after)
+                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP, ?)
+            ''', (book_id, status, ', '.join(filled) or None, message, attempts, retry_after))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return new_covers
+
+class Run:
+    """One pass over the incomplete books. Counters are read by the audit
+    page while the run is going."""
+
+    def __init__(self, workers=DEFAULT_WORKERS, rate=DEFAULT_RATE, recheck=False, queue_covers=False):
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.recheck = recheck
+        self.queue_covers = queue_covers
+        self.total = 0
+        self.done = 0
+        self.counts = {}
+        self.started_at = time.time()
+        self.finished_at = None
+        self.error = None
+
+    def execute(self, conn, progress=None):
+        self.total = count_candidates(conn, self.recheck)
+        pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='enrich')
+        after_id = 0
+        try:
+            while True:
+                todo = candidates(conn, after_id, FETCH_BATCH, self.recheck)
+                if not todo:
+                    break
+                after_id = todo[-1]['id']
+                futures = {pool.submit(fetch, row['isbn'], self.limiter): row for row in todo}
+                results = []
+                for future in as_completed(futures):
+                    row = futures[future]
+                    try:
+                        book, error = future.result(), None
+                    except openlibrary.LookupFailed as e:
+                        book, error = None, e
+                    results.append((row['id'], row['attempts'], book, error))
+                    if len(results) >= WRITE_BATCH:
+                        self._save(conn, results, progress)
+                        results = []
+                self._save(conn, results, progress)
+        finally:
+            # On Ctrl-C: drop lookups that haven't started
+            pool.shutdown(wait=False, cancel_futures=True)
+            self.finished_at = time.time()
+
+    def _save(self, conn, results, progress):
+        if not results:
+            return
+        new_covers = save_results(conn, results)
+        if self.queue_covers:
+            for url in new_covers:
+                covers.fetcher.enqueue(url)
+        for book_id, _, book, error in results:
+            outcome = FAILED if error else ('not_found' if book is None else 'looked_up')
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+            self.done += 1
+            if progress:
+                progress(self, book_id, outcome)
+
+# --- BACKGROUND RUNS (audit page) ---
+
+_current = None
+_current_lock = threading.Lock()
+
+def current_run():
+    """The run started from this process (running or last finished), or None."""
+    return _current
+
+def start_background(workers=DEFAULT_WORKERS, rate=DEFAULT_RATE):
+    """Starts a run on a daemon thread with its own connection. Returns
+    False if one is already running in this process."""
+    global _current
+    with _current_lock:
+        if _current is not None and _current.finished_at is None:
+            return False
+        run = _current = Run(workers, rate, queue_covers=True)
+
+    def work():
+        conn = database.connect()
+        try:
+            run.execute(conn)
+        except Exception as e:
+            log.exception("Metadata enrichment failed")
+            run.error = str(e)
+        finally:
+            conn.close()
+
+    threading.Thread(target=work, name='enrich', daemon=True).start()
+    return True
+
+def summary(conn):
+    """Books per outcome so far, e.g. {'filled': 120, 'failed': 3}."""
+    rows = conn.execute('SELECT status, COUNT(*) FROM enrichment GROUP BY status').fetchall()
+    return {row[0]: row[1] for row in rows}
+
+def recent_problems(conn, limit=20):
+    return conn.execute('''
+        SELECT e.book_id, e.status, e.message, e.attempts, e.updated_at, books.title, books.author, books.isbn
+        FROM enrichment AS e JOIN books ON books.id = e.book_id
+        WHERE e.status IN ('failed', 'not_found')
+        ORDER BY e.updated_at DESC, e.book_id DESC LIMIT ?
+    ''', (limit,)).fetchall()
+
+# --- CLI ---
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fill missing covers, page counts, publishers and years from Open Library.")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="Parallel Open Library lookups")
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE, help="Most Open Library requests per second")
+    parser.add_argument('--recheck', action='store_true', help="Also look up books tried before (not found, nothing new)")
+    args = parser.parse_args(argv)
+
+    conn = database.connect()
+    migrations.migrate(conn)
+
+    def progress(run, book_id, outcome):
+        print(f"  {run.done}/{run.total}  book #{book_id}  {outcome}")
+
+    run = Run(args.workers, args.rate, args.recheck)
+    try:
+        run.execute(conn, progress)
+    except KeyboardInterrupt:
+        print("\n⚠️  Interrupted. Finished lookups were saved; run again to continue.")
+        return 130
+    finally:
+        totals = summary(conn)
+        conn.close()
+
+    print("  ".join(f"{status}: {n}" for status, n in sorted(totals.items())))
+    print(f"✅ Looked up {run.done} books. Run `python covers.py` to download new covers.")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+import csv
+import io
+import json
+import zlib
+
+import facets
+
+# Streams the books table out as CSV, NDJSON or a JSON array. Rows are
+# pulled from the cursor a chunk at a time and each chunk is encoded (and
+# optionally gzipped) before the next is read, so memory stays flat and
+# the first bytes go out immediately, whatever the library size.
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'json': 'application/json',
+}
+
+COLUMNS = [
+    'id', 'title', 'author', 'isbn', 'publisher', 'binding',
+    'page_count', 'published_year', 'series_title', 'series_number',
+    'height', 'width', 'weight', 'notes', 'cover_url',
+    'read_status', 'is_signed', 'no_isbn',
+]
+
+# Rows per fetchmany() and per yielded chunk
+CHUNK_ROWS = 500
+
+def iter_rows(conn, selected=None):
+    """Yields lists of rows (at most CHUNK_ROWS each), in id order."""
+    where, params = facets.where(selected or {})
+    cursor = conn.execute(f"SELECT {', '.join(COLUMNS)} FROM books WHERE {where} ORDER BY id", params)
+    while True:
+        rows = cursor.fetchmany(CHUNK_ROWS)
+        if not rows:
+            break
+        yield rows
+
+def _csv_chunks(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def _ndjson_chunks(chunks):
+    for rows in chunks:
+        yield ''.join(json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False) + '\n' for row in rows)
+
+def _json_chunks(chunks):
+    # One JSON array, written incrementally
+    separator = '[\n'
+    for rows in chunks:
+        parts = []
+        for row in rows:
+            parts.append(separator + json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False))
+            separator = ',\n'
+        yield ''.join(parts)
+    yield '[]\n' if separator == '[\n' else '\n]\n'
+
+ENCODERS = {
+    'csv': _csv_chunks,
+    'ndjson': _ndjson_chunks,
+    'json': _json_chunks,
+}
+
+def gzip_chunks(chunks):
+    """Gzips a stream of byte chunks, flushing after each one so the
+    client sees progress."""
+    # wbits=31: gzip container
+    gzip = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = gzip.compress(chunk) + gzip.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield gzip.flush()
+
+def stream(conn, fmt, selected=None, compress=False):
+    """Yields the export as UTF-8 bytes (gzip-compressed if asked)."""
+    chunks = (text.encode('utf-8') for text in ENCODERS[fmt](iter_rows(conn, selected)))
+    if compress:
+        chunks = gzip_chunks(chunks)
+    yield from chunks
@@ -0,0 +1,225 @@
+import threading
+from collections import OrderedDict
+
+import database
+import metrics
+
+# Composable filters for the library listing ("Hardcover + To Read +
+# 1960s + Ace"). Each facet is an expression over the books table. A copy
+# matches when, for every facet in use, its value is one of the ticked
+# ones (OR within a facet, AND across facets); a work is listed if any of
+# its copies match.
+
+# URL name -> (SQL expression over books, URL value parser, heading)
+FACETS = {
+    'status': ("COALESCE(read_status, '')", str, "Status"),
+    'binding': ("TRIM(binding)", str, "Format"),
+    'signed': ("COALESCE(is_signed, 0)", int, "Signed"),
+    'decade': ("published_year / 10 * 10", int, "Decade"),
+    'publisher': ("TRIM(publisher)", str, "Publisher"),
+    'series': ("series_title", str, "Series"),
+}
+
+# Options listed per facet, busiest first (ticked ones are always listed)
+TOP_VALUES = 15
+
+# The old single ?filter= dropdown, still accepted in URLs and the CLI
+LEGACY_FILTERS = {
+    'read': ('status', 'Read'),
+    'tbr': ('status', 'To Read'),
+    'dnf': ('status', 'DNF'),
+    'signed': ('signed', 1),
+}
+
+# Single-option selections the works table already counts per work
+SUMMARY_COLUMNS = {
+    ('status', 'Read'): 'read_copies',
+    ('status', 'To Read'): 'tbr_copies',
+    ('status', 'DNF'): 'dnf_copies',
+    ('signed', 1): 'signed_copies',
+}
+
+# Selections whose counts are kept per process
+CACHE_ENTRIES = 256
+
+def from_filter(name):
+    """Selection for one of the LEGACY_FILTERS names (empty otherwise)."""
+    if name not in LEGACY_FILTERS:
+        return {}
+    facet, value = LEGACY_FILTERS[name]
+    return {facet: (value,)}
+
+def parse(args):
+    """Selected facets from the query string: {name: (value, ...)}.
+    Unknown names and values that don't parse are ignored."""
+    chosen = {name: set(values) for name, values in from_filter(args.get('filter')).items()}
+    for name, (_, parse_value, _) in FACETS.items():
+        for raw in args.getlist(name):
+            try:
+                chosen.setdefault(name, set()).add(parse_value(raw))
+            except ValueError:
+                pass
+    return {name: tuple(sorted(chosen[name])) for name in FACETS if chosen.get(name)}
+
+def where(selected, skip=None):
+    """(SQL condition over books, params) for the selection, leaving out
+    the `skip` facet."""
+    clauses = []
+    params = []
+    for name, values in selected.items():
+        if name == skip:
+            continue
+        clauses.append(f"{FACETS[name][0]} IN ({', '.join('?' * len(values))})")
+        params.extend(values)
+    return " AND ".join(clauses) or "1 = 1", params
+
+def summary_column(selected):
+    """The works column counting the selected copies, if there is one."""
+    if len(selected) != 1:
+        return None
+    (name, values), = selected.items()
+    if len(values) != 1:
+        return None
+    return SUMMARY_COLUMNS.get((name, values[0]))
+
+def label(name, value):
+    if name == 'status':
+        return value or "No Status"
+    if name == 'signed':
+        return "Signed" if value else "Not Signed"
+    if name == 'decade':
+        return f"{value}s"
+    return str(value)
+
+def count(conn, selected):
+    """Copy counts for the current selection:
+    {'total': matching copies, 'facets': {name: [option, ...]}}.
+    A facet's counts ignore its own ticked options, so they show what
+    ticking one more would add."""
+    wanted = len(selected)
+    found = {name: {} for name in FACETS}
+
+    # With nothing ticked, or one facet, "ignoring its own selection" means
+    # the whole library: facet_values has those counts (migration 7)
+    stored = list(FACETS) if wanted == 0 else list(selected) if wanted == 1 else []
+    if stored:
+        rows = conn.execute(f"""
+            SELECT facet, value, copies FROM facet_values
+            WHERE copies > 0 AND facet IN ({', '.join('?' * len(stored))})
+        """, stored)
+        for name, value, copies in rows:
+            found[name][value] = copies
+
+    if wanted == 0:
+        total = conn.execute("SELECT COUNT(*) FROM books").fetchone()[0]
+    else:
+        total = _count_matching(conn, selected, [name for name in FACETS if name not in stored], found)
+
+    result = {}
+    for name, counts in found.items():
+        counts = {value: n for value, n in counts.items() if value != '' or name == 'status'}
+        ticked = selected.get(name, ())
+        for value in ticked:
+            counts.setdefault(value, 0)
+        if name == 'decade':
+            values = sorted(counts)
+        else:
+            values = sorted(counts, key=lambda v: (-counts[v], v))
+        shown = values[:TOP_VALUES] + [v for v in values[TOP_VALUES:] if v in ticked]
+        result[name] = [{'value': value, 'label': label(name, value), 'count': counts[value], 'selected': value in ticked}
+                        for value in shown]
+    return {'total': total, 'facets': result}
+
+def _count_matching(conn, selected, names, found):
+    # One pass over books: every copy failing at most one ticked facet is
+    # kept once, with a 0/1 flag per ticked facet; each facet's counts are
+    # then a GROUP BY over that (much smaller) set. Fills found[name] for
+    # `names` and returns the number of copies matching everything.
+    columns = [f"{FACETS[name][0]} AS v_{name}" for name in names]
+    flags = []
+    flag_params = []
+    for name, values in selected.items():
+        flags.append(f"COALESCE({FACETS[name][0]} IN ({', '.join('?' * len(values))}), 0)")
+        flag_params.extend(values)
+    columns.extend(f"{flag} AS m_{name}" for flag, name in zip(flags, selected))
+    matched = " + ".join(flags)
+    wanted = len(selected)
+    # Near misses only count towards ticked facets that are still to do
+    keep = wanted - 1 if any(name in selected for name in names) else wanted
+
+    parts = [f"SELECT NULL, NULL, COUNT(*) FROM copies WHERE matched = {wanted}"]
+    for name in names:
+        condition = f"matched - m_{name} = {wanted - 1}" if name in selected else f"matched = {wanted}"
+        parts.append(f"SELECT '{name}', v_{name}, COUNT(*) FROM copies WHERE {condition} GROUP BY v_{name}")
+
+    query = f"""
+        WITH copies AS MATERIALIZED (
+            SELECT {', '.join(columns)}, {matched} AS matched
+            FROM books WHERE {matched} >= {keep}
+        )
+        {' UNION ALL '.join(parts)}
+    """
+    total = 0
+    for name, value, copies in conn.execute(query, flag_params * 3):
+        if name is None:
+            total = copies
+        elif value is not None:
+            found[name][value] = copies
+    return total
+
+class _VersionedCache:
+    """Results per key, least recently used dropped first. Like
+    page_cache.PageCache, everything is dropped when PRAGMA data_version
+    says books.db changed."""
+
+    def __init__(self, max_entries=CACHE_ENTRIES, path=None, data_version=None):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+        # Opened on first use (see page_cache.PageCache)
+        self._path = path
+        self._conn = None
+        # Or a function giving the version (snapshot.SnapshotPool.version)
+        self._data_version = data_version
+
+    def _current_version(self):
+        if self._data_version is not None:
+            return self._data_version()
+        if self._conn is None:
+            self._conn = database.connect(read_only=True, check_same_thread=False, path=self._path)
+        return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def _get(self, key, compute, counter):
+        with self._lock:
+            version = self._current_version()
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        counter.inc('hit' if entry is not None else 'miss')
+        if entry is not None:
+            return entry
+
+        entry = compute()
+        with self._lock:
+            if version == self._version:
+                self._entries[key] = entry
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return entry
+
+class CountCache(_VersionedCache):
+    """count() results per selection."""
+
+    def get(self, conn, selected):
+        return self._get(tuple(selected.items()), lambda: count(conn, selected), metrics.FACET_CACHE)
+
+class ListingCache(_VersionedCache):
+    """Pages of the works listing per (selection, sort, cursor, page
+    size), for the selections that look at each work's copies."""
+
+    def get(self, key, compute):
+        return self._get(key, compute, metrics.LISTING_CACHE)
@@ -0,0 +1,195 @@
+import glob
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+import changes
+import database
+
+log = logging.getLogger(__name__)
+
+# Keeping books.db healthy: snapshots (backups) and tuning (checkpoint,
+# incremental vacuum, fresh planner statistics). Used by
+# `maintenance.py backup|optimize` and by the admin app's nightly
+# scheduler (MAINTENANCE_AT). None of it locks readers out.
+
+BACKUP_DIR = os.environ.get('BACKUP_DIR') or os.path.join(database.BASE_DIR, 'data', 'backups')
+BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', 7))
+
+# Pages copied per backup step, and the pause between steps so the
+# snapshot doesn't hog the disk
+BACKUP_STEP_PAGES = 1024
+BACKUP_STEP_PAUSE = 0.005
+
+# Pages freed per incremental_vacuum call (each call is a short write)
+VACUUM_STEP_PAGES = 2000
+
+# Rows ANALYZE samples per index; enough for the planner, fast on any size
+ANALYSIS_LIMIT = 1000
+
+# The scheduler waits for this many quiet seconds after MAINTENANCE_AT,
+# for at most MAX_DELAY, and skips the backup if a recent one exists
+IDLE_SECONDS = 60
+MAX_DELAY = 2 * 3600
+MIN_BACKUP_AGE = 12 * 3600
+
+class SnapshotFailed(Exception):
+    pass
+
+def snapshot_paths(directory=None):
+    """Existing snapshots, oldest first."""
+    return sorted(glob.glob(os.path.join(directory or BACKUP_DIR, 'books-*.db')))
+
+def snapshot(conn, directory=None, verify=True, progress=None):
+    """Copies the database to <directory>/books-<timestamp>.db with the
+    online backup API and returns the path.
+
+    The copy runs inside one read transaction on `conn`, so in WAL mode it
+    is a consistent snapshot that writers never block and never restart
+    (a stepped backup without one starts over after every commit)."""
+    directory = directory or BACKUP_DIR
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"books-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db")
+    partial = path + '.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+
+    def step(status, remaining, total):
+        if progress:
+            progress(total - remaining, total)
+        time.sleep(BACKUP_STEP_PAUSE)
+
+    target = sqlite3.connect(partial)
+    try:
+        conn.execute('BEGIN')
+        try:
+            conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+            conn.backup(target, pages=BACKUP_STEP_PAGES, progress=step)
+        finally:
+            conn.rollback()
+        # A self-contained file: no -wal next to it
+        target.execute('PRAGMA journal_mode = DELETE')
+        if verify:
+            result = target.execute('PRAGMA integrity_check').fetchall()
+            if [row[0] for row in result] != ['ok']:
+                raise SnapshotFailed("; ".join(row[0] for row in result[:5]))
+    except BaseException:
+        target.close()
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    target.close()
+    os.replace(partial, path)
+    return path
+
+def rotate(directory=None, keep=BACKUP_KEEP):
+    """Deletes all but the newest `keep` snapshots. Returns the deleted paths."""
+    paths = snapshot_paths(directory)
+    old = paths[:-keep] if keep > 0 else []
+    for path in old:
+        os.remove(path)
+    return old
+
+def verify(path):
+    """Runs integrity_check on a snapshot; returns the problems (empty if fine)."""
+    conn = database.connect(read_only=True, path=path)
+    try:
+        rows = conn.execute('PRAGMA integrity_check').fetchall()
+    finally:
+        conn.close()
+    return [row[0] for row in rows if row[0] != 'ok']
+
+def optimize(conn, log_step=None):
+    """Compacts the change log, hands free pages back to the filesystem
+    (if incremental auto-vacuum is on), refreshes planner statistics and
+    checkpoints the WAL. Every step is a short transaction, so the app
+    keeps writing meanwhile. Returns a summary dict."""
+    report = {}
+
+    report['changes_compacted'] = changes.compact(conn)
+    if log_step:
+        log_step(f"compacted the change log ({report['changes_compacted']} entries)")
+
+    report['free_pages'] = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    report['auto_vacuum'] = conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+    report['vacuumed'] = 0
+    if report['auto_vacuum']:
+        free = report['free_pages']
+        while free:
+            # execute() would stop after the first freed page; a script
+            # runs the pragma to completion
+            conn.executescript(f'PRAGMA incremental_vacuum({VACUUM_STEP_PAGES});')
+            left = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if left >= free:
+                break
+            report['vacuumed'] += free - left
+            free = left
+            if log_step:
+                log_step(f"freed {report['vacuumed']} pages")
+
+    # PRAGMA optimize on a fresh connection only looks at tables that
+    # connection has queried, so analyze everything, sampled
+    conn.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.execute('PRAGMA optimize')
+
+    # Last, so the vacuumed file shrinks now. PASSIVE never waits for
+    # readers or writers; whatever it can't copy back goes next time.
+    busy, wal_pages, copied = conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+    # -1 when another connection was checkpointing at that moment
+    report['wal_pages'] = max(wal_pages, 0)
+    report['checkpointed'] = max(copied, 0)
+    return report
+
+def enable_incremental_vacuum(conn):
+    """One-off full VACUUM that switches the file to incremental
+    auto-vacuum (so optimize() can shrink it from then on). This rewrites
+    the whole file and blocks writers until it finishes."""
+    conn.commit()
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+
+# --- SCHEDULER (admin app) ---
+
+def _next_run(at, now):
+    hour, minute = (int(part) for part in at.split(':'))
+    run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    return run if run > now else run + timedelta(days=1)
+
+def run_nightly():
+    """Snapshot + rotate + optimize, as the scheduler runs it. Skips the
+    snapshot if another process made one recently."""
+    conn = database.connect()
+    try:
+        recent = [path for path in snapshot_paths() if time.time() - os.path.getmtime(path) < MIN_BACKUP_AGE]
+        if not recent:
+            path = snapshot(conn)
+            deleted = rotate()
+            log.info("Backed up books.db to %s (%d old snapshots removed)", path, len(deleted))
+        report = optimize(conn)
+        log.info("Optimized books.db: %s", report)
+    finally:
+        conn.close()
+
+def start_scheduler(at, idle_seconds):
+    """Runs run_nightly() every day at `at` ("HH:MM", local time), once the
+    app has been idle for IDLE_SECONDS (idle_seconds() returns how long it
+    has been since the last request), waiting at most MAX_DELAY."""
+    _next_run(at, datetime.now())  # Fail at startup on a malformed time
+
+    def work():
+        while True:
+            time.sleep(max((_next_run(at, datetime.now()) - datetime.now()).total_seconds(), 1))
+            deadline = time.monotonic() + MAX_DELAY
+            while idle_seconds() < IDLE_SECONDS and time.monotonic() < deadline:
+                time.sleep(10)
+            try:
+                run_nightly()
+            except Exception:
+                log.exception("Nightly maintenance failed")
+
+    threading.Thread(target=work, name='housekeeping', daemon=True).start()
@@ -1,5 +1,17 @@
-import sqlite3
+import argparse
+import csv
+import json
 import os
+import sys
+from datetime import datetime
+
+from werkzeug.datastructures import MultiDict
+
+import database
+import export
+import facets
+import housekeeping
+import migrations
 
 # Define the columns we want to edit and how they look to the user
 # Format: (Database Column Name, Display Label, Data Type)
@@ -20,13 +32,38 @@ FIELDS = [
     ('notes', 'Notes', str)
 ]
 
+FIELD_TYPES = {name: data_type for name, _, data_type in FIELDS}
+
+# Undo journals written by batch edits (see batch_mode)
+UNDO_DIR = os.path.join(database.BASE_DIR, 'data', 'undo')
+
+# Books read per query while applying a batch
+BATCH_CHUNK = 500
+
+def convert(data_type, raw):
+    """Prompt text or a batch value -> column value. Empty (or null)
+    means NULL. Raises ValueError if it isn't a `data_type`."""
+    if raw is None:
+        return None
+    if isinstance(raw, str):
+        raw = raw.strip()
+        if raw == "":
+            return None
+    if data_type == int:
+        if isinstance(raw, float) and not raw.is_integer():
+            raise ValueError(raw)
+        return int(raw)
+    if data_type == float:
+        return float(raw)
+    return str(raw)
+
 def get_db():
-    # 1. Determine where this file (maintenance.py) is located
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    # 2. Look for the 'data' folder inside that directory
-    db_path = os.path.join(base_dir, 'data', 'books.db')
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
+    # Same file, pragmas and WAL mode as the web app (see database.py)
+    conn = database.connect()
+    # Upgrade older databases (indexes, search table) before editing
+    applied = migrations.migrate(conn)
+    if applied:
+        print(f"🛠️  Upgraded database schema to version {applied[-1]}.")
     return conn
 
 def maintenance_mode():
@@ -90,23 +127,12 @@ def maintenance_mode():
             new_val_str = input("Enter new value: ").strip()
 
             # Prepare value for database
-            final_val = None
-            
-            if new_val_str == "":
-                # If they hit enter with no text, ask if they mean NULL or keep formatting
-                # For this script, empty input = DELETE data (set to NULL)
-                final_val = None
-            else:
-                try:
-                    if data_type == int:
-                        final_val = int(new_val_str)
-                    elif data_type == float:
-                        final_val = float(new_val_str)
-                    else:
-                        final_val = new_val_str
-                except ValueError:
-                    print(f"❌ Error: Value must be a {data_type.__name__}.")
-                    continue
+            # For this script, empty input = DELETE data (set to NULL)
+            try:
+                final_val = convert(data_type, new_val_str)
+            except ValueError:
+                print(f"❌ Error: Value must be a {data_type.__name__}.")
+                continue
 
             # Execute Update
             try:
@@ -118,5 +144,359 @@ def maintenance_mode():
 
     conn.close()
 
+def export_selection(args):
+    """The facets picked with --filter and --<facet> VALUE, read the way
+    the web export reads its query string."""
+    chosen = MultiDict()
+    if args.filter:
+        chosen.add('filter', args.filter)
+    for name in facets.FACETS:
+        for value in getattr(args, name) or ():
+            chosen.add(name, value)
+    return facets.parse(chosen)
+
+def export_mode(args):
+    """Writes the library to a file (or stdout) without loading it into memory"""
+    fmt = args.format
+    if fmt is None:
+        # Guess from the file name, e.g. books.ndjson.gz
+        name = (args.output or '').removesuffix('.gz')
+        fmt = os.path.splitext(name)[1].lstrip('.') or 'csv'
+    if fmt not in export.FORMATS:
+        print(f"❌ Unknown format '{fmt}'. Use one of: {', '.join(export.FORMATS)}.", file=sys.stderr)
+        return 1
+    compress = args.gzip or (args.output or '').endswith('.gz')
+
+    conn = get_db()
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        for chunk in export.stream(conn, fmt, export_selection(args), compress):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+        conn.close()
+    if args.output:
+        print(f"✅ Exported to {args.output}", file=sys.stderr)
+    return 0
+
+# --- BATCH EDITS ---
+
+class BatchError(Exception):
+    pass
+
+def parse_assignment(text, allow_id=False):
+    """'author=Pratchett, Terry' -> ('author', 'Pratchett, Terry'), with
+    the value converted to the field's type."""
+    field, sep, raw = text.partition('=')
+    field = field.strip()
+    if not sep or (field not in FIELD_TYPES and not (allow_id and field == 'id')):
+        raise BatchError(f"'{text}' is not <field>=<value> with a field from: {', '.join(FIELD_TYPES)}")
+    data_type = FIELD_TYPES.get(field, int)
+    try:
+        return field, convert(data_type, raw)
+    except ValueError:
+        raise BatchError(f"{field} must be a {data_type.__name__}, not '{raw}'")
+
+def select_ids(conn, ids=(), where=(), like=()):
+    """Ids of the books matching every condition: an id list, exact
+    field=value matches (None = not set) and LIKE patterns."""
+    clauses = []
+    params = []
+    if ids:
+        clauses.append("id IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(list(ids)))
+    for field, value in where:
+        if value is None:
+            clauses.append(f"{field} IS NULL")
+        else:
+            clauses.append(f"{field} = ?")
+            params.append(value)
+    for field, pattern in like:
+        clauses.append(f"{field} LIKE ?")
+        params.append(pattern)
+    rows = conn.execute(f"SELECT id FROM books WHERE {' AND '.join(clauses) or '1 = 1'} ORDER BY id", params)
+    return [row[0] for row in rows]
+
+def read_edit_file(path):
+    """Edits from a CSV (an `id` column plus one column per field; empty
+    cells are left alone) or a JSON list of objects (null clears a field).
+    Returns {book_id: {field: value}}."""
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        if path.lower().endswith('.json'):
+            records = json.load(f)
+            if not isinstance(records, list):
+                raise BatchError(f"{path}: expected a JSON list of objects")
+        else:
+            records = [{key: value for key, value in row.items() if value not in ('', None)}
+                       for row in csv.DictReader(f)]
+
+    edits = {}
+    for number, record in enumerate(records, start=1):
+        if not isinstance(record, dict):
+            raise BatchError(f"{path}, record {number}: expected an object")
+        try:
+            book_id = int(record.get('id'))
+        except (TypeError, ValueError):
+            raise BatchError(f"{path}, record {number}: missing or invalid id")
+        changes = edits.setdefault(book_id, {})
+        for field, raw in record.items():
+            if field == 'id':
+                continue
+            if field not in FIELD_TYPES:
+                raise BatchError(f"{path}, record {number}: unknown field '{field}'")
+            try:
+                changes[field] = convert(FIELD_TYPES[field], raw)
+            except ValueError:
+                raise BatchError(f"{path}, record {number}: {field} must be a {FIELD_TYPES[field].__name__}, not {raw!r}")
+    return edits
+
+def apply_edits(conn, edits, expected=None, dry_run=False, note=''):
+    """Applies {book_id: {field: value}} in one transaction and writes an
+    undo journal to UNDO_DIR. Fields already at their new value are
+    skipped, and so (given `expected`, same shape) are fields whose
+    current value isn't the expected one.
+    Returns (changes, problems, journal path or None)."""
+    changes = []
+    problems = []
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        ids = list(edits)
+        current = {}
+        for start in range(0, len(ids), BATCH_CHUNK):
+            rows = conn.execute(f"""
+                SELECT id, {', '.join(FIELD_TYPES)} FROM books
+                WHERE id IN (SELECT value FROM json_each(?))
+            """, (json.dumps(ids[start:start + BATCH_CHUNK]),))
+            for row in rows:
+                current[row['id']] = row
+
+        for book_id in ids:
+            row = current.get(book_id)
+            if row is None:
+                problems.append(f"#{book_id}: no such book")
+                continue
+            before = {}
+            after = {}
+            for field, value in edits[book_id].items():
+                if expected is not None and row[field] != expected[book_id][field]:
+                    problems.append(f"#{book_id} {field}: is now {row[field]!r}, not {expected[book_id][field]!r}; left alone")
+                    continue
+                if row[field] != value:
+                    before[field] = row[field]
+                    after[field] = value
+            if after:
+                changes.append({'id': book_id, 'title': row['title'], 'before': before, 'after': after})
+
+        if dry_run or not changes:
+            conn.rollback()
+            return changes, problems, None
+
+        # One executemany per set of changed fields
+        groups = {}
+        for change in changes:
+            groups.setdefault(tuple(change['after']), []).append(change)
+        for fields, group in groups.items():
+            assignments = ', '.join(f"{field} = ?" for field in fields)
+            conn.executemany(f"UPDATE books SET {assignments} WHERE id = ?",
+                             [[change['after'][field] for field in fields] + [change['id']] for change in group])
+
+        # The journal is on disk before the commit (and removed if it fails)
+        os.makedirs(UNDO_DIR, exist_ok=True)
+        journal = os.path.join(UNDO_DIR, f"batch-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.json")
+        with open(journal, 'w', encoding='utf-8') as f:
+            json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'note': note, 'changes': changes},
+                      f, ensure_ascii=False, indent=1)
+        try:
+            conn.commit()
+        except Exception:
+            os.remove(journal)
+            raise
+        return changes, problems, journal
+    except Exception:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+
+def print_changes(changes, problems):
+    for change in changes:
+        print(f"#{change['id']} {change['title']}")
+        for field, new in change['after'].items():
+            print(f"    {field}: {change['before'][field]!r} → {new!r}")
+    for problem in problems:
+        print(f"⚠️  {problem}")
+
+def batch_mode(args):
+    """Non-interactive edits: --set on the selected books, or a CSV/JSON file"""
+    conn = get_db()
+    try:
+        if args.file:
+            if args.set or args.ids or args.where or args.like or args.all:
+                raise BatchError("--file can't be combined with --set or a selection")
+            edits = read_edit_file(args.file)
+        else:
+            assignments = dict(parse_assignment(text) for text in args.set)
+            if not assignments:
+                raise BatchError("Nothing to change: give --set field=value (or --file)")
+            try:
+                ids = [int(part) for part in ','.join(args.ids).split(',') if part.strip()]
+            except ValueError:
+                raise BatchError("--ids takes comma-separated numbers")
+            where = [parse_assignment(text, allow_id=True) for text in args.where]
+            like = [text.split('=', 1) for text in args.like]
+            for pair in like:
+                if len(pair) != 2 or pair[0] not in FIELD_TYPES:
+                    raise BatchError(f"'{'='.join(pair)}' is not <field>=<pattern> with a field from: {', '.join(FIELD_TYPES)}")
+            if not (ids or where or like or args.all):
+                raise BatchError("Select books with --ids, --where or --like (or --all for every book)")
+            edits = {book_id: dict(assignments) for book_id in select_ids(conn, ids, where, like)}
+        changes, problems, journal = apply_edits(conn, edits, dry_run=args.dry_run, note=' '.join(sys.argv[1:]))
+    except BatchError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 2
+    finally:
+        conn.close()
+
+    print_changes(changes if args.dry_run or args.verbose else [], problems)
+    fields = sum(len(change['after']) for change in changes)
+    if args.dry_run:
+        print(f"🔍 Dry run: {fields} fields on {len(changes)} books would change. Nothing was saved.")
+    elif journal:
+        print(f"✅ Changed {fields} fields on {len(changes)} books. Undo with: python maintenance.py undo {journal}")
+    else:
+        print("Nothing to change.")
+    return 1 if problems else 0
+
+def undo_mode(args):
+    """Puts back the values a batch replaced, unless they were edited again since"""
+    with open(args.journal, encoding='utf-8') as f:
+        journal = json.load(f)
+    edits = {change['id']: change['before'] for change in journal['changes']}
+    expected = {change['id']: change['after'] for change in journal['changes']}
+
+    conn = get_db()
+    try:
+        changes, problems, undo_journal = apply_edits(conn, edits, expected=expected, dry_run=args.dry_run,
+                                                      note=f"undo {args.journal}")
+    finally:
+        conn.close()
+
+    print_changes(changes if args.dry_run or args.verbose else [], problems)
+    if args.dry_run:
+        print(f"🔍 Dry run: {len(changes)} books would be restored. Nothing was saved.")
+    elif undo_journal:
+        print(f"✅ Restored {len(changes)} books. To redo: python maintenance.py undo {undo_journal}")
+    else:
+        print("Nothing to restore.")
+    return 1 if problems else 0
+
+def backup_mode(args):
+    """Hot snapshot of books.db (the app can keep running), then rotation"""
+    conn = get_db()
+    try:
+        def progress(done, total):
+            print(f"\r  {done}/{total} pages", end='', file=sys.stderr)
+        path = housekeeping.snapshot(conn, args.dir, verify=not args.no_verify, progress=progress)
+        print(file=sys.stderr)
+    except housekeeping.SnapshotFailed as e:
+        print(f"\n❌ Snapshot failed its integrity check: {e}", file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+    print(f"✅ Backed up to {path}")
+    for old in housekeeping.rotate(args.dir, args.keep):
+        print(f"🗑️  Removed {old}")
+    return 0
+
+def verify_mode(args):
+    paths = args.paths or housekeeping.snapshot_paths(args.dir)
+    failed = 0
+    for path in paths:
+        problems = housekeeping.verify(path)
+        if problems:
+            failed += 1
+            print(f"❌ {path}: {'; '.join(problems[:5])}")
+        else:
+            print(f"✅ {path}")
+    return 1 if failed else 0
+
+def optimize_mode(args):
+    conn = get_db()
+    try:
+        if args.full:
+            print("🛠️  Rewriting the database (VACUUM); writes wait until this finishes...")
+            housekeeping.enable_incremental_vacuum(conn)
+        report = housekeeping.optimize(conn, log_step=lambda message: print(f"  {message}"))
+    finally:
+        conn.close()
+    print(f"✅ Checkpointed {report['checkpointed']}/{report['wal_pages']} WAL pages, "
+          f"freed {report['vacuumed']} pages, refreshed planner statistics.")
+    if not report['auto_vacuum'] and report['free_pages']:
+        print(f"ℹ️  {report['free_pages']} free pages can't be released without "
+              f"`maintenance.py optimize --full` (once; later runs release them in small steps).")
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Library maintenance. With no command, starts the interactive editor.")
+    commands = parser.add_subparsers(dest='command')
+
+    export_parser = commands.add_parser('export', help="Export the library as CSV, NDJSON or JSON")
+    export_parser.add_argument('-o', '--output', help="File to write (default: stdout). A .gz name compresses it.")
+    export_parser.add_argument('-f', '--format', choices=list(export.FORMATS), help="Default: from the file name, else csv")
+    export_parser.add_argument('--filter', choices=list(facets.LEGACY_FILTERS), help="Only export one filter of the library")
+    for name, (_, _, heading) in facets.FACETS.items():
+        export_parser.add_argument(f'--{name}', action='append', metavar='VALUE',
+                                   help=f"{heading} to export, as in ?{name}= on the home page; repeatable")
+    export_parser.add_argument('--gzip', action='store_true', help="Gzip the output")
+
+    batch_parser = commands.add_parser(
+        'batch', help="Change fields on many books at once (one transaction, with undo)",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="examples:\n"
+               "  maintenance.py batch --where 'author=Pratchet, Terry' --set 'author=Pratchett, Terry'\n"
+               "  maintenance.py batch --ids 12,40,41 --set binding=Hardcover --set notes=\n"
+               "  maintenance.py batch --file fixes.csv --dry-run")
+    batch_parser.add_argument('--set', action='append', default=[], metavar='FIELD=VALUE', help="New value (empty clears it); repeatable")
+    batch_parser.add_argument('--ids', action='append', default=[], help="Comma-separated book ids")
+    batch_parser.add_argument('--where', action='append', default=[], metavar='FIELD=VALUE', help="Exact match (empty = not set); repeatable")
+    batch_parser.add_argument('--like', action='append', default=[], metavar='FIELD=PATTERN', help="SQL LIKE match, e.g. 'publisher=%%Ace%%'; repeatable")
+    batch_parser.add_argument('--all', action='store_true', help="Select every book")
+    batch_parser.add_argument('--file', help="CSV (id + field columns) or JSON list of edits, instead of --set")
+    batch_parser.add_argument('--dry-run', action='store_true', help="Show what would change and save nothing")
+    batch_parser.add_argument('-v', '--verbose', action='store_true', help="List every change after applying")
+
+    undo_parser = commands.add_parser('undo', help="Revert a batch edit from its journal in data/undo/")
+    undo_parser.add_argument('journal')
+    undo_parser.add_argument('--dry-run', action='store_true', help="Show what would be restored and save nothing")
+    undo_parser.add_argument('-v', '--verbose', action='store_true', help="List every restored field")
+
+    backup_parser = commands.add_parser('backup', help="Snapshot the database while the app keeps running")
+    backup_parser.add_argument('--dir', default=housekeeping.BACKUP_DIR, help="Where snapshots go (default: data/backups)")
+    backup_parser.add_argument('--keep', type=int, default=housekeeping.BACKUP_KEEP, help="Snapshots to keep")
+    backup_parser.add_argument('--no-verify', action='store_true', help="Skip the integrity check of the new snapshot")
+
+    verify_parser = commands.add_parser('verify', help="Integrity-check snapshots (default: all in the backup directory)")
+    verify_parser.add_argument('paths', nargs='*')
+    verify_parser.add_argument('--dir', default=housekeeping.BACKUP_DIR)
+
+    optimize_parser = commands.add_parser('optimize', help="Checkpoint, incremental vacuum and ANALYZE")
+    optimize_parser.add_argument('--full', action='store_true', help="One-off full VACUUM that enables incremental vacuum")
+
+    args = parser.parse_args(argv)
+    if args.command == 'export':
+        return export_mode(args)
+    if args.command == 'batch':
+        return batch_mode(args)
+    if args.command == 'undo':
+        return undo_mode(args)
+    if args.command == 'backup':
+        return backup_mode(args)
+    if args.command == 'verify':
+        return verify_mode(args)
+    if args.command == 'optimize':
+        return optimize_mode(args)
+    maintenance_mode()
+    return 0
+
 if __name__ == '__main__':
-    maintenance_mode()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,274 @@
+import bisect
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# In-process counters and histograms, rendered in the Prometheus text
+# format at /metrics. Every observation is a perf_counter() pair, a
+# bisect and a dict update under a lock, so this stays on in production.
+# Each process has its own numbers (scrape every worker/container).
+
+# Seconds. Routes and SQL statements mostly finish in milliseconds.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Seconds. Calls to Open Library / the cover CDN.
+UPSTREAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Statements slower than this (ms) are logged with their query plan.
+# Unset or 0 = off.
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS') or 0)
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for values, total in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, values)} {total}")
+        return lines
+
+class Gauge(Counter):
+    def set(self, *label_values, value):
+        with self._lock:
+            self._values[label_values] = value
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per-bucket counts (+Inf last), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for values, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, values, ('le', bound))} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, values)} {total:.6f}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, values)} {cumulative}")
+        return lines
+
+REQUESTS = Counter('caliper_http_requests_total', "HTTP requests by route, method and status.", ('route', 'method', 'status'))
+REQUEST_SECONDS = Histogram('caliper_http_request_duration_seconds', "Time spent handling a request.", ('route',))
+DB_SECONDS = Histogram('caliper_db_statement_duration_seconds', "Time spent executing and fetching one SQL statement.", ('route',))
+DB_ROWS = Counter('caliper_db_rows_total', "Rows returned (SELECT) or changed (writes) by SQL statements.", ('route',))
+DB_SLOW = Counter('caliper_db_slow_statements_total', "Statements slower than SLOW_QUERY_MS.", ('route',))
+UPSTREAM_SECONDS = Histogram('caliper_upstream_request_duration_seconds', "Calls to external HTTP services.",
+                             ('service', 'outcome'), buckets=UPSTREAM_BUCKETS)
+LOOKUP_CACHE = Counter('caliper_lookup_cache_total', "Open Library lookup cache results.", ('result',))
+PAGE_CACHE = Counter('caliper_page_cache_total', "Public page cache lookups.", ('result',))
+FACET_CACHE = Counter('caliper_facet_cache_total', "Facet count cache lookups.", ('result',))
+LISTING_CACHE = Counter('caliper_listing_cache_total', "Faceted listing page cache lookups.", ('result',))
+STATS_CACHE = Counter('caliper_stats_cache_total', "Collection statistics cache lookups.", ('result',))
+SERIES_CACHE = Counter('caliper_series_cache_total', "Series index lookups (hit, partial or full recompute).", ('result',))
+SHELF_PLAN = Counter('caliper_shelf_plan_total', "Shelf plan lookups (hit, miss, incremental or full re-plan).", ('result',))
+START_TIME = Gauge('caliper_process_start_time_seconds', "Unix time this process started.")
+START_TIME.set(value=time.time())
+
+REGISTRY = [REQUESTS, REQUEST_SECONDS, DB_SECONDS, DB_ROWS, DB_SLOW, UPSTREAM_SECONDS, LOOKUP_CACHE, PAGE_CACHE, FACET_CACHE, LISTING_CACHE, STATS_CACHE, SHELF_PLAN, SERIES_CACHE, START_TIME]
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+class upstream_timer:
+    """with upstream_timer('openlibrary'): ... records the call's duration,
+    with outcome 'error' if the block raised."""
+
+    def __init__(self, service):
+        self.service = service
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        outcome = 'ok' if exc_type is None else 'error'
+        UPSTREAM_SECONDS.observe(time.perf_counter() - self.start, self.service, outcome)
+        return False
+
+# --- SQL ---
+
+class InstrumentedCursor:
+    """Wraps a sqlite3 cursor. A statement's time is its execute() plus the
+    fetches that drain it; it is recorded once the rows are consumed (or
+    straight away for statements that return none)."""
+
+    def __init__(self, cursor, route):
+        self._cursor = cursor
+        self._route = route
+        self._sql = None
+        self._params = None
+        self._elapsed = 0.0
+        self._rows = 0
+        self._open = False
+
+    def __getattr__(self, name):
+        # lastrowid, rowcount, description, close, ...
+        return getattr(self._cursor, name)
+
+    def _start(self, sql, params):
+        self._finish()
+        self._sql = sql
+        self._params = params
+        self._elapsed = 0.0
+        self._rows = 0
+        self._open = True
+
+    def _finish(self):
+        if not self._open:
+            return
+        self._open = False
+        DB_SECONDS.observe(self._elapsed, self._route)
+        DB_ROWS.inc(self._route, amount=self._rows)
+        if SLOW_QUERY_MS and self._elapsed * 1000 >= SLOW_QUERY_MS:
+            DB_SLOW.inc(self._route)
+            log_slow_query(self._cursor.connection, self._sql, self._params, self._elapsed, self._route)
+
+    def execute(self, sql, params=()):
+        self._start(sql, params)
+        start = time.perf_counter()
+        try:
+            self._cursor.execute(sql, params)
+        finally:
+            self._elapsed += time.perf_counter() - start
+        if self._cursor.description is None:
+            self._rows = max(self._cursor.rowcount, 0)
+            self._finish()
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._start(sql, None)
+        start = time.perf_counter()
+        try:
+            self._cursor.executemany(sql, seq_of_params)
+        finally:
+            self._elapsed += time.perf_counter() - start
+        self._rows = max(self._cursor.rowcount, 0)
+        self._finish()
+        return self
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._elapsed += time.perf_counter() - start
+        if row is not None:
+            self._rows += 1
+        # Callers that use fetchone() want one row; don't wait for the rest
+        self._finish()
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = self._cursor.fetchmany(size if size is not None else self._cursor.arraysize)
+        self._elapsed += time.perf_counter() - start
+        self._rows += len(rows)
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._elapsed += time.perf_counter() - start
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = next(self._cursor)
+        except StopIteration:
+            self._elapsed += time.perf_counter() - start
+            self._finish()
+            raise
+        self._elapsed += time.perf_counter() - start
+        self._rows += 1
+        return row
+
+    def __del__(self):
+        # A cursor dropped before it was drained still counts
+        self._finish()
+
+class InstrumentedConnection:
+    """Wraps a sqlite3 connection so every statement is timed and its rows
+    counted under the given route label. Everything else is passed through."""
+
+    def __init__(self, conn, route):
+        self.conn = conn
+        self.route = route
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def cursor(self):
+        return InstrumentedCursor(self.conn.cursor(), self.route)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def commit(self):
+        start = time.perf_counter()
+        self.conn.commit()
+        DB_SECONDS.observe(time.perf_counter() - start, self.route)
+
+def log_slow_query(conn, sql, params, elapsed, route):
+    plan = ''
+    # executemany() has no single parameter set to explain
+    if params is not None:
+        try:
+            rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+            plan = '\n'.join(f"    {row[3]}" for row in rows)
+        except Exception as e:
+            plan = f"    (no plan: {e})"
+    log.warning("Slow query (%.1f ms) in %s:\n%s\n%s", elapsed * 1000, route, ' '.join(sql.split()), plan)
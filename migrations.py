@@ -0,0 +1,623 @@
+import os
+import sqlite3
+import time
+
+# Schema history for data/books.db.
+# The database's PRAGMA user_version records how many of these have been
+# applied. Each entry is a list of statements that run in one transaction,
+# so a deployed books.db upgrades in place the next time the app (or
+# maintenance.py) opens it. Only ever APPEND to this list.
+
+# One row of the works table (see migration 5), aggregated from the copies
+# in books that match `condition`.
+def _work_rows(condition):
+    return f'''
+        INSERT INTO works (
+            title, author, id, last_id, series_title, series_number,
+            published_year, last_year, copy_count,
+            read_copies, tbr_copies, dnf_copies, signed_copies,
+            formats, read_status
+        )
+        SELECT
+            g.title, g.author, g.id, g.last_id, first.series_title, first.series_number,
+            g.published_year, g.last_year, g.copy_count,
+            g.read_copies, g.tbr_copies, g.dnf_copies, g.signed_copies,
+            (SELECT GROUP_CONCAT(binding, ', ') FROM (
+                SELECT DISTINCT TRIM(binding) AS binding FROM books
+                WHERE title = g.title AND author = g.author AND TRIM(binding) != ''
+                ORDER BY 1
+            )),
+            (SELECT read_status FROM books
+                WHERE title = g.title AND author = g.author AND read_status IS NOT NULL
+                ORDER BY id LIMIT 1)
+        FROM (
+            SELECT
+                title, author,
+                MIN(id) AS id,
+                MAX(id) AS last_id,
+                MIN(published_year) AS published_year,
+                MAX(published_year) AS last_year,
+                COUNT(*) AS copy_count,
+                SUM(CASE WHEN read_status = 'Read' THEN 1 ELSE 0 END) AS read_copies,
+                SUM(CASE WHEN read_status = 'To Read' THEN 1 ELSE 0 END) AS tbr_copies,
+                SUM(CASE WHEN read_status = 'DNF' THEN 1 ELSE 0 END) AS dnf_copies,
+                SUM(CASE WHEN is_signed = 1 THEN 1 ELSE 0 END) AS signed_copies
+            FROM books
+            WHERE {condition}
+            GROUP BY title, author
+        ) AS g
+        JOIN books AS first ON first.id = g.id
+    '''
+
+def _refresh_work(ref, only_if="1 = 1"):
+    # Trigger body: rebuild the works row for <ref>.title / <ref>.author
+    # from its copies (nothing is inserted if none are left, or if the
+    # only_if condition is false).
+    return f'''
+        DELETE FROM works WHERE title = {ref}.title AND author = {ref}.author;
+        {_work_rows(f"title = {ref}.title AND author = {ref}.author AND {only_if}")};
+    '''
+
+# Facet values of one copy (<ref>.*), as facets.FACETS computes them.
+# Frozen here: changing a facet means a new migration.
+def _facet_values(ref, source=None):
+    source = f" FROM {source}" if source else ""
+    return f'''
+        SELECT 'status' AS facet, COALESCE({ref}read_status, '') AS value{source}
+        UNION ALL SELECT 'binding', TRIM({ref}binding){source}
+        UNION ALL SELECT 'signed', COALESCE({ref}is_signed, 0){source}
+        UNION ALL SELECT 'decade', {ref}published_year / 10 * 10{source}
+        UNION ALL SELECT 'publisher', TRIM({ref}publisher){source}
+        UNION ALL SELECT 'series', {ref}series_title{source}
+    '''
+
+def _count_facets(ref, delta):
+    # Trigger body: add `delta` copies to each facet value of <ref>
+    return f'''
+        INSERT INTO facet_values (facet, value, copies)
+        SELECT facet, value, {delta} FROM ({_facet_values(ref + '.')}) WHERE value IS NOT NULL
+        ON CONFLICT (facet, value) DO UPDATE SET copies = copies + {delta};
+    '''
+
+# Bitmask of what a copy (<ref>.*) is missing, for audit_queue:
+# 1 ISBN (unless flagged "no ISBN"), 2 height/width, 4 weight,
+# 8 cover, 16 page count, 32 publication year.
+def _audit_mask(ref):
+    return f'''(
+        (CASE WHEN ({ref}isbn IS NULL OR {ref}isbn = '') AND ({ref}no_isbn IS NULL OR {ref}no_isbn = 0) THEN 1 ELSE 0 END)
+        | (CASE WHEN {ref}height IS NULL OR {ref}height = 0 OR {ref}width IS NULL OR {ref}width = 0 THEN 2 ELSE 0 END)
+        | (CASE WHEN {ref}weight IS NULL OR {ref}weight = 0 THEN 4 ELSE 0 END)
+        | (CASE WHEN {ref}cover_url IS NULL OR {ref}cover_url = '' THEN 8 ELSE 0 END)
+        | (CASE WHEN {ref}page_count IS NULL OR {ref}page_count = 0 THEN 16 ELSE 0 END)
+        | (CASE WHEN {ref}published_year IS NULL OR {ref}published_year = 0 THEN 32 ELSE 0 END)
+    )'''
+
+def _audit_rows(ref, source=None):
+    # audit_queue rows for the copies in <source> (or the single copy <ref>)
+    source = f" FROM {source}" if source else ""
+    return f'''
+        INSERT INTO audit_queue (book_id, missing, author, series_title, series_number, title)
+        SELECT * FROM (
+            SELECT {ref}id, {_audit_mask(ref)} AS missing, {ref}author,
+                COALESCE({ref}series_title, ''), COALESCE({ref}series_number, -1), {ref}title{source}
+        ) WHERE missing != 0
+    '''
+
+# Audit lists (app.AUDIT_LISTS) -> audit_queue.missing bits
+_AUDIT_LIST_MASKS = {'isbn': 1, 'dims': 6, 'cover': 8, 'pages': 16, 'year': 32}
+
+MIGRATIONS = [
+    # 1. Baseline: the books table as the app has always used it
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS books (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            author TEXT NOT NULL,
+            isbn TEXT,
+            publisher TEXT,
+            binding TEXT,
+            page_count INTEGER,
+            published_year INTEGER,
+            series_title TEXT,
+            series_number REAL,
+            height REAL,
+            width REAL,
+            weight REAL,
+            notes TEXT,
+            cover_url TEXT,
+            read_status TEXT DEFAULT NULL,
+            is_signed INTEGER DEFAULT 0,
+            no_isbn INTEGER DEFAULT 0
+        )
+        ''',
+    ],
+
+    # 2. Full-text search
+    # External-content FTS5 index over the searchable columns of books.
+    # The triggers keep it in step with every INSERT/UPDATE/DELETE, and the
+    # prefix indexes make "tolk*" style queries cheap.
+    [
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+            title, author, series_title, publisher, isbn, notes,
+            content='books', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS books_fts_ai AFTER INSERT ON books BEGIN
+            INSERT INTO books_fts(rowid, title, author, series_title, publisher, isbn, notes)
+            VALUES (new.id, new.title, new.author, new.series_title, new.publisher, new.isbn, new.notes);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS books_fts_ad AFTER DELETE ON books BEGIN
+            INSERT INTO books_fts(books_fts, rowid, title, author, series_title, publisher, isbn, notes)
+            VALUES ('delete', old.id, old.title, old.author, old.series_title, old.publisher, old.isbn, old.notes);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS books_fts_au
+        AFTER UPDATE OF title, author, series_title, publisher, isbn, notes ON books BEGIN
+            INSERT INTO books_fts(books_fts, rowid, title, author, series_title, publisher, isbn, notes)
+            VALUES ('delete', old.id, old.title, old.author, old.series_title, old.publisher, old.isbn, old.notes);
+            INSERT INTO books_fts(rowid, title, author, series_title, publisher, isbn, notes)
+            VALUES (new.id, new.title, new.author, new.series_title, new.publisher, new.isbn, new.notes);
+        END
+        ''',
+        # Index the rows that were already in the library
+        "INSERT INTO books_fts(books_fts) VALUES ('rebuild')",
+    ],
+
+    # 3. Indexes for the hot access paths
+    [
+        # Copies of the same work: sibling lookup in book_detail(), the
+        # "apply status to all copies" UPDATEs, the read-status probe in
+        # lookup_isbn() and the GROUP BY title, author listing.
+        "CREATE INDEX IF NOT EXISTS idx_books_work ON books (title, author, read_status)",
+        # Status filter dropdown
+        "CREATE INDEX IF NOT EXISTS idx_books_read_status ON books (read_status)",
+        # "Show Signed Only" (a small slice of the library)
+        "CREATE INDEX IF NOT EXISTS idx_books_signed ON books (title, author) WHERE is_signed = 1",
+        # Audit lists. The WHERE clauses must stay word-for-word identical
+        # to the queries in audit_page() or the planner will not use them.
+        '''
+        CREATE INDEX IF NOT EXISTS idx_books_audit_isbn ON books (author, title)
+        WHERE (isbn IS NULL OR isbn = '')
+            AND (no_isbn IS NULL OR no_isbn = 0)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_books_audit_dims ON books (author, series_title, series_number, title)
+        WHERE (height IS NULL OR height = 0)
+            OR (width IS NULL OR width = 0)
+            OR (weight IS NULL OR weight = 0)
+        ''',
+        "ANALYZE",
+    ],
+
+    # 4. Bulk ISBN imports (bulk_import.py). Every input book is a row so an
+    # interrupted job can resume without re-fetching what it already has.
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS import_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            finished_at TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS import_rows (
+            job_id INTEGER NOT NULL REFERENCES import_jobs (id),
+            row_no INTEGER NOT NULL,
+            isbn TEXT,
+            fields TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            metadata TEXT,
+            message TEXT,
+            book_id INTEGER,
+            PRIMARY KEY (job_id, row_no)
+        )
+        ''',
+    ],
+
+    # 5. Precomputed works (one row per title/author), so the home page
+    # reads an index instead of grouping every copy on every request.
+    # Column names match the sort keys in app.py (id = first copy).
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS works (
+            title TEXT NOT NULL,
+            author TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            series_title TEXT,
+            series_number REAL,
+            published_year INTEGER,
+            last_year INTEGER,
+            copy_count INTEGER NOT NULL,
+            read_copies INTEGER NOT NULL,
+            tbr_copies INTEGER NOT NULL,
+            dnf_copies INTEGER NOT NULL,
+            signed_copies INTEGER NOT NULL,
+            formats TEXT,
+            read_status TEXT,
+            PRIMARY KEY (title, author)
+        )
+        ''',
+        _work_rows("1 = 1"),
+        # One index per sort mode, matching SORT_KEYS in app.py exactly
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_works_id ON works (id)",
+        "CREATE INDEX IF NOT EXISTS idx_works_last_id ON works (last_id)",
+        "CREATE INDEX IF NOT EXISTS idx_works_title ON works (title, id)",
+        '''
+        CREATE INDEX IF NOT EXISTS idx_works_author ON works (
+            author, COALESCE(series_title, ''), COALESCE(series_number, -1), title, id
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_works_year ON works (COALESCE(published_year, -1), id)",
+        "CREATE INDEX IF NOT EXISTS idx_works_last_year ON works (COALESCE(last_year, -1), last_id)",
+        f'''
+        CREATE TRIGGER IF NOT EXISTS works_ai AFTER INSERT ON books BEGIN
+            {_refresh_work('new')}
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS works_ad AFTER DELETE ON books BEGIN
+            {_refresh_work('old')}
+        END
+        ''',
+        # Old work first: a copy renamed to another title/author may have
+        # been its first copy, and works.id must stay unique.
+        f'''
+        CREATE TRIGGER IF NOT EXISTS works_au
+        AFTER UPDATE OF title, author, series_title, series_number, published_year,
+            binding, read_status, is_signed ON books BEGIN
+            {_refresh_work('old', "(old.title IS NOT new.title OR old.author IS NOT new.author)")}
+            {_refresh_work('new')}
+        END
+        ''',
+        "ANALYZE works",
+    ],
+
+    # 6. Change log for /api/changes: every write to books appends the
+    # book's id, so offline clients can fetch only what changed since the
+    # version they last saw. Deletes are told apart by the id being gone.
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS book_changes (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            book_id INTEGER NOT NULL
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS book_changes_ai AFTER INSERT ON books BEGIN
+            INSERT INTO book_changes (book_id) VALUES (new.id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS book_changes_au AFTER UPDATE ON books BEGIN
+            INSERT INTO book_changes (book_id) VALUES (new.id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS book_changes_ad AFTER DELETE ON books BEGIN
+            INSERT INTO book_changes (book_id) VALUES (old.id);
+        END
+        ''',
+    ],
+
+    # 7. Copies per facet value across the whole library, so the facet
+    # bar's counts need no scan of books when nothing (or one facet) is
+    # ticked. Values can drop to 0 copies; readers skip those rows.
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS facet_values (
+            facet TEXT NOT NULL,
+            value NOT NULL,
+            copies INTEGER NOT NULL,
+            PRIMARY KEY (facet, value)
+        ) WITHOUT ROWID
+        ''',
+        f'''
+        INSERT INTO facet_values (facet, value, copies)
+        SELECT facet, value, COUNT(*) FROM ({_facet_values('', 'books')})
+        WHERE value IS NOT NULL
+        GROUP BY facet, value
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS facet_values_ai AFTER INSERT ON books BEGIN
+            {_count_facets('new', 1)}
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS facet_values_ad AFTER DELETE ON books BEGIN
+            {_count_facets('old', -1)}
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS facet_values_au
+        AFTER UPDATE OF read_status, binding, is_signed, published_year, publisher, series_title ON books BEGIN
+            {_count_facets('old', -1)}
+            {_count_facets('new', 1)}
+        END
+        ''',
+    ],
+
+    # 8. Audit queue: one row per copy that is missing something, with the
+    # bitmask of what (see _audit_mask), kept by triggers so the audit
+    # page never scans books. Sort columns are copied in (NULLs folded to
+    # ''/-1) so each list pages through its own partial index, and
+    # audit_totals keeps each list's size. Queue rows are only ever
+    # inserted or deleted, never updated.
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS audit_queue (
+            book_id INTEGER PRIMARY KEY,
+            missing INTEGER NOT NULL,
+            author TEXT NOT NULL,
+            series_title TEXT NOT NULL,
+            series_number REAL NOT NULL,
+            title TEXT NOT NULL
+        )
+        ''',
+        _audit_rows('', 'books'),
+        *[f'''
+        CREATE INDEX IF NOT EXISTS idx_audit_queue_{name} ON audit_queue (author, series_title, series_number, title, book_id)
+        WHERE (missing & {mask}) != 0
+        ''' for name, mask in _AUDIT_LIST_MASKS.items()],
+        "CREATE TABLE IF NOT EXISTS audit_totals (mask INTEGER PRIMARY KEY, books INTEGER NOT NULL)",
+        *[f"INSERT INTO audit_totals (mask, books) SELECT {mask}, COUNT(*) FROM audit_queue WHERE (missing & {mask}) != 0"
+          for mask in _AUDIT_LIST_MASKS.values()],
+        '''
+        CREATE TRIGGER IF NOT EXISTS audit_totals_ai AFTER INSERT ON audit_queue BEGIN
+            UPDATE audit_totals SET books = books + 1 WHERE (new.missing & mask) != 0;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS audit_totals_ad AFTER DELETE ON audit_queue BEGIN
+            UPDATE audit_totals SET books = books - 1 WHERE (old.missing & mask) != 0;
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS audit_queue_ai AFTER INSERT ON books BEGIN
+            {_audit_rows('new.')};
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS audit_queue_ad AFTER DELETE ON books BEGIN
+            DELETE FROM audit_queue WHERE book_id = old.id;
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS audit_queue_au
+        AFTER UPDATE OF isbn, no_isbn, height, width, weight, cover_url, page_count, published_year,
+            title, author, series_title, series_number ON books BEGIN
+            DELETE FROM audit_queue WHERE book_id = old.id;
+            {_audit_rows('new.')};
+        END
+        ''',
+        # Replaced by the queue's own indexes
+        "DROP INDEX IF EXISTS idx_books_audit_isbn",
+        "DROP INDEX IF EXISTS idx_books_audit_dims",
+        "ANALYZE audit_queue",
+    ],
+
+    # 9. Metadata enrichment (enrich.py): the outcome of each book's Open
+    # Library lookup, so finished books are skipped and failed ones wait
+    # until retry_after. A deleted book, or a new ISBN, clears the row.
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS enrichment (
+            book_id INTEGER PRIMARY KEY,
+            status TEXT NOT NULL,
+            filled TEXT,
+            message TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            retry_after REAL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_enrichment_status ON enrichment (status, updated_at)",
+        '''
+        CREATE TRIGGER IF NOT EXISTS enrichment_ad AFTER DELETE ON books BEGIN
+            DELETE FROM enrichment WHERE book_id = old.id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS enrichment_au AFTER UPDATE OF isbn ON books
+        WHEN new.isbn IS NOT old.isbn BEGIN
+            DELETE FROM enrichment WHERE book_id = old.id;
+        END
+        ''',
+    ],
+
+    # 10. Duplicate detection (duplicates.py): a normalized key per
+    # title/author pair with an inverted trigram index over it. Keys are
+    # computed in Python, so triggers only queue the pairs that changed and
+    # duplicates.sync() indexes them; this migration queues every work.
+    # Pairs found are kept by key id, dismissed ones by title/author.
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS work_keys (
+            id INTEGER PRIMARY KEY,
+            title TEXT NOT NULL,
+            author TEXT NOT NULL,
+            title_key TEXT NOT NULL,
+            author_key TEXT NOT NULL,
+            UNIQUE (title, author)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_work_keys_key ON work_keys (title_key, author_key)",
+        '''
+        CREATE TABLE IF NOT EXISTS work_grams (
+            gram TEXT NOT NULL,
+            key_id INTEGER NOT NULL,
+            PRIMARY KEY (gram, key_id)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS work_gram_counts (
+            gram TEXT PRIMARY KEY,
+            works INTEGER NOT NULL
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS work_key_queue (
+            title TEXT NOT NULL,
+            author TEXT NOT NULL,
+            PRIMARY KEY (title, author)
+        ) WITHOUT ROWID
+        ''',
+        "INSERT OR IGNORE INTO work_key_queue (title, author) SELECT title, author FROM works",
+        '''
+        CREATE TRIGGER IF NOT EXISTS work_key_queue_ai AFTER INSERT ON books BEGIN
+            INSERT OR IGNORE INTO work_key_queue (title, author) VALUES (new.title, new.author);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS work_key_queue_ad AFTER DELETE ON books BEGIN
+            INSERT OR IGNORE INTO work_key_queue (title, author) VALUES (old.title, old.author);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS work_key_queue_au AFTER UPDATE OF title, author ON books
+        WHEN old.title IS NOT new.title OR old.author IS NOT new.author BEGIN
+            INSERT OR IGNORE INTO work_key_queue (title, author) VALUES (old.title, old.author);
+            INSERT OR IGNORE INTO work_key_queue (title, author) VALUES (new.title, new.author);
+        END
+        ''',
+        # Possible duplicates found so far (first_id < second_id)
+        '''
+        CREATE TABLE IF NOT EXISTS duplicate_pairs (
+            first_id INTEGER NOT NULL,
+            second_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            PRIMARY KEY (first_id, second_id)
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_duplicate_pairs_second ON duplicate_pairs (second_id)",
+        '''
+        CREATE TABLE IF NOT EXISTS duplicate_dismissals (
+            first_title TEXT NOT NULL,
+            first_author TEXT NOT NULL,
+            second_title TEXT NOT NULL,
+            second_author TEXT NOT NULL,
+            PRIMARY KEY (first_title, first_author, second_title, second_author)
+        ) WITHOUT ROWID
+        ''',
+    ],
+
+    # 11. Shelves for the shelf planner (shelving.py), in the order the
+    # books are laid out. One row can stand for several identical shelves.
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS shelves (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            width_mm REAL NOT NULL,
+            height_mm REAL NOT NULL,
+            max_load_kg REAL,
+            shelf_count INTEGER NOT NULL DEFAULT 1
+        )
+        ''',
+    ],
+
+    # 12. Series index (series.py): volumes in order within each series,
+    # for its window queries and per-series lookups
+    [
+        "CREATE INDEX IF NOT EXISTS idx_books_series ON books (series_title, series_number)",
+    ],
+
+    # 13. Change log versions (changes.py) come from book_changes'
+    # AUTOINCREMENT counter, which survives compaction; start it at 1 so a
+    # library with an empty log still has a version clients can hold. The
+    # floor is the oldest version deltas are still exact from.
+    [
+        '''
+        INSERT INTO sqlite_sequence (name, seq)
+        SELECT 'book_changes', 1
+        WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'book_changes')
+        ''',
+        "CREATE TABLE IF NOT EXISTS book_changes_floor (version INTEGER NOT NULL)",
+        "INSERT INTO book_changes_floor (version) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM book_changes_floor)",
+    ],
+
+    # 14. A row here while duplicates.py is re-pairing a big backlog, so a
+    # restart halfway still pairs the works indexed before it. Set now if
+    # works are queued: an interrupted first index may have left some
+    # indexed but never paired.
+    [
+        "CREATE TABLE IF NOT EXISTS duplicate_rebuild (id INTEGER PRIMARY KEY CHECK (id = 1))",
+        "INSERT OR IGNORE INTO duplicate_rebuild (id) SELECT 1 WHERE EXISTS (SELECT 1 FROM work_key_queue)",
+    ],
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# PUBLIC mode never migrates; it waits this long for the admin container
+# to bring books.db up to SCHEMA_VERSION
+SCHEMA_WAIT_SECONDS = float(os.environ.get('SCHEMA_WAIT', 60))
+
+class SchemaMismatch(Exception):
+    """books.db is not at the schema version this code expects."""
+
+def get_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(conn):
+    """Brings the database up to SCHEMA_VERSION. Returns the list of
+    versions that were applied (empty if it was already current)."""
+    applied = []
+    if get_version(conn) >= SCHEMA_VERSION:
+        return applied
+
+    # Manage transactions by hand so each migration is all-or-nothing
+    old_isolation = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        for version, statements in enumerate(MIGRATIONS, start=1):
+            # IMMEDIATE takes the write lock up front, so if the admin and
+            # public containers start together only one of them migrates.
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if get_version(conn) >= version:
+                    conn.execute('COMMIT')
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {version}')
+                conn.execute('COMMIT')
+            except sqlite3.Error:
+                conn.execute('ROLLBACK')
+                raise
+            applied.append(version)
+    finally:
+        conn.isolation_level = old_isolation
+
+    return applied
+
+def wait_until_current(connect, timeout=SCHEMA_WAIT_SECONDS, poll=1.0):
+    """For processes that must not write: polls the user_version of
+    connect() (a missing file counts as 0) until another process has
+    migrated it. Raises SchemaMismatch after `timeout` seconds, or at once
+    if the file is newer than this code."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            conn = connect()
+            try:
+                version = get_version(conn)
+            finally:
+                conn.close()
+        except sqlite3.OperationalError:
+            version = 0
+        if version == SCHEMA_VERSION:
+            return
+        if version > SCHEMA_VERSION:
+            raise SchemaMismatch(f"books.db is at schema version {version}, newer than this code ({SCHEMA_VERSION})")
+        if time.monotonic() >= deadline:
+            raise SchemaMismatch(f"books.db is at schema version {version}, expected {SCHEMA_VERSION}; "
+                                 f"start the admin app to migrate it")
+        time.sleep(poll)
@@ -0,0 +1,228 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import requests # pyright: ignore[reportMissingModuleSource]
+from requests.adapters import HTTPAdapter # pyright: ignore[reportMissingModuleSource]
+
+import database
+import metrics
+
+log = logging.getLogger(__name__)
+
+API_URL = "https://openlibrary.org/api/books"
+
+# (connect, read) seconds. A slow upstream must never pin a worker.
+TIMEOUT = (3.05, 10)
+
+# How long answers stay cached. Misses are re-checked sooner because
+# Open Library keeps adding editions.
+CACHE_TTL = int(os.environ.get('LOOKUP_CACHE_TTL', 30 * 24 * 3600))
+NEGATIVE_CACHE_TTL = int(os.environ.get('LOOKUP_NEGATIVE_TTL', 24 * 3600))
+
+# Lives next to books.db but in its own file, so the read-only public
+# container can still cache lookups.
+CACHE_PATH = os.path.join(database.BASE_DIR, 'data', 'cache.db')
+
+# Hot entries are also kept in memory
+MEMORY_CACHE_SIZE = 1024
+
+class LookupFailed(Exception):
+    """Open Library could not be reached or sent back something unusable."""
+
+def _make_session():
+    session = requests.Session()
+    # Keep-alive connections to openlibrary.org, shared by all threads
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = 'Caliper (self-hosted library manager)'
+    return session
+
+SESSION = _make_session()
+
+def clean_isbn(raw):
+    return ''.join(filter(str.isdigit, raw or ''))
+
+def extract_year(date_str):
+    if not date_str: return None
+    match = re.search(r'\d{4}', str(date_str))
+    if match: return int(match.group(0))
+    return None
+
+def format_authors(authors):
+    # "Frank Herbert" -> "Herbert, Frank", joined with " & "
+    formatted_names = []
+    for name in [a['name'] for a in authors]:
+        parts = name.strip().split(' ')
+        if len(parts) > 1:
+            last = parts[-1]
+            first = " ".join(parts[:-1])
+            formatted_names.append(f"{last}, {first}")
+        else:
+            formatted_names.append(name)
+    return " & ".join(formatted_names)
+
+def parse_book(book):
+    """Turns one Open Library 'jscmd=data' record into our column names."""
+    # Format Author
+    authors_str = "Unknown"
+    if 'authors' in book:
+        authors_str = format_authors(book['authors'])
+
+    # Cover
+    cover = ""
+    if 'cover' in book:
+        cover = book['cover'].get('large', book['cover'].get('medium', ''))
+
+    return {
+        'title': book.get('title', ''),
+        'author': authors_str,
+        'published_year': extract_year(book.get('publish_date')),
+        'page_count': book.get('number_of_pages'),
+        'publisher': (book.get('publishers') or [{}])[0].get('name', ''),
+        'cover_url': cover,
+    }
+
+def fetch_from_api(isbn):
+    """Asks Open Library directly. Returns the parsed book, or None if it
+    has no record of the ISBN. Raises LookupFailed on network/API errors."""
+    params = {'bibkeys': f'ISBN:{isbn}', 'jscmd': 'data', 'format': 'json'}
+    try:
+        with metrics.upstream_timer('openlibrary'):
+            response = SESSION.get(API_URL, params=params, timeout=TIMEOUT)
+            response.raise_for_status()
+            json_data = response.json()
+    except (requests.RequestException, ValueError) as e:
+        raise LookupFailed(str(e)) from e
+
+    key = f"ISBN:{isbn}"
+    if key not in json_data:
+        return None
+    try:
+        return parse_book(json_data[key])
+    except (KeyError, IndexError, TypeError, AttributeError) as e:
+        raise LookupFailed(f"Unexpected record format: {e}") from e
+
+class LookupCache:
+    """Two levels: a small in-memory LRU in front of a SQLite table that
+    survives restarts. Entries store None for "Open Library has no record"."""
+
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self):
+        # Opened lazily; callers hold self._lock
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=database.BUSY_TIMEOUT, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode = WAL')
+            self._conn.execute('PRAGMA synchronous = NORMAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS lookup_cache (
+                    isbn TEXT PRIMARY KEY,
+                    payload TEXT,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+            self._conn.commit()
+        return self._conn
+
+    def get(self, isbn):
+        """Returns (hit, book)."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(isbn)
+            if entry is not None and entry[0] > now:
+                self._memory.move_to_end(isbn)
+                return True, entry[1]
+
+            try:
+                row = self._db().execute(
+                    'SELECT payload, expires_at FROM lookup_cache WHERE isbn = ?', (isbn,)
+                ).fetchone()
+            except sqlite3.Error as e:
+                # A broken cache only costs us an API call
+                log.warning("Lookup cache read failed: %s", e)
+                return False, None
+            if row is None or row[1] <= now:
+                return False, None
+
+            book = json.loads(row[0]) if row[0] is not None else None
+            self._remember(isbn, row[1], book)
+            return True, book
+
+    def put(self, isbn, book):
+        ttl = CACHE_TTL if book is not None else NEGATIVE_CACHE_TTL
+        expires_at = time.time() + ttl
+        payload = json.dumps(book) if book is not None else None
+        with self._lock:
+            self._remember(isbn, expires_at, book)
+            try:
+                conn = self._db()
+                conn.execute(
+                    'INSERT OR REPLACE INTO lookup_cache (isbn, payload, expires_at) VALUES (?, ?, ?)',
+                    (isbn, payload, expires_at)
+                )
+                conn.commit()
+            except sqlite3.Error as e:
+                log.warning("Lookup cache write failed: %s", e)
+
+    def _remember(self, isbn, expires_at, book):
+        self._memory[isbn] = (expires_at, book)
+        self._memory.move_to_end(isbn)
+        while len(self._memory) > MEMORY_CACHE_SIZE:
+            self._memory.popitem(last=False)
+
+cache = LookupCache()
+
+# ISBN -> _InFlight for fetches currently running
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+class _InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.book = None
+        self.error = None
+
+def lookup(isbn):
+    """Cached Open Library lookup by (cleaned) ISBN.
+    Returns the parsed book or None. Raises LookupFailed if the API is
+    unreachable; failures are not cached."""
+    hit, book = cache.get(isbn)
+    metrics.LOOKUP_CACHE.inc('hit' if hit else 'miss')
+    if hit:
+        return book
+
+    # Only one thread talks to Open Library per ISBN; the rest wait for it
+    with _in_flight_lock:
+        flight = _in_flight.get(isbn)
+        leader = flight is None
+        if leader:
+            flight = _in_flight[isbn] = _InFlight()
+
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.book
+
+    try:
+        flight.book = fetch_from_api(isbn)
+        cache.put(isbn, flight.book)
+        return flight.book
+    except LookupFailed as e:
+        log.warning("Open Library lookup for ISBN %s failed: %s", isbn, e)
+        flight.error = e
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight[isbn]
+        flight.done.set()
@@ -0,0 +1,82 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import database
+import metrics
+
+# Rendered pages for the read-only (PUBLIC) instance. Only the admin
+# container writes to books.db, so a page stays valid until the next
+# commit from another connection, which PRAGMA data_version reports.
+# Everything is dropped at once when that happens.
+
+# Total size of cached bodies per process
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+class Entry:
+    __slots__ = ('body', 'mimetype', 'etag')
+
+    def __init__(self, body, mimetype):
+        self.body = body
+        self.mimetype = mimetype
+        # Strong validator: same bytes, same ETag
+        self.etag = hashlib.sha1(body).hexdigest()[:32]
+
+class PageCache:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, path=None, data_version=None):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._version = None
+        self._lock = threading.Lock()
+        # One connection just for PRAGMA data_version, which changes
+        # whenever any *other* connection commits. Opened on first use, so
+        # each serve.py worker gets its own rather than one from before the fork.
+        self._path = path
+        self._conn = None
+        # Or a function giving the version (snapshot.SnapshotPool.version)
+        self._data_version = data_version
+
+    def _current_version(self):
+        if self._data_version is not None:
+            return self._data_version()
+        if self._conn is None:
+            self._conn = database.connect(read_only=True, check_same_thread=False, path=self._path)
+        return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def version(self):
+        """Current data version. Drops every entry if the data changed."""
+        with self._lock:
+            version = self._current_version()
+            if version != self._version:
+                self._entries.clear()
+                self._size = 0
+                self._version = version
+            return version
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        metrics.PAGE_CACHE.inc('hit' if entry is not None else 'miss')
+        return entry
+
+    def put(self, key, body, mimetype, version):
+        """Stores a page rendered at data `version` (skipped if the data
+        changed while it was rendering). Returns the entry either way."""
+        entry = Entry(body, mimetype)
+        if len(body) > self.max_bytes // 4:
+            return entry
+        with self._lock:
+            if version != self._version:
+                return entry
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old.body)
+            self._entries[key] = entry
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted.body)
+        return entry
@@ -0,0 +1,160 @@
+import json
+import threading
+
+import changes
+import database
+import metrics
+
+# Series index for /series: which volumes of each series are owned, the
+# gaps between them (1, 2, 4 but no 3), fractional entries (0.5 novellas)
+# and the copies and formats held of each volume. Window functions over
+# idx_books_series do the grouping and gap finding.
+#
+# Results are kept per series. When books.db changes, the book_changes
+# log says which copies were written; only the series they left or
+# joined are computed again.
+
+# More changed copies than this since the last look: recompute everything
+RECOMPUTE_AT = 500
+
+# One row per owned volume and format, then one per gap between owned
+# whole-numbered volumes (counted from 1)
+_QUERY = """
+    WITH copies AS (
+        SELECT series_title, series_number, COALESCE(NULLIF(TRIM(binding), ''), 'Unknown') AS binding,
+               COUNT(*) AS copies, MIN(id) AS first_id, MIN(title) AS title
+        FROM books WHERE {where}
+        GROUP BY series_title, series_number, 3
+    ),
+    volumes AS (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY series_title, series_number ORDER BY first_id) AS nth
+        FROM copies
+    ),
+    whole AS (
+        SELECT series_title, series_number,
+               LAG(series_number, 1, 0) OVER (PARTITION BY series_title ORDER BY series_number) AS previous
+        FROM volumes
+        WHERE nth = 1 AND series_number >= 1 AND series_number = CAST(series_number AS INTEGER)
+    )
+    SELECT 'volume', series_title, series_number, binding, copies, first_id, title FROM volumes
+    UNION ALL
+    SELECT 'gap', series_title, previous + 1, series_number - 1, NULL, NULL, NULL FROM whole
+    WHERE series_number - previous > 1
+    ORDER BY 2, 1 DESC, 3, 6
+"""
+
+def label(number):
+    """2.0 -> '2', 0.5 -> '0.5'."""
+    return f"{number:g}"
+
+def compute(conn, names=None):
+    """{series title: series} for `names` (every series if None). A series
+    is a JSON-ready dict of its volumes (number, copies, formats, first
+    copy), the gaps as [from, to] and counts."""
+    if names is None:
+        rows = conn.execute(_QUERY.format(where="series_title > ''"))
+    else:
+        rows = conn.execute(_QUERY.format(where="series_title IN (SELECT value FROM json_each(?))"),
+                            (json.dumps(list(names)),))
+
+    result = {}
+    for kind, name, number, binding, copies, first_id, title in rows:
+        series = result.get(name)
+        if series is None:
+            series = result[name] = {
+                'name': name, 'copies': 0, 'volumes': [], 'gaps': [], 'missing': 0,
+                'owned': 0, 'fractional': 0, 'unnumbered': 0, 'highest': None,
+            }
+        if kind == 'gap':
+            # number and binding hold the gap's first and last missing volume
+            first, last = int(number), int(binding)
+            series['gaps'].append([first, last])
+            series['missing'] += last - first + 1
+            continue
+
+        series['copies'] += copies
+        if number is None:
+            series['unnumbered'] += copies
+            continue
+        volumes = series['volumes']
+        if not volumes or volumes[-1]['number'] != number:
+            whole = number == int(number)
+            volumes.append({'number': number, 'label': label(number), 'fractional': not whole,
+                            'title': title, 'id': first_id, 'copies': 0, 'bindings': {}})
+            if whole and number >= 1:
+                series['owned'] += 1
+                series['highest'] = int(number)
+            elif not whole:
+                series['fractional'] += 1
+        volumes[-1]['copies'] += copies
+        volumes[-1]['bindings'][binding] = copies
+    return result
+
+class SeriesIndex:
+    """compute() results per series, recomputed only for the series that
+    books.db writes touched (see stats.StatsCache for the versioning)."""
+
+    def __init__(self, path=None, data_version=None):
+        self._lock = threading.Lock()
+        self._path = path
+        self._conn = None
+        self._data_version = data_version
+        self._version = None
+        self._change_version = None
+        self._series = {}
+        # Book id -> series title, to find the series a copy left
+        self._book_series = {}
+
+    def _current_version(self):
+        if self._data_version is not None:
+            return self._data_version()
+        if self._conn is None:
+            self._conn = database.connect(read_only=True, check_same_thread=False, path=self._path)
+        return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def _refresh(self, conn):
+        version = self._current_version()
+        if version == self._version:
+            metrics.SERIES_CACHE.inc('hit')
+            return
+        # Read before the books, so a write in between is looked at again
+        # next time rather than missed
+        change_version = changes.current_version(conn)
+        changed = None
+        if self._change_version is not None:
+            changed = changes.changed_books(conn, self._change_version, RECOMPUTE_AT + 1)
+
+        if changed is None or len(changed) > RECOMPUTE_AT:
+            self._series = compute(conn)
+            self._book_series = dict(conn.execute("SELECT id, series_title FROM books WHERE series_title > ''"))
+            metrics.SERIES_CACHE.inc('full')
+        else:
+            affected = {self._book_series.pop(book_id) for book_id in changed if book_id in self._book_series}
+            for book_id, name in conn.execute('''
+                SELECT id, series_title FROM books
+                WHERE id IN (SELECT value FROM json_each(?)) AND series_title > ''
+            ''', (json.dumps(changed),)):
+                self._book_series[book_id] = name
+                affected.add(name)
+            if affected:
+                fresh = compute(conn, affected)
+                for name in affected:
+                    if name in fresh:
+                        self._series[name] = fresh[name]
+                    else:
+                        self._series.pop(name, None)
+            metrics.SERIES_CACHE.inc('partial')
+        self._version = version
+        self._change_version = change_version
+
+    def all(self, conn):
+        """Every series, by name."""
+        with self._lock:
+            self._refresh(conn)
+            return [self._series[name] for name in sorted(self._series)]
+
+    def get(self, conn, name):
+        """The series called `name`, or None."""
+        with self._lock:
+            self._refresh(conn)
+            return self._series.get(name)
@@ -0,0 +1,94 @@
+import argparse
+import multiprocessing
+import os
+import sys
+
+from gunicorn.app.base import BaseApplication # pyright: ignore[reportMissingImports]
+
+# Production server for both containers: Gunicorn with threaded workers.
+# The app is imported once in the master (migrations run and templates
+# are compiled there), then each forked worker opens its own SQLite
+# connections and starts its own background work (app.start_worker).
+#
+#   python serve.py                     # APP_MODE decides the defaults
+#   kill -HUP <master pid>              # graceful restart of the workers
+#
+# Every setting can also come from the environment (WEB_CONCURRENCY,
+# WEB_THREADS, ...), so a container can be tuned without a new command.
+
+def default_workers(read_only):
+    # PUBLIC: processes scale with cores. ADMIN: one process, because
+    # imports, metadata enrichment and cover downloads keep their progress
+    # in memory, and there is one user; its threads cover concurrency.
+    if not read_only:
+        return 1
+    return min(multiprocessing.cpu_count() * 2 + 1, 12)
+
+def options(args, read_only):
+    return {
+        'bind': args.bind,
+        'workers': args.workers or default_workers(read_only),
+        # Threads per worker. SQLite and the page cache release the GIL
+        # often enough that a few threads overlap well.
+        'worker_class': 'gthread',
+        'threads': args.threads or (8 if not read_only else 4),
+        # Import the app before forking: one migration run, shared
+        # compiled templates, and a broken build fails at startup
+        'preload_app': True,
+        # A worker whose main loop stalls this long is killed and replaced.
+        # Requests on gthread workers (like long exports) are not cut off.
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'keepalive': args.keepalive,
+        # Heartbeat files on tmpfs; a disk-backed /tmp in Docker can stall workers
+        'worker_tmp_dir': '/dev/shm' if os.path.isdir('/dev/shm') else None,
+        'accesslog': '-' if args.access_log else None,
+        'errorlog': '-',
+        'post_fork': _post_fork,
+    }
+
+def _post_fork(server, worker):
+    import app
+    app.start_worker()
+
+class Server(BaseApplication):
+    def __init__(self, settings):
+        self.settings = settings
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.settings.items():
+            if value is not None:
+                self.cfg.set(key, value)
+
+    def load(self):
+        import app
+        app.warm_templates()
+        return app.app
+
+def main(argv=None):
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description="Run Caliper under Gunicorn.")
+    parser.add_argument('--bind', default=env('BIND', f"0.0.0.0:{env('PORT', '5000')}"))
+    parser.add_argument('--workers', type=int, default=int(env('WEB_CONCURRENCY', 0)), help="Worker processes (default: from APP_MODE and CPU cores)")
+    parser.add_argument('--threads', type=int, default=int(env('WEB_THREADS', 0)), help="Threads per worker")
+    parser.add_argument('--timeout', type=int, default=int(env('WEB_TIMEOUT', 30)), help="Seconds before a stuck worker is replaced")
+    parser.add_argument('--graceful-timeout', type=int, default=int(env('WEB_GRACEFUL_TIMEOUT', 30)), help="Seconds workers get to finish requests on restart/stop")
+    parser.add_argument('--keepalive', type=int, default=int(env('WEB_KEEPALIVE', 5)), help="Seconds to hold idle keep-alive connections")
+    parser.add_argument('--access-log', action='store_true', default=env('ACCESS_LOG') == '1')
+    parser.add_argument('--print-config', action='store_true', help="Show the settings and exit")
+    args = parser.parse_args(argv)
+
+    read_only = os.environ.get('APP_MODE', 'ADMIN').upper() == 'PUBLIC'
+    settings = options(args, read_only)
+    if args.print_config:
+        for key, value in settings.items():
+            if not callable(value):
+                print(f"{key} = {value}")
+        return 0
+
+    Server(settings).run()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,44 +1,126 @@
+import argparse
+import random
 import sqlite3
 import os
+import migrations
 
-def create_example_database():
+# Named library sizes for --size (number of copies in books)
+SIZES = {
+    '1k': 1_000,
+    '10k': 10_000,
+    '100k': 100_000,
+    '1m': 1_000_000,
+}
+
+# Building blocks for generated libraries
+FIRST_NAMES = ["Ada", "Brandon", "Claire", "Daniel", "Elena", "Frank", "Grace", "Haruki", "Isaac", "Jane",
+               "Kazuo", "Leigh", "Margaret", "Neil", "Octavia", "Patrick", "Robin", "Stephen", "Terry", "Ursula",
+               "Vernor", "William", "Yoon", "Zadie"]
+LAST_NAMES = ["Abercrombie", "Banks", "Chiang", "Dick", "Eddings", "Feist", "Gaiman", "Hobb", "Ishiguro", "Jemisin",
+              "King", "Le Guin", "Martin", "Novik", "Okorafor", "Pratchett", "Rothfuss", "Sanderson", "Tolkien",
+              "Vinge", "Wolfe", "Zelazny", "Atwood", "Butler", "Clarke", "Herbert", "Leckie", "Simmons"]
+TITLE_WORDS = ["Shadow", "Empire", "Stone", "River", "Crown", "Glass", "Winter", "Ash", "Storm", "Garden",
+               "Iron", "Silver", "Night", "Ember", "Tide", "Mirror", "Wolf", "Star", "Salt", "Lantern",
+               "Thorn", "Harbor", "Memory", "Clock", "Raven", "Dust", "Engine", "Bone", "Song", "Gate"]
+TITLE_PATTERNS = ["The {a} of {b}", "{a} and {b}", "The {a} {b}", "{a}'s {b}", "A {a} in the {b}", "{a}"]
+PUBLISHERS = ["Ace", "Tor", "Orbit", "Del Rey", "Penguin", "Vintage", "Gollancz", "DAW", "Harper Voyager",
+              "Houghton Mifflin", "Bantam", "Picador"]
+BINDINGS = ["Paperback", "Hardcover", "Mass Market Paperback", "eBook", "Other"]
+READ_STATUSES = [("Read", 45), ("To Read", 25), ("DNF", 3), ("Reference", 2), (None, 25)]
+
+INSERT_SQL = '''
+    INSERT INTO books (
+        title, author, isbn, publisher, binding, 
+        page_count, published_year, series_title, series_number, 
+        height, width, weight, notes, 
+        cover_url, read_status, is_signed, no_isbn
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+def make_isbn(rng):
+    # 978 + 9 random digits + a valid ISBN-13 check digit
+    digits = [9, 7, 8] + [rng.randint(0, 9) for _ in range(9)]
+    check = (10 - sum(d * (1 if i % 2 == 0 else 3) for i, d in enumerate(digits)) % 10) % 10
+    return ''.join(map(str, digits)) + str(check)
+
+def generate_books(copies, seed=1):
+    """Yields `copies` rows for INSERT_SQL: series, several bindings per
+    work, missing dimensions and missing ISBNs in realistic proportions."""
+    rng = random.Random(seed)
+    author_count = max(10, copies // 25)
+    authors = [f"{rng.choice(LAST_NAMES)}, {rng.choice(FIRST_NAMES)}" +
+               (f" {chr(65 + i % 26)}." if i >= 26 else "") for i in range(author_count)]
+    statuses, weights = zip(*READ_STATUSES)
+    made = 0
+    work_no = 0
+
+    while made < copies:
+        work_no += 1
+        author_no = rng.randrange(author_count)
+        author = authors[author_no]
+        # About a third of works belong to one of the author's two series
+        in_series = rng.random() < 0.3
+        a, b = rng.sample(TITLE_WORDS, 2)
+        title = rng.choice(TITLE_PATTERNS).format(a=a, b=b)
+        if rng.random() < 0.5:
+            title += f" {work_no}"
+        series_title = None
+        if in_series:
+            series_title = f"The {TITLE_WORDS[author_no % len(TITLE_WORDS)]} {rng.choice(['Cycle', 'Saga'])}"
+        series_number = float(rng.randint(0, 12)) if in_series else None
+        if in_series and rng.random() < 0.05:
+            series_number += 0.5  # novellas
+
+        year = rng.choice([rng.randint(1850, 1979), rng.randint(1980, 2025), rng.randint(1980, 2025)])
+        page_count = rng.randint(90, 1200)
+        cover_id = rng.randint(1_000_000, 14_000_000)
+
+        # Most works are a single copy; some are owned in several bindings
+        copy_count = rng.choices([1, 2, 3], weights=[80, 15, 5])[0]
+        for binding in rng.sample(BINDINGS, copy_count):
+            if made >= copies:
+                break
+            made += 1
+
+            isbn = make_isbn(rng)
+            no_isbn = 0
+            if rng.random() < 0.06:
+                isbn = None
+                no_isbn = 1 if rng.random() < 0.5 else 0
+
+            height, width, weight = round(rng.uniform(170, 240), 1), round(rng.uniform(105, 160), 1), round(rng.uniform(150, 1200))
+            if rng.random() < 0.15:
+                # Not measured yet (some of the three, or all)
+                height, width, weight = [v if rng.random() < 0.5 else None for v in (height, width, weight)]
+                if height and width and weight:
+                    weight = None
+
+            yield (
+                title, author, isbn, rng.choice(PUBLISHERS), binding,
+                page_count, year, series_title, series_number,
+                height, width, weight, "Generated copy." if rng.random() < 0.1 else None,
+                f"https://covers.openlibrary.org/b/id/{cover_id}-L.jpg" if rng.random() < 0.7 else None,
+                rng.choices(statuses, weights=weights)[0], 1 if rng.random() < 0.02 else 0, no_isbn
+            )
+
+def create_example_database(db_path=os.path.join('data', 'books.db'), copies=0, seed=1):
     # 1. Ensure the 'data' directory exists
-    if not os.path.exists('data'):
-        os.makedirs('data')
-        print("📁 Created 'data' directory.")
+    data_dir = os.path.dirname(db_path)
+    if data_dir and not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+        print(f"📁 Created '{data_dir}' directory.")
 
-    db_path = os.path.join('data', 'books.db')
+    # 2. Start from a clean slate (drop any old database and its WAL files)
+    for path in (db_path, db_path + '-wal', db_path + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
 
-    # 2. Connect (this creates the file)
+    # 3. Connect (this creates the file)
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
 
-    # 3. Drop table if exists (Clean Slate)
-    cursor.execute('DROP TABLE IF EXISTS books')
-
-    # 4. Create the Table with the exact schema we built
-    cursor.execute('''
-        CREATE TABLE books (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT NOT NULL,
-            author TEXT NOT NULL,
-            isbn TEXT,
-            publisher TEXT,
-            binding TEXT,
-            page_count INTEGER,
-            published_year INTEGER,
-            series_title TEXT,
-            series_number REAL,
-            height REAL,
-            width REAL,
-            weight REAL,
-            notes TEXT,
-            cover_url TEXT,
-            read_status TEXT DEFAULT NULL,
-            is_signed INTEGER DEFAULT 0,
-            no_isbn INTEGER DEFAULT 0
-        )
-    ''')
+    # 4. Create the schema (tables, search index, indexes) from migrations.py
+    migrations.migrate(conn)
     print("✅ Created 'books' table structure.")
 
     # 5. Insert Sample Data
@@ -70,20 +152,50 @@ def create_example_database():
         )
     ]
 
-    cursor.executemany('''
-        INSERT INTO books (
-            title, author, isbn, publisher, binding, 
-            page_count, published_year, series_title, series_number, 
-            height, width, weight, notes, 
-            cover_url, read_status, is_signed, no_isbn
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', sample_books)
+    cursor.executemany(INSERT_SQL, sample_books)
 
     conn.commit()
-    conn.close()
     print(f"✅ Inserted {len(sample_books)} sample books.")
+
+    # 6. Optionally pad it out to a large generated library
+    if copies:
+        # Nothing to lose in a fresh file, so skip the fsyncs
+        conn.execute('PRAGMA synchronous = OFF')
+        # FTS5 flushes its pending terms at every trigger statement, which
+        # gets slower as the index grows. Index everything once at the end.
+        fts_trigger = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'books_fts_ai'").fetchone()[0]
+        conn.execute('DROP TRIGGER books_fts_ai')
+        rows = generate_books(copies, seed)
+        done = 0
+        while True:
+            chunk = [row for _, row in zip(range(10_000), rows)]
+            if not chunk:
+                break
+            cursor.executemany(INSERT_SQL, chunk)
+            conn.commit()
+            done += len(chunk)
+            print(f"   ...{done:,} / {copies:,}", end='\r', flush=True)
+        conn.execute(fts_trigger)
+        conn.execute("INSERT INTO books_fts(books_fts) VALUES ('rebuild')")
+        conn.execute('ANALYZE')
+        conn.commit()
+        print()
+        print(f"✅ Inserted {done:,} generated copies.")
+
+    conn.close()
     print(f"🎉 Database ready at: {db_path}")
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create data/books.db with sample books, optionally padded to a large generated library.")
+    parser.add_argument('--size', choices=sorted(SIZES, key=SIZES.get), help="Add a generated library of this many copies")
+    parser.add_argument('--copies', type=int, default=0, help="...or exactly this many generated copies")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed (the same seed builds the same library)")
+    parser.add_argument('--path', default=os.path.join('data', 'books.db'), help="Database file to (re)create")
+    args = parser.parse_args(argv)
+
+    copies = SIZES[args.size] if args.size else args.copies
+    create_example_database(args.path, copies, args.seed)
+
 if __name__ == '__main__':
 
-    create_example_database()
+    main()
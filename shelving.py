@@ -0,0 +1,313 @@
+import json
+import threading
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+
+import changes
+import database
+import metrics
+import stats
+
+# Shelf planner for /shelves: lays the physical copies out on the shelves
+# defined in the shelves table, shelf after shelf, and reports each
+# shelf's fill and load and the copies that don't fit.
+#
+# A copy takes stats.spine_sql() of shelf (spines aren't measured). The
+# plan is kept between requests: when books change, the changed copies
+# are moved in the ordered list and the layout is redone from the shelf
+# the change falls on, only until a shelf starts with the same copy as
+# before. From there on the old plan still holds.
+
+# canonical: the library's own order (author, series, number, title).
+#   A copy too tall for the shelf its turn comes on is set aside and put
+#   on the nearest tall enough shelf after it with room left.
+# height: copies grouped by the lowest shelf they fit (canonical order
+#   within), lowest shelves first, so tall shelves are kept for tall books.
+MODES = ('canonical', 'height')
+
+# Unweighed copies count this many grams per mm of spine
+GRAMS_PER_MM = 18
+
+# More changed copies than this since the last plan: plan from scratch
+REPLAN_AT = 500
+
+def _books_query():
+    # One row per physical copy: its canonical sort key (author, series,
+    # number, title, id; as SORT_KEYS['author'] in app.py), then spine mm,
+    # height, grams and whether it was weighed
+    return f"""
+        SELECT author, COALESCE(series_title, ''), COALESCE(series_number, -1), title, id,
+               spine, height, COALESCE(weight, spine * {GRAMS_PER_MM}), weight IS NOT NULL
+        FROM (SELECT author, series_title, series_number, title, id, {stats.spine_sql()} AS spine,
+                     NULLIF(height, 0) AS height, NULLIF(weight, 0) AS weight
+              FROM books WHERE {stats.physical_sql()})
+    """
+
+def _read_books(conn, where='', params=()):
+    # {id: (sort key, row)}
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(_books_query() + where, params)
+    return {row[4]: (row[:5], row) for row in cursor}
+
+def load_shelves(conn):
+    """The shelves in layout order: one (definition id, name, width mm,
+    height mm, load limit g) per physical shelf."""
+    shelves = []
+    for row in conn.execute('SELECT id, name, width_mm, height_mm, max_load_kg, shelf_count FROM shelves ORDER BY id'):
+        definition_id, name, width, height, max_load, count = row
+        for number in range(1, count + 1):
+            label = f"{name} {number}" if count > 1 else name
+            shelves.append((definition_id, label, width, height, max_load * 1000 if max_load else None))
+    return shelves
+
+def _book(row):
+    return {'id': row[4], 'title': row[3], 'author': row[0]}
+
+class _Layout:
+    """One mode's plan: the copies in layout order and, per shelf, (first
+    position, end position, mm used, grams, ids set aside, ids too tall
+    for every shelf), with what plan() shows of it."""
+
+    def __init__(self, mode, shelves, entries):
+        self.mode = mode
+        self.canonical = mode == 'canonical'
+        if self.canonical:
+            self.order = list(range(len(shelves)))
+        else:
+            self.order = sorted(range(len(shelves)), key=lambda i: (shelves[i][3], i))
+        self.shelves = [shelves[i] for i in self.order]
+        self.clearances = sorted({shelf[3] for shelf in shelves})
+        self.tallest = self.clearances[-1] if self.clearances else 0
+        self.sequence = sorted(map(self._item, entries), key=itemgetter(0))
+        self.fills = []
+        self.views = []
+        self._lay(0, 0)
+
+    def _item(self, entry):
+        key, row = entry
+        if self.canonical:
+            return entry
+        # Lowest shelf height class the copy fits; unmeasured copies are
+        # taken to fit any shelf
+        return (bisect_left(self.clearances, row[6]) if row[6] else 0, key), row
+
+    def _lay(self, shelf, position, cut=0, shift=0):
+        # Lays copies out from `position` onto shelves from `shelf` on,
+        # until a shelf starts where it did before the change (positions
+        # from `cut` on moved by `shift`): the old plan holds from there.
+        sequence = self.sequence
+        old = self.fills
+        first = shelf
+        laid = []
+        while shelf < len(self.shelves):
+            if shelf < len(old) and old[shelf][0] >= cut and old[shelf][0] + shift == position:
+                break
+            _, _, width, height, limit = self.shelves[shelf]
+            start = position
+            used = load = 0
+            aside = []
+            too_tall = []
+            while position < len(sequence):
+                _, _, _, _, book_id, spine, book_height, grams, _ = sequence[position][1]
+                if book_height and book_height > self.tallest:
+                    too_tall.append(book_id)
+                    position += 1
+                    continue
+                if book_height and book_height > height:
+                    if not self.canonical:
+                        break
+                    aside.append(book_id)
+                    position += 1
+                    continue
+                # An empty shelf takes the copy even if it is too wide or
+                # heavy for it, so one bad measurement can't empty the rest
+                if used and (used + spine > width or (limit is not None and load + grams > limit)):
+                    break
+                used += spine
+                load += grams
+                position += 1
+            laid.append((start, position, used, load, aside, too_tall))
+            shelf += 1
+
+        tail = [(start + shift, end + shift, *rest) for start, end, *rest in old[shelf:]]
+        self.fills = old[:first] + laid + tail
+        self.views = self.views[:first] + [self._view(fill) for fill in laid] + self.views[shelf:]
+
+    def _view(self, fill):
+        start, end, used, load, aside, too_tall = fill
+        books = [item[1] for item in self.sequence[start:end]]
+        if aside or too_tall:
+            skipped = set(aside) | set(too_tall)
+            books = [row for row in books if row[4] not in skipped]
+        return {
+            'books': [row[4] for row in books],
+            'used_mm': used,
+            'load_g': load,
+            'unweighed': sum(1 for row in books if not row[8]),
+            'first': _book(books[0]) if books else None,
+            'last': _book(books[-1]) if books else None,
+        }
+
+    def _relayout(self, position, cut, shift):
+        if not self.fills:
+            return
+        # Shelves before the one holding the copy ahead of the change were
+        # closed by copies ahead of it, so they stay as they are
+        starts = [fill[0] for fill in self.fills]
+        shelf = max(bisect_right(starts, position - 1) - 1, 0)
+        self._lay(shelf, starts[shelf], cut, shift)
+
+    def add(self, entry):
+        item = self._item(entry)
+        position = bisect_left(self.sequence, item)
+        self.sequence.insert(position, item)
+        self._relayout(position, position, 1)
+
+    def remove(self, entry):
+        item = self._item(entry)
+        position = bisect_left(self.sequence, item)
+        del self.sequence[position]
+        self._relayout(position, position + 1, -1)
+
+    def unplaced_from(self):
+        return self.fills[-1][1] if self.fills else 0
+
+class ShelfPlanner:
+    """Shelf layouts of the whole library, one per mode, updated from the
+    book_changes log when books.db changes (see stats.StatsCache)."""
+
+    def __init__(self, path=None, data_version=None):
+        self._lock = threading.Lock()
+        self._path = path
+        self._conn = None
+        self._data_version = data_version
+        self._version = None
+        self._change_version = None
+        self._shelves = None
+        self._entries = {}
+        self._layouts = {}
+        self._plans = {}
+
+    def _current_version(self):
+        if self._data_version is not None:
+            return self._data_version()
+        if self._conn is None:
+            self._conn = database.connect(read_only=True, check_same_thread=False, path=self._path)
+        return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def get(self, conn, mode='canonical'):
+        """plan() of the library in `mode`."""
+        with self._lock:
+            version = self._current_version()
+            if version != self._version:
+                metrics.SHELF_PLAN.inc(self._refresh(conn))
+                self._version = version
+            else:
+                metrics.SHELF_PLAN.inc('hit' if mode in self._plans else 'miss')
+            if mode not in self._plans:
+                if mode not in self._layouts:
+                    self._layouts[mode] = _Layout(mode, self._shelves, self._entries.values())
+                self._plans[mode] = plan(self._layouts[mode], self._entries)
+            return self._plans[mode]
+
+    def _refresh(self, conn):
+        # Read before the books, so a write in between is fetched again
+        # next time rather than missed
+        change_version = changes.current_version(conn)
+        shelves = load_shelves(conn)
+        self._plans = {}
+        changed = None
+        if shelves == self._shelves and self._change_version is not None:
+            changed = changes.changed_books(conn, self._change_version, REPLAN_AT + 1)
+        self._change_version = change_version
+        self._shelves = shelves
+
+        if changed is None or len(changed) > REPLAN_AT:
+            self._entries = _read_books(conn)
+            # Laid out again when asked for
+            self._layouts = {}
+            return 'full'
+
+        entries = _read_books(conn, 'WHERE id IN (SELECT value FROM json_each(?))', (json.dumps(changed),))
+        for book_id in changed:
+            old = self._entries.pop(book_id, None)
+            new = entries.get(book_id)
+            if new is not None:
+                self._entries[book_id] = new
+            if old == new:
+                continue
+            for layout in self._layouts.values():
+                if old is not None:
+                    layout.remove(old)
+                if new is not None:
+                    layout.add(new)
+        return 'incremental'
+
+def plan(layout, entries):
+    """The layout as a JSON-ready dict: per shelf its copies (ids, in
+    order), fill and load, plus the copies too tall for every shelf and
+    those there was no room for."""
+    shelves = []
+    set_aside = []
+    too_tall = []
+    for (definition_id, name, width, height, limit), fill, view in zip(layout.shelves, layout.fills, layout.views):
+        set_aside.extend((len(shelves), book_id) for book_id in fill[4])
+        too_tall.extend(fill[5])
+        shelves.append(dict(view, definition_id=definition_id, name=name, width_mm=width, height_mm=height,
+                            max_load_kg=limit / 1000 if limit is not None else None, moved_here=[]))
+
+    # Copies set aside go to the nearest tall enough shelf after their own
+    # with room left, after the copies laid out there
+    no_room = []
+    for shelf_index, book_id in set_aside:
+        _, _, _, _, _, spine, height, grams, weighed = entries[book_id][1]
+        for shelf in shelves[shelf_index:]:
+            if shelf['height_mm'] < height or shelf['used_mm'] + spine > shelf['width_mm']:
+                continue
+            if shelf['max_load_kg'] is not None and shelf['load_g'] + grams > shelf['max_load_kg'] * 1000:
+                continue
+            shelf['moved_here'].append(book_id)
+            shelf['used_mm'] += spine
+            shelf['load_g'] += grams
+            shelf['unweighed'] += not weighed
+            break
+        else:
+            no_room.append(book_id)
+
+    # Shelves go back to their defined order (the height mode fills them
+    # lowest first)
+    ordered = [None] * len(shelves)
+    for index, shelf in zip(layout.order, shelves):
+        ordered[index] = shelf
+
+    for item in layout.sequence[layout.unplaced_from():]:
+        row = item[1]
+        (too_tall if row[6] and row[6] > layout.tallest else no_room).append(row[4])
+
+    capacity = sum(shelf['width_mm'] for shelf in ordered)
+    used = 0
+    for shelf in ordered:
+        used += shelf['used_mm']
+        shelf['copies'] = len(shelf['books']) + len(shelf['moved_here'])
+        shelf['fill'] = round(100 * shelf['used_mm'] / shelf['width_mm'], 1) if shelf['width_mm'] else 0
+        shelf['overfull'] = shelf['used_mm'] > shelf['width_mm']
+        shelf['used_mm'] = round(shelf['used_mm'], 1)
+        shelf['load_kg'] = round(shelf.pop('load_g') / 1000, 2)
+        shelf['overloaded'] = shelf['max_load_kg'] is not None and shelf['load_kg'] > shelf['max_load_kg']
+
+    return {
+        'mode': layout.mode,
+        'shelves': ordered,
+        'too_tall': [dict(_book(entries[book_id][1]), height_mm=entries[book_id][1][6]) for book_id in too_tall],
+        'no_room': [_book(entries[book_id][1]) for book_id in no_room],
+        'totals': {
+            'copies': len(layout.sequence),
+            'placed': sum(shelf['copies'] for shelf in ordered),
+            'shelves': len(ordered),
+            'used_shelves': sum(1 for shelf in ordered if shelf['copies']),
+            'capacity_m': round(capacity / 1000, 2),
+            'used_m': round(used / 1000, 2),
+            'fill': round(100 * used / capacity, 1) if capacity else 0,
+        },
+    }
@@ -0,0 +1,205 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import database
+
+log = logging.getLogger(__name__)
+
+# PUBLIC mode only reads, so each process can serve from an in-memory copy
+# of books.db instead of the shared (often network-mounted) file. The copy
+# is made with the backup API; a watcher thread polls the file's
+# data_version and, when the admin container has committed, loads a fresh
+# copy and swaps it in. Requests that started on the old copy finish on
+# it, and it is freed when the last of them hands its connection back.
+#
+# Memory: one copy of the database per process, two during a swap.
+
+# Seconds between checks for a changed books.db
+POLL_SECONDS = float(os.environ.get('SNAPSHOT_POLL', 2))
+
+class _Generation:
+    """One in-memory copy and the connections open on it."""
+
+    def __init__(self, number, uri, keeper):
+        self.number = number
+        self.uri = uri
+        # The memory database lives as long as one connection to it is open
+        self.keeper = keeper
+        self.idle = []
+        self.borrowed = 0
+        self.retired = False
+
+class SnapshotPool:
+    """Drop-in for database.ConnectionPool that hands out read-only
+    connections to the current in-memory copy. acquire() never touches
+    the disk once the first copy is loaded."""
+
+    def __init__(self, size=8, path=None, poll_seconds=POLL_SECONDS, on_load=None):
+        self.size = size
+        self.path = path or database.DB_PATH
+        self.poll_seconds = poll_seconds
+        # Called with a connection to each new copy once it is swapped in
+        # (covers.CoverMap.load), off the request path
+        self.on_load = on_load
+        self._current = None
+        self._owners = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        # Disk connection used only by the watcher, for PRAGMA data_version
+        self._source = None
+        self._source_id = None
+        self._loaded_version = None
+        self._watcher = None
+
+    def version(self):
+        """Number of the copy being served; changes on every swap (the page
+        and facet caches key on it instead of data_version)."""
+        return self._generation().number
+
+    def acquire(self):
+        self._generation()
+        with self._lock:
+            generation = self._current
+            conn = generation.idle.pop() if generation.idle else None
+            generation.borrowed += 1
+        if conn is None:
+            conn = self._connect(generation.uri)
+        with self._lock:
+            self._owners[id(conn)] = generation
+        return conn
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            generation = self._owners.pop(id(conn))
+            generation.borrowed -= 1
+            if not generation.retired and len(generation.idle) < self.size:
+                generation.idle.append(conn)
+                return
+            drop = generation.retired and generation.borrowed == 0
+        conn.close()
+        if drop:
+            generation.keeper.close()
+
+    def fill(self, count=None):
+        """Loads the first copy and opens idle connections to it."""
+        count = min(self.size if count is None else count, self.size)
+        opened = [self.acquire() for _ in range(count)]
+        for conn in opened:
+            self.release(conn)
+
+    def close_all(self):
+        with self._lock:
+            generation, self._current = self._current, None
+        if generation is not None:
+            self._retire(generation)
+
+    def refresh(self):
+        """Loads a new copy from disk and swaps it in."""
+        with self._load_lock:
+            self._load()
+
+    def start_watcher(self):
+        """Starts the thread that swaps in a new copy whenever books.db
+        changes. Call it in each serving process (threads don't survive
+        a fork)."""
+        if self._watcher is not None:
+            return
+        self._generation()
+        self._watcher = threading.Thread(target=self._watch, name='snapshot-watcher', daemon=True)
+        self._watcher.start()
+
+    # --- internals ---
+
+    def _connect(self, uri):
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA query_only = 1')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        return conn
+
+    def _generation(self):
+        generation = self._current
+        if generation is None:
+            with self._load_lock:
+                if self._current is None:
+                    self._load()
+                generation = self._current
+        return generation
+
+    def _file_id(self):
+        # A restored or replaced books.db is a new file, which
+        # data_version (per open file) can't see
+        stat = os.stat(self.path)
+        return (stat.st_dev, stat.st_ino)
+
+    def _load(self):
+        # Reopen the disk connection if the file was replaced, so the copy
+        # and the data_version baseline come from the same file
+        file_id = self._file_id()
+        if self._source is None or file_id != self._source_id:
+            if self._source is not None:
+                self._source.close()
+            self._source = database.connect(read_only=True, check_same_thread=False, path=self.path)
+            self._source_id = file_id
+
+        self._count += 1
+        # Named, shared-cache memory database, so every pooled connection
+        # of this process sees the same copy
+        uri = f"file:caliper-snapshot-{os.getpid()}-{self._count}?mode=memory&cache=shared"
+        keeper = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        started = time.perf_counter()
+        # Read before copying: a commit that lands during the copy then
+        # shows up as a change at the next poll
+        version = self._source.execute('PRAGMA data_version').fetchone()[0]
+        try:
+            # A single-step backup reads one consistent snapshot of the file
+            self._source.backup(keeper)
+        except Exception:
+            keeper.close()
+            raise
+        self._loaded_version = version
+
+        generation = _Generation(self._count, uri, keeper)
+        with self._lock:
+            old, self._current = self._current, generation
+        if old is not None:
+            self._retire(old)
+        log.info("Loaded in-memory snapshot %d of %s in %.0f ms",
+                 generation.number, self.path, (time.perf_counter() - started) * 1000)
+        if self.on_load is not None:
+            try:
+                self.on_load(keeper)
+            except Exception:
+                log.exception("on_load failed for snapshot %d", generation.number)
+
+    def _retire(self, generation):
+        with self._lock:
+            generation.retired = True
+            idle, generation.idle = generation.idle, []
+            drop = generation.borrowed == 0
+        for conn in idle:
+            conn.close()
+        if drop:
+            generation.keeper.close()
+
+    def _changed(self):
+        if self._file_id() != self._source_id:
+            return True
+        return self._source.execute('PRAGMA data_version').fetchone()[0] != self._loaded_version
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_seconds)
+            try:
+                with self._load_lock:
+                    if self._changed():
+                        self._load()
+            except Exception:
+                # Keep serving the last good copy; try again next time
+                log.exception("Could not refresh the in-memory snapshot")
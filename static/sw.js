@@ -0,0 +1,73 @@
+// Caliper service worker: keeps the site usable offline.
+//  - The library page is served from cache at once and refreshed in the
+//    background; its data comes from IndexedDB (see index.html), which
+//    is kept current with /api/changes.
+//  - Other pages: network first, falling back to the last copy seen.
+//  - Covers and static files never change: cache first.
+//  - Other API calls and all writes go straight to the network.
+
+const CACHE = 'caliper-v1';
+
+self.addEventListener('install', event => {
+    event.waitUntil(caches.open(CACHE).then(cache => cache.add('/')).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(
+        caches.keys()
+            .then(keys => Promise.all(keys.filter(key => key !== CACHE).map(key => caches.delete(key))))
+            .then(() => self.clients.claim())
+    );
+});
+
+function fetchAndCache(request) {
+    return fetch(request).then(response => {
+        if (response.ok) {
+            const copy = response.clone();
+            caches.open(CACHE).then(cache => cache.put(request, copy));
+        }
+        return response;
+    });
+}
+
+function offlinePage() {
+    return new Response(
+        '<!DOCTYPE html><meta name="viewport" content="width=device-width, initial-scale=1.0">' +
+        '<body style="background:#121212;color:#b0b0b0;font-family:sans-serif;padding:40px;">' +
+        '<p>You are offline and this page has not been saved yet.</p><p><a href="/" style="color:#4e9f3d;">← Back to Library</a></p>',
+        { status: 503, headers: { 'Content-Type': 'text/html; charset=utf-8' } }
+    );
+}
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    const url = new URL(request.url);
+    if (request.method !== 'GET' || url.origin !== self.location.origin) return;
+
+    if (url.pathname.startsWith('/covers/') || url.pathname.startsWith('/static/')) {
+        event.respondWith(caches.match(request).then(hit => hit || fetchAndCache(request)));
+        return;
+    }
+
+    if (request.mode !== 'navigate') return;
+
+    if (url.pathname === '/') {
+        // Stale-while-revalidate. Any sort/filter works from the same
+        // shell, since the page re-renders from IndexedDB.
+        event.respondWith(
+            caches.match(request, { ignoreSearch: true }).then(hit => {
+                const refresh = fetchAndCache(request);
+                if (hit) {
+                    refresh.catch(() => {});
+                    return hit;
+                }
+                return refresh.catch(offlinePage);
+            })
+        );
+        return;
+    }
+
+    event.respondWith(
+        fetchAndCache(request).catch(() => caches.match(request).then(hit => hit || offlinePage()))
+    );
+});
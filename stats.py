@@ -0,0 +1,206 @@
+import threading
+from bisect import bisect_right
+from itertools import accumulate
+
+import database
+import metrics
+
+# Collection analytics for /stats: shelf length and weight per format and
+# decade, page-count percentiles, height distribution and the authors and
+# series taking up the most shelf. One query gathers all of it (the
+# per-copy values are computed once, then grouped several ways), and the
+# result is kept until books.db changes.
+
+# Spine thickness isn't recorded (width is across the cover), so shelf
+# length is estimated: paper per page plus the boards of each format, in mm
+PAGE_MM = 0.05
+COVER_MM = {
+    'Hardcover': 6.0,
+    'Paperback': 1.5,
+    'Mass Market Paperback': 1.0,
+}
+OTHER_COVER_MM = 2.0
+# Page count assumed for copies that have none
+UNKNOWN_PAGES = 300
+
+# Formats that take no shelf space and weigh nothing
+DIGITAL = ('eBook',)
+
+PERCENTILES = (10, 25, 50, 75, 90, 99)
+# Histogram bucket sizes: pages, and mm of height
+PAGE_BUCKET = 100
+HEIGHT_BUCKET = 10
+# Authors / series listed by footprint
+TOP = 15
+
+# Per group: copies, physical copies, shelf mm, copies with a guessed page
+# count, grams, weighed copies, tallest, mean height, mean width, pages
+_AGGREGATES = """COUNT(*), SUM(physical), SUM(shelf_mm), SUM(physical AND pages IS NULL),
+    SUM(weight), COUNT(weight), MAX(height), AVG(height), AVG(width), SUM(pages)"""
+_PADDING = ", NULL" * 9
+
+def physical_sql():
+    """SQL condition over books: the copy takes shelf space."""
+    digital = ", ".join(repr(name) for name in DIGITAL)
+    return f"COALESCE(TRIM(binding), '') NOT IN ({digital})"
+
+def spine_sql():
+    """SQL expression over books: estimated mm of shelf a physical copy
+    takes."""
+    cover = " ".join(f"WHEN {name!r} THEN {mm}" for name, mm in COVER_MM.items())
+    return f"""(CASE TRIM(binding) {cover} ELSE {OTHER_COVER_MM} END)
+                   + COALESCE(NULLIF(page_count, 0), {UNKNOWN_PAGES}) * {PAGE_MM}"""
+
+def _copies_query():
+    return f"""
+        SELECT COALESCE(NULLIF(TRIM(binding), ''), 'Unknown') AS binding,
+               published_year / 10 * 10 AS decade,
+               NULLIF(author, '') AS author,
+               NULLIF(series_title, '') AS series_title,
+               NULLIF(page_count, 0) AS pages,
+               physical,
+               CASE WHEN physical THEN NULLIF(height, 0) END AS height,
+               CASE WHEN physical THEN NULLIF(width, 0) END AS width,
+               CASE WHEN physical THEN NULLIF(weight, 0) END AS weight,
+               CASE WHEN physical THEN
+                   {spine_sql()}
+               ELSE 0 END AS shelf_mm
+        FROM (SELECT binding, published_year, author, series_title, page_count, height, width, weight,
+                     {physical_sql()} AS physical FROM books)
+    """
+
+def _top(kind, column):
+    return f"""SELECT * FROM (
+        SELECT '{kind}', {column}, {_AGGREGATES} FROM copies WHERE {column} IS NOT NULL
+        GROUP BY {column} ORDER BY SUM(shelf_mm) DESC, COUNT(*) DESC LIMIT {TOP})"""
+
+def _query():
+    parts = [
+        f"SELECT 'total', NULL, {_AGGREGATES} FROM copies",
+        f"SELECT 'binding', binding, {_AGGREGATES} FROM copies GROUP BY binding",
+        f"SELECT 'decade', decade, {_AGGREGATES} FROM copies GROUP BY decade",
+        _top('author', 'author'),
+        _top('series', 'series_title'),
+        f"SELECT 'pages', pages, COUNT(*){_PADDING} FROM copies WHERE pages IS NOT NULL GROUP BY pages",
+        f"SELECT 'height', CAST(height / {HEIGHT_BUCKET} AS INTEGER) * {HEIGHT_BUCKET}, COUNT(*){_PADDING} "
+        f"FROM copies WHERE height IS NOT NULL GROUP BY 2",
+    ]
+    return f"WITH copies AS MATERIALIZED ({_copies_query()}) {' UNION ALL '.join(parts)}"
+
+def _group(name, row):
+    copies, physical, shelf_mm, guessed, grams, weighed, tallest, height, width, pages = row
+    return {
+        'name': name,
+        'copies': copies,
+        'physical': physical or 0,
+        'shelf_m': round((shelf_mm or 0) / 1000, 2),
+        'guessed_pages': guessed or 0,
+        'weight_kg': round((grams or 0) / 1000, 2),
+        'weighed': weighed,
+        'tallest_mm': tallest,
+        'mean_height_mm': round(height, 1) if height is not None else None,
+        'mean_width_mm': round(width, 1) if width is not None else None,
+        'pages': pages or 0,
+    }
+
+def percentiles(histogram, wanted=PERCENTILES):
+    """Percentiles of a {value: count} histogram, interpolated between the
+    closest ranks (like numpy's default). All of them come from one walk
+    of the cumulative counts instead of a sorted list of every copy."""
+    values = sorted(histogram)
+    ends = list(accumulate(histogram[value] for value in values))
+    if not ends:
+        return {p: None for p in wanted}
+
+    def at(rank):
+        return values[bisect_right(ends, rank)]
+
+    result = {}
+    for p in wanted:
+        rank = p / 100 * (ends[-1] - 1)
+        low = int(rank)
+        below, above = at(low), at(min(low + 1, ends[-1] - 1))
+        result[p] = round(below + (above - below) * (rank - low), 1)
+    return result
+
+def buckets(histogram, size):
+    """{value: count} regrouped into [{'from', 'to', 'copies'}] of `size`."""
+    grouped = {}
+    for value, count in histogram.items():
+        start = int(value // size * size)
+        grouped[start] = grouped.get(start, 0) + count
+    return [{'from': start, 'to': start + size - 1, 'copies': grouped[start]} for start in sorted(grouped)]
+
+def compute(conn):
+    """Everything /stats shows, as a JSON-ready dict."""
+    groups = {'binding': [], 'decade': [], 'author': [], 'series': []}
+    totals = None
+    pages = {}
+    heights = {}
+    for kind, key, *row in conn.execute(_query()):
+        if kind == 'total':
+            totals = _group(None, row)
+        elif kind == 'pages':
+            pages[key] = row[0]
+        elif kind == 'height':
+            heights[key] = row[0]
+        else:
+            groups[kind].append(_group(key, row))
+
+    groups['binding'].sort(key=lambda group: (-group['shelf_m'], -group['copies']))
+    groups['decade'].sort(key=lambda group: (group['name'] is None, group['name'] or 0))
+    for group in groups['decade']:
+        group['label'] = f"{group['name']}s" if group['name'] is not None else "Unknown"
+
+    return {
+        'totals': totals,
+        'bindings': groups['binding'],
+        'decades': groups['decade'],
+        'authors': groups['author'],
+        'series': groups['series'],
+        'page_counts': {
+            'copies': sum(pages.values()),
+            'percentiles': {f"p{p}": value for p, value in percentiles(pages).items()},
+            'histogram': buckets(pages, PAGE_BUCKET),
+        },
+        'heights': buckets(heights, HEIGHT_BUCKET),
+        'estimate': {
+            'page_mm': PAGE_MM,
+            'cover_mm': {**COVER_MM, 'other': OTHER_COVER_MM},
+            'unknown_pages': UNKNOWN_PAGES,
+        },
+    }
+
+class StatsCache:
+    """compute() result, recomputed when PRAGMA data_version says books.db
+    changed (see facets.CountCache)."""
+
+    def __init__(self, path=None, data_version=None):
+        self._entry = None
+        self._version = None
+        self._lock = threading.Lock()
+        self._path = path
+        self._conn = None
+        # Or a function giving the version (snapshot.SnapshotPool.version)
+        self._data_version = data_version
+
+    def _current_version(self):
+        if self._data_version is not None:
+            return self._data_version()
+        if self._conn is None:
+            self._conn = database.connect(read_only=True, check_same_thread=False, path=self._path)
+        return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def get(self, conn):
+        with self._lock:
+            version = self._current_version()
+            entry = self._entry if version == self._version else None
+        metrics.STATS_CACHE.inc('hit' if entry is not None else 'miss')
+        if entry is not None:
+            return entry
+
+        entry = compute(conn)
+        with self._lock:
+            if self._current_version() == version:
+                self._entry, self._version = entry, version
+        return entry